@@ -1,5 +1,5 @@
 # -*- coding: utf-8 -*-
-from odoo import models, fields, api, _
+from odoo import models, fields, api, tools, _
 from odoo.exceptions import UserError, ValidationError
 from xmlrpc import client
 
@@ -10,10 +10,73 @@ import sycret, random, math, logging
 import random, base64, re, string, hashlib
 import ujson as json
 import concurrent.futures
+import collections, multiprocessing, os, struct, threading, time
+import requests
+
+from . import frames, tracing
 
 _logger = logging.getLogger(__name__)
 
-eq = sycret.EqFactory(n_threads=10)
+# dpf factories are made on first use, one per thread count,
+# see ClientManager.get_dpf_threads
+_eq_factories = dict()
+_eq_lock = threading.Lock()
+
+
+def get_eq(n_threads):
+    with _eq_lock:
+        if n_threads not in _eq_factories:
+            _eq_factories[n_threads] = sycret.EqFactory(n_threads=n_threads)
+        return _eq_factories[n_threads]
+
+
+# framing of /o_dory/blobs, doc id | size, little endian
+FRAME_HEADER = struct.Struct("<qQ")
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+DOWNLOAD_TIMEOUT = 60
+# staged uploads, chunks are sent by PUT /o_dory/upload/<token>/<index>
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+UPLOAD_RETRIES = 5
+# servers found without the binary rpc route, by url, these get xml-rpc
+_xmlrpc_only = set()
+_XMLRPC = object()
+# encodings each server reads, by url, learnt from its answers
+_server_encodings = dict()
+# compression of the binary rpc bodies, by (url, method, direction):
+# [calls, compressed calls, bytes, bytes sent or received]
+_compression_stats = dict()
+_compression_lock = threading.Lock()
+# largest answer the client decompresses
+MAX_RPC_SIZE = 1024 * 1024 * 1024
+
+# uid of each account on its server, by (url, db, account, password), so that
+# only the first call of an account logs in over xml-rpc
+_uids = dict()
+
+# answers kept between delta searches by this process, see
+# ClientManager.search_keywords_delta, keyed by
+# (db, manager id, salt, partition, indices) -> {"version", "macs", "rows"}
+# the least recently searched ones are dropped past DELTA_ANSWERS_MAX, their
+# next search then covers the whole folder
+DELTA_ANSWERS_MAX = 256
+_delta_answers = collections.OrderedDict()
+_delta_lock = threading.Lock()
+
+
+def get_delta_answer(key):
+    with _delta_lock:
+        answer = _delta_answers.get(key)
+        if answer is not None:
+            _delta_answers.move_to_end(key)
+        return answer
+
+
+def set_delta_answer(key, answer):
+    with _delta_lock:
+        _delta_answers[key] = answer
+        _delta_answers.move_to_end(key)
+        while len(_delta_answers) > DELTA_ANSWERS_MAX:
+            _delta_answers.popitem(last=False)
 
 
 class ClientManager(models.Model):
@@ -41,6 +104,55 @@ class ClientManager(models.Model):
     salt = fields.Char("Salt", default=_get_salt)
 
     async_enabled = fields.Boolean("Async", default=False)
+    delta_search = fields.Boolean(
+        "Delta Search",
+        default=False,
+        help="Searches only evaluate the rows written since the previous search "
+        "of each keyword, the answers are merged on the client.",
+    )
+    partition_count = fields.Integer(
+        "Partitions",
+        default=1,
+        help="Documents are spread over this many partitions of the server "
+        "folder, each with its own bitmaps and MACs, searched in parallel.",
+    )
+    search_engine = fields.Selection(
+        [("seq", "Sequential"), ("async", "Async"), ("numpy", "NumPy")],
+        string="Server Search Engine",
+        default="numpy",
+        help="How the servers scan the bitmaps. NumPy works on packed columns.",
+    )
+    search_protocol = fields.Selection(
+        [("matrix", "Full Matrix"), ("fold", "XOR-Folded")],
+        string="Search Protocol",
+        default="fold",
+        help="Full Matrix: the servers return every column of the bitmaps. "
+        "XOR-Folded: one dpf key per queried index, "
+        "the servers return one share per index.",
+    )
+    rpc_transport = fields.Selection(
+        [("binary", "Binary"), ("xmlrpc", "XML-RPC")],
+        string="RPC Transport",
+        default="binary",
+        help="Binary: calls are sent to /o_dory/rpc as length prefixed frames, "
+        "the large payloads as raw bytes, servers without it get XML-RPC. "
+        "XML-RPC: every call goes through XML-RPC.",
+    )
+    rpc_compression = fields.Selection(
+        [("zlib", "zlib"), ("lzma", "LZMA"), ("none", "None")],
+        string="RPC Compression",
+        default="zlib",
+        help="Compression of the large bodies of the binary transport, "
+        "used with the servers that support it. LZMA is smaller and slower.",
+    )
+    dpf_key_format = fields.Selection(
+        [("compact", "Compact"), ("columns", "One Key per Column")],
+        string="DPF Key Format",
+        default="compact",
+        help="Compact: one dpf key per queried index, "
+        "expanded by the servers over the whole bloom filter. "
+        "One Key per Column: a dpf key for every bloom filter column.",
+    )
 
     # a crude extraction
     def extract_keywords(self, raw_file):
@@ -143,21 +255,62 @@ class ClientManager(models.Model):
         raise UserError(_("Connections Test Succeeded!"))
 
     # we only want to verify consistency, but not implement it
-    def verify_bitmap_consistency(self):
+    # (for the given partitions, all of them by default)
+    @tracing.timed("verify_bitmap_consistency")
+    def verify_bitmap_consistency(self, partitions=None):
         self.ensure_one()
         if len(self.account_ids) < 2:
             raise ValidationError(
                 _("Consistency verification needs at least two server accounts.")
             )
 
-        versions = [a.retrieve_bitmaps_version() for a in self.account_ids]
-        # # print("bitmaps versions -----> ", versions)
-        if not all(v == versions[0] for v in versions):
-            raise ValidationError(_("bitmaps versions don't match"))
+        if partitions is None:
+            partitions = self.get_partitions()
+        for partition in partitions:
+            versions = [
+                a.retrieve_bitmaps_version(partition) for a in self.account_ids
+            ]
+            # # print("bitmaps versions -----> ", versions)
+            if not all(v == versions[0] for v in versions):
+                raise ValidationError(_("bitmaps versions don't match"))
+
+    def get_partitions(self):
+        self.ensure_one()
+        return list(range(max(self.partition_count, 1)))
+
+    # the partition of each of the given documents
+    def get_doc_partitions(self, fids):
+        self.ensure_one()
+        records = self.env["document.record"].search(
+            [("manager_id", "=", self.id), ("doc_id", "in", fids)]
+        )
+        partitions = {r.doc_id: r.partition for r in records}
+        return [partitions.get(fid, 0) for fid in fids]
 
-    def verify_and_retrieve_current_macs(self):
+    # new documents go to the partitions holding the fewest documents,
+    # which keeps the bitmaps of the partitions about the same size
+    def assign_partitions(self, count):
         self.ensure_one()
-        old_macs_lst = [account.retrieve_col_macs() for account in self.account_ids]
+        sizes = dict.fromkeys(self.get_partitions(), 0)
+        groups = self.env["document.record"].read_group(
+            [("manager_id", "=", self.id)], ["partition"], ["partition"]
+        )
+        for group in groups:
+            if group["partition"] in sizes:
+                sizes[group["partition"]] = group["partition_count"]
+        res = []
+        for i in range(count):
+            partition = min(sizes, key=lambda p: (sizes[p], p))
+            sizes[partition] += 1
+            res.append(partition)
+        return res
+
+    @tracing.timed("retrieve_macs")
+    def verify_and_retrieve_current_macs(self, partition=0):
+        self.ensure_one()
+        old_macs_lst = [
+            account.retrieve_col_macs(partition) for account in self.account_ids
+        ]
         if not all(om == old_macs_lst[0] for om in old_macs_lst):
             raise ValidationError(_("MACs don't match"))
 
@@ -167,9 +320,11 @@ class ClientManager(models.Model):
 
         return old_macs
 
-    def verify_and_compute_macs_for_doc_ids(self, doc_ids):
+    @tracing.timed("compute_macs")
+    def verify_and_compute_macs_for_doc_ids(self, doc_ids, partition=0):
         macs = [
-            account.compute_macs_for_doc_ids(doc_ids) for account in self.account_ids
+            account.compute_macs_for_doc_ids(doc_ids, partition)
+            for account in self.account_ids
         ]
         if not all(m == macs[0] for m in macs):
             raise ValidationError(_("Selected computed MACs don't match"))
@@ -190,16 +345,35 @@ class ClientManager(models.Model):
                 _("Consistency verification needs at least two server accounts.")
             )
 
-        counts = [a.retrieve_doc_count() for a in self.account_ids]
+        counts = [
+            sum(a.retrieve_doc_count(p) for p in self.get_partitions())
+            for a in self.account_ids
+        ]
         # print("counts -----> ", counts)
         if not all(c == counts[0] for c in counts):
             raise ValidationError(_("Inconsistent doc counts."))
         return counts[0]
 
+    @tracing.traced("upload")
     def upload(self, raw_data):
-        self.verify_bitmap_consistency()
+        if not raw_data:
+            return []
+        partitions = self.assign_partitions(len(raw_data))
+        res_ids = [None] * len(raw_data)
+        for partition in sorted(set(partitions)):
+            positions = [k for (k, p) in enumerate(partitions) if p == partition]
+            doc_ids = self.upload_partition(
+                [raw_data[k] for k in positions], partition
+            )
+            for (k, doc_id) in zip(positions, doc_ids):
+                res_ids[k] = doc_id
+        return res_ids
 
-        old_macs = self.verify_and_retrieve_current_macs()
+    def upload_partition(self, raw_data, partition=0):
+        self.verify_bitmap_consistency([partition])
+        # the servers xor the macs of the new rows into theirs, which lets
+        # concurrent uploads to the folder go through in any order
+        self.verify_and_retrieve_current_macs(partition)
 
         files, rows, filenames, macs = [], [], [], []
         for rf, filename in raw_data:
@@ -222,13 +396,11 @@ class ClientManager(models.Model):
         if not files:
             return []
 
-        macs = self.update_col_macs(old_macs, macs)
-
-        data = [files, rows, macs]
+        data = [files, rows, json.dumps(macs)]
         # # print("-----> data", data)
         res_ids = None
         for account in self.account_ids:
-            doc_ids = account.upload(data)
+            doc_ids = account.upload_staged(data, partition)
             if res_ids == None:
                 res_ids = doc_ids
             if res_ids != doc_ids:
@@ -241,24 +413,37 @@ class ClientManager(models.Model):
                         "manager_id": self.id,
                         "doc_id": res_ids[i],
                         "name": filenames[i],
+                        "partition": partition,
                     }
                     for i in range(len(res_ids))
                 ]
             )
 
-        self.verify_bitmap_consistency()
+        self.verify_bitmap_consistency([partition])
         return res_ids
 
+    # documents are removed from the partition holding them
+    @tracing.traced("remove")
     def remove(self, fids):
-        self.verify_bitmap_consistency()
         res = False
-        old_macs = self.verify_and_retrieve_current_macs()
+        partitions = self.get_doc_partitions(fids)
+        for partition in sorted(set(partitions)):
+            res = self.remove_partition(
+                [fid for (fid, p) in zip(fids, partitions) if p == partition],
+                partition,
+            )
+        return res
+
+    def remove_partition(self, fids, partition=0):
+        self.verify_bitmap_consistency([partition])
+        res = False
+        old_macs = self.verify_and_retrieve_current_macs(partition)
         # compute selected files macs
-        new_macs = self.verify_and_compute_macs_for_doc_ids(fids)
+        new_macs = self.verify_and_compute_macs_for_doc_ids(fids, partition)
         macs = self.update_col_macs(old_macs, new_macs)
 
         for account in self.account_ids:
-            res = account.remove([fids, macs])
+            res = account.remove([fids, macs], partition)
             if not res:
                 raise ValidationError(_("Inconsistent removing."))
 
@@ -268,13 +453,26 @@ class ClientManager(models.Model):
             )
             rec_ids.unlink()
 
-        self.verify_bitmap_consistency()
+        self.verify_bitmap_consistency([partition])
         return res
 
-    # updating old file with the new raw file
+    # updating old file with the new raw file, in the partition holding it
+    @tracing.traced("update")
     def update(self, fids, new_raw_files):
-        self.verify_bitmap_consistency()
-        old_macs = self.verify_and_retrieve_current_macs()
+        res_ids = None
+        partitions = self.get_doc_partitions(fids)
+        for partition in sorted(set(partitions)):
+            positions = [k for (k, p) in enumerate(partitions) if p == partition]
+            res_ids = self.update_partition(
+                [fids[k] for k in positions],
+                [new_raw_files[k] for k in positions],
+                partition,
+            )
+        return res_ids
+
+    def update_partition(self, fids, new_raw_files, partition=0):
+        self.verify_bitmap_consistency([partition])
+        old_macs = self.verify_and_retrieve_current_macs(partition)
 
         encrypted_files, rows, macs = [], [], []
         for new_raw_file in new_raw_files:
@@ -293,18 +491,18 @@ class ClientManager(models.Model):
             rows.append(row)
 
         res_ids = None
-        remove_macs = self.verify_and_compute_macs_for_doc_ids(fids)
+        remove_macs = self.verify_and_compute_macs_for_doc_ids(fids, partition)
         macs = [remove_macs[i] ^ macs[i] for i in range(len(macs))]
         macs = self.update_col_macs(old_macs, macs)
         data = [fids, encrypted_files, rows, macs]
         for account in self.account_ids:
-            doc_ids = account.update(data)
+            doc_ids = account.update(data, partition)
             if res_ids == None:
                 res_ids = doc_ids
             if res_ids != doc_ids:
                 raise ValidationError(_("Inconsistent updating."))
 
-        self.verify_bitmap_consistency()
+        self.verify_bitmap_consistency([partition])
         return res_ids
 
     def retrieve_ids(self):
@@ -326,10 +524,28 @@ class ClientManager(models.Model):
         return list(ids)
 
     # retrieve documents by ids
+    # download the documents from one of the servers, both hold the same blobs
+    # should give a map of doc id -> path of the downloaded file
     def retrieve_files(self, fids):  # a list of fid
-        raise ValidationError(_("retrieve files failed"))
-
-    def prepare_dpf_seq(self, target_indices, start, end):
+        self.ensure_one()
+        if not self.account_ids:
+            raise ValidationError(_("retrieve files failed"))
+        paths = self.account_ids[0].retrieve_files(fids)
+        # decrypt is the identity for now, so the files are kept as downloaded
+        return paths
+
+    # threads of a key generation: o_dory_dpf_threads in the odoo
+    # configuration, else the o_dory.dpf_threads parameter, else the cores
+    def get_dpf_threads(self):
+        threads = tools.config.get("o_dory_dpf_threads")
+        if not threads:
+            params = self.env["ir.config_parameter"].sudo()
+            threads = params.get_param("o_dory.dpf_threads")
+        return max(int(threads or multiprocessing.cpu_count()), 1)
+
+    # eq is given when this runs in a thread, which must not use the cursor
+    def prepare_dpf_seq(self, target_indices, start, end, eq=None):
+        eq = eq or get_eq(self.get_dpf_threads())
         col_num = end - start
         keys_a, keys_b = eq.keygen(col_num)
         alpha = eq.alpha(keys_a, keys_b)  # necessary according to sycret
@@ -352,6 +568,7 @@ class ClientManager(models.Model):
         # [[a[k] for k in range(j*batch, min(j*batch+batch, len(a)))] for j in range(math.ceil(len(a)/batch))]
         batch_size = 500
         batch_count = math.ceil(col_num / batch_size)
+        eq = get_eq(self.get_dpf_threads())
         with concurrent.futures.ThreadPoolExecutor(max_workers=batch_count) as executor:
             batches = [
                 executor.submit(
@@ -360,6 +577,7 @@ class ClientManager(models.Model):
                     target_indices,
                     i * batch_size,
                     min(i * batch_size + batch_size, col_num),
+                    eq,
                 )
                 for i in range(batch_count)
             ]
@@ -372,9 +590,35 @@ class ClientManager(models.Model):
 
         return x, a, b
 
+    # one point function key per target index,
+    # the servers evaluate x = offset + p for every position p of the bloom filter,
+    # alpha - offset is the target index, so only it evaluates to 1
+    # and the offset alone says nothing about it since alpha is secret
+    # the keys are padded to hash_count with keys targeting no position of the
+    # bloom filter, so the servers do not learn how many distinct positions a
+    # keyword hashes to; padding keys come last (see index_columns)
+    def prepare_dpf_compact(self, target_indices):
+        eq = get_eq(self.get_dpf_threads())
+        width = self.bloom_filter_width
+        targets = list(target_indices) + [
+            random.randrange(width, 2 ** 32)
+            for k in range(self.hash_count - len(target_indices))
+        ]
+        keys_a, keys_b = eq.keygen(len(targets))
+        alpha = eq.alpha(keys_a, keys_b).astype(np.int64)
+        secrets_a, secrets_b = [], []
+        for k, i in enumerate(targets):
+            offset = int(alpha[k] - i) % 2 ** 32
+            secrets_a.append({"offset": offset, "key": keys_a[k].tolist()})
+            secrets_b.append({"offset": offset, "key": keys_b[k].tolist()})
+        return secrets_a, secrets_b
+
+    @tracing.timed("prepare_dpf")
     def prepare_dpf(self, target_indices):
         # self.verify_bitmap_consistency()
         self.ensure_one()
+        if self.dpf_key_format == "compact":
+            return self.prepare_dpf_compact(target_indices)
         x, a, b = [], [], []
         if self.async_enabled:
             x, a, b = self.prepare_dpf_async(target_indices, self.bloom_filter_width)
@@ -382,9 +626,98 @@ class ClientManager(models.Model):
             x, a, b = self.prepare_dpf_seq(target_indices, 0, self.bloom_filter_width)
         return [x, a], [x.copy(), b]
 
+    # one set of dpf secrets per target index, over the whole bloom filter
+    @tracing.timed("prepare_dpf_fold")
+    def prepare_dpf_fold(self, target_indices):
+        self.ensure_one()
+        if self.dpf_key_format == "compact":
+            # compact secrets already come as one key per index
+            return self.prepare_dpf_compact(target_indices)
+        params_a, params_b = [], []
+        for i in target_indices:
+            secrets_a, secrets_b = self.prepare_dpf([i])
+            params_a.append(secrets_a)
+            params_b.append(secrets_b)
+        return params_a, params_b
+
+    # the result columns of the indices, matrix results hold one column per
+    # bloom filter position, folded ones one per key, the padding keys last
+    # (see prepare_dpf_compact)
+    def index_columns(self, results, indices, fold):
+        if fold:
+            return results[: len(indices)]
+        return [col for (i, col) in enumerate(results) if i in indices]
+
+    # combine the results of the two servers
+    @tracing.timed("combine")
+    def combine_search_results(self, rs_a, rs_b):
+        results = []
+        for i, ra in enumerate(rs_a):
+            rb = rs_b[i]
+            res = []
+            for j, r_a in enumerate(ra):
+                r_b = rb[j]
+                res.append(r_a ^ r_b)
+            results.append(res)
+        return results
+
+    # results holds the combined column of each index,
+    # check them against our macs, unmask them
+    # and give the docs having all the indices
+    def unmask_search_results(self, indices, results, row_to_doc, versions, server_macs):
+        self.ensure_one()
+        trace_id = self.env.context.get("o_dory_trace_id")
+        # now we need to check if the returned columns match our macs
+        with tracing.span(trace_id, "mac_check"):
+            for col, i in enumerate(indices):
+                macs = [
+                    self.generate_mac(
+                        results[col][row], i, versions.get(row_to_doc.get(row))
+                    )
+                    for row in range(len(results[col]))
+                ]
+                # print("col macs", macs)
+                m = None
+                for mac in macs:
+                    if m == None:
+                        m = mac
+                    else:
+                        m ^= mac
+                # print("comparing mac", m, server_macs[i])
+                if m != server_macs[i]:
+                    raise ValidationError(
+                        _("MACs don't match. Server could be corrupted.")
+                    )
+
+        # print("row to doc ", row_to_doc)
+        # print("versions ", versions)
+        # i is row
+        rows = []
+        with tracing.span(trace_id, "unmask"):
+            for i in range(len(results[0])):
+                version = versions.get(row_to_doc.get(i))
+                mask = self.get_mask_from_doc_version(version)
+                mask = [mask[m] for m in indices]
+                # print("selected mask ", mask)
+                unmasked = [results[k][i] ^ mask[k] for k in range(len(results))]
+                # print("unmasked ", unmasked)
+                if all(unmasked):
+                    rows.append(i)
+
+        # print(rows)
+        docs = []
+        for row in rows:
+            docs.append(row_to_doc.get(row))
+        return docs
+
     # prepare dpf secrets here and send to each partitions
     # should not send all secrets to central server/master
+    @tracing.traced("search")
     def search_keywords(self, keywords):
+        if self.delta_search:
+            return self.search_keywords_delta(keywords)[0]
+        if self.partition_count > 1:
+            return self.search_keywords_partitioned(keywords)[0]
         self.verify_bitmap_consistency()
         if len(self.account_ids) != 2:
             raise ValidationError(_("Need exactly two servers for searching."))
@@ -400,16 +733,29 @@ class ClientManager(models.Model):
 
         # print("keywords: indices ", keywords, indices)
         _logger.warning("Client preparing for dpf")
-        params = self.prepare_dpf(indices)
+        fold = self.search_protocol == "fold"
+        if fold:
+            params = self.prepare_dpf_fold(indices)
+        else:
+            params = self.prepare_dpf(indices)
         _logger.warning("Done preparing for dpf")
         with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
             futures = [
                 executor.submit(
+                    ODoryAccount.search_keywords_fold,
+                    self.account_ids[i],
+                    i,
+                    json.dumps(params[i]),
+                    self.search_engine,
+                )
+                if fold
+                else executor.submit(
                     ODoryAccount.search_keywords,
                     self.account_ids[i],
                     i,
                     json.dumps(params[i]),
                     True if self.async_enabled else False,
+                    self.search_engine,
                 )
                 for i in range(2)
             ]
@@ -417,72 +763,272 @@ class ClientManager(models.Model):
         search_data_a, search_data_b = [f.result() for f in futures]
 
         _logger.warning("Client received search data, ready to assemble...")
-        rs_a, row_to_doc, doc_versions = json.loads(search_data_a)
+        # doc_ids and doc_versions give the doc id and version of each row
+        rs_a, doc_ids, doc_versions = json.loads(search_data_a)
         rs_b, __, __ = json.loads(search_data_b)
-        # print(rs_a)
-        # print(rs_b)
         # combining results
-        results = []
-        for i, ra in enumerate(rs_a):
-            rb = rs_b[i]
-            res = []
-            for j, r_a in enumerate(ra):
-                r_b = rb[j]
-                res.append(r_a ^ r_b)
-            results.append(res)
+        results = self.combine_search_results(rs_a, rs_b)
 
         # conveniently, the only valid columns are the indexed columns
-        results = [col for (i, col) in enumerate(results) if i in indices]
+        results = self.index_columns(results, indices, fold)
 
         # print("filtered results ", results)
-        row_to_doc = {int(k): int(v) for (k, v) in row_to_doc}
+        row_to_doc = dict(enumerate(doc_ids))
 
         # versions
-        versions = {e.get("id"): e.get("version") for e in doc_versions}
-        # now we need to check if the returned columns match our macs
-        for col, i in enumerate(indices):
-            macs = [
-                self.generate_mac(
-                    results[col][row], i, versions.get(row_to_doc.get(row))
+        versions = dict(zip(doc_ids, doc_versions))
+        docs = self.unmask_search_results(
+            indices, results, row_to_doc, versions, server_macs
+        )
+
+        _logger.warning("Done searching keyword")
+        self.verify_bitmap_consistency()
+        # print("----------------- done searching from server", docs)
+        return docs
+
+    # search many keywords with one call per server,
+    # should give one list of docs per keyword
+    @tracing.traced("search_batch")
+    def search_keywords_batch(self, keywords):
+        if self.delta_search:
+            return self.search_keywords_delta(keywords)
+        if self.partition_count > 1:
+            return self.search_keywords_partitioned(keywords)
+        self.verify_bitmap_consistency()
+        if len(self.account_ids) != 2:
+            raise ValidationError(_("Need exactly two servers for searching."))
+
+        server_macs = self.verify_and_retrieve_current_macs()
+        if not keywords or all(not m for m in server_macs):
+            return [[] for keyword in keywords]
+
+        all_indices = [self.compute_word_indices(keyword) for keyword in keywords]
+        fold = self.search_protocol == "fold"
+        params_a, params_b = [], []
+        for indices in all_indices:
+            if fold:
+                secrets_a, secrets_b = self.prepare_dpf_fold(indices)
+            else:
+                secrets_a, secrets_b = self.prepare_dpf(indices)
+            params_a.append(secrets_a)
+            params_b.append(secrets_b)
+
+        params = [params_a, params_b]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            futures = [
+                executor.submit(
+                    ODoryAccount.search_keywords_batch,
+                    self.account_ids[i],
+                    i,
+                    json.dumps(params[i]),
+                    self.search_protocol,
+                    self.search_engine,
                 )
-                for row in range(len(results[col]))
+                for i in range(2)
             ]
-            # print("col macs", macs)
-            m = None
-            for mac in macs:
-                if m == None:
-                    m = mac
-                else:
-                    m ^= mac
-            # print("comparing mac", m, server_macs[i])
-            if m != server_macs[i]:
-                raise ValidationError(_("MACs don't match. Server could be corrupted."))
 
-        # print("row to doc ", row_to_doc)
-        # print("versions ", versions)
-        # i is row
-        rows = []
-        for i in range(len(results[0])):
-            version = versions.get(row_to_doc.get(i))
-            mask = self.get_mask_from_doc_version(version)
-            mask = [mask[m] for m in indices]
-            # print("selected mask ", mask)
-            unmasked = [results[k][i] ^ mask[k] for k in range(len(results))]
-            # print("unmasked ", unmasked)
-            if all(unmasked):
-                rows.append(i)
+        search_data_a, search_data_b = [f.result() for f in futures]
+        all_rs_a, doc_ids, doc_versions = json.loads(search_data_a)
+        all_rs_b, __, __ = json.loads(search_data_b)
+        row_to_doc = dict(enumerate(doc_ids))
+        versions = dict(zip(doc_ids, doc_versions))
+
+        all_docs = []
+        for q, indices in enumerate(all_indices):
+            results = self.combine_search_results(all_rs_a[q], all_rs_b[q])
+            results = self.index_columns(results, indices, fold)
+            all_docs.append(
+                self.unmask_search_results(
+                    indices, results, row_to_doc, versions, server_macs
+                )
+            )
 
-        # print(rows)
-        docs = []
-        for row in rows:
-            docs.append(row_to_doc.get(row))
+        self.verify_bitmap_consistency()
+        return all_docs
+
+    # search many keywords over all the partitions, with one call per server
+    # the same secrets serve every partition, each server evaluates them once
+    # and scans its partitions in parallel, the docs found in each partition
+    # (checked against the macs of that partition) are then merged
+    # should give one list of docs per keyword
+    @tracing.traced("search_partitioned")
+    def search_keywords_partitioned(self, keywords):
+        self.verify_bitmap_consistency()
+        if len(self.account_ids) != 2:
+            raise ValidationError(_("Need exactly two servers for searching."))
+
+        partitions = self.get_partitions()
+        server_macs = [self.verify_and_retrieve_current_macs(p) for p in partitions]
+        if not keywords or all(not m for macs in server_macs for m in macs):
+            return [[] for keyword in keywords]
+
+        all_indices = [self.compute_word_indices(keyword) for keyword in keywords]
+        fold = self.search_protocol == "fold"
+        params_a, params_b = [], []
+        for indices in all_indices:
+            if fold:
+                secrets_a, secrets_b = self.prepare_dpf_fold(indices)
+            else:
+                secrets_a, secrets_b = self.prepare_dpf(indices)
+            params_a.append(secrets_a)
+            params_b.append(secrets_b)
+
+        params = [params_a, params_b]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            futures = [
+                executor.submit(
+                    ODoryAccount.search_keywords_partitions,
+                    self.account_ids[i],
+                    i,
+                    json.dumps(params[i]),
+                    self.search_protocol,
+                    self.search_engine,
+                    len(partitions),
+                )
+                for i in range(2)
+            ]
+
+        search_data_a, search_data_b = [json.loads(f.result()) for f in futures]
+        all_docs = [[] for keyword in keywords]
+        for p in partitions:
+            all_rs_a, doc_ids, doc_versions = search_data_a[p]
+            all_rs_b, __, __ = search_data_b[p]
+            if not doc_ids or all(not m for m in server_macs[p]):
+                continue
+            row_to_doc = dict(enumerate(doc_ids))
+            versions = dict(zip(doc_ids, doc_versions))
+            for q, indices in enumerate(all_indices):
+                results = self.combine_search_results(all_rs_a[q], all_rs_b[q])
+                results = self.index_columns(results, indices, fold)
+                all_docs[q] += self.unmask_search_results(
+                    indices, results, row_to_doc, versions, server_macs[p]
+                )
 
-        _logger.warning("Done searching keyword")
         self.verify_bitmap_consistency()
-        # print("----------------- done searching from server", docs)
+        return all_docs
+
+    # search keywords over the rows written since the previous search of each
+    # keyword only, and merge with the answer kept from that search
+    # the first search of a keyword covers the whole folder, as does one from a
+    # version the servers no longer know the removals after
+    # should give one list of docs per keyword
+    @tracing.traced("search_delta")
+    def search_keywords_delta(self, keywords):
+        self.verify_bitmap_consistency()
+        if len(self.account_ids) != 2:
+            raise ValidationError(_("Need exactly two servers for searching."))
+        if not keywords:
+            return []
+
+        all_indices = [self.compute_word_indices(keyword) for keyword in keywords]
+        fold = self.search_protocol == "fold"
+        params_a, params_b = [], []
+        for indices in all_indices:
+            if fold:
+                secrets_a, secrets_b = self.prepare_dpf_fold(indices)
+            else:
+                secrets_a, secrets_b = self.prepare_dpf(indices)
+            params_a.append(secrets_a)
+            params_b.append(secrets_b)
+        params = [json.dumps(params_a), json.dumps(params_b)]
+
+        all_docs = [[] for keyword in keywords]
+        for partition in self.get_partitions():
+            server_macs = self.verify_and_retrieve_current_macs(partition)
+            keys = [
+                (self.env.cr.dbname, self.id, self.salt, partition, tuple(indices))
+                for indices in all_indices
+            ]
+            answers = [get_delta_answer(key) for key in keys]
+            since = min(a["version"] if a else -1 for a in answers)
+
+            with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+                futures = [
+                    executor.submit(
+                        ODoryAccount.search_keywords_delta,
+                        self.account_ids[i],
+                        i,
+                        params[i],
+                        since,
+                        self.search_protocol,
+                        self.search_engine,
+                        partition,
+                    )
+                    for i in range(2)
+                ]
+            data_a, data_b = [json.loads(f.result()) for f in futures]
+            all_rs_a, doc_ids, doc_versions, inserted, removed = data_a[:5]
+            all_rs_b = data_b[0]
+            if data_a[1:] != data_b[1:]:
+                raise ValidationError(_("bitmaps versions don't match"))
+            since, version = data_a[5:]
+
+            for q, indices in enumerate(all_indices):
+                results = self.combine_search_results(all_rs_a[q], all_rs_b[q])
+                results = self.index_columns(results, indices, fold)
+                answer = self.merge_delta_answer(
+                    indices,
+                    answers[q] if since >= 0 else None,
+                    [results, doc_ids, doc_versions, inserted, removed, version],
+                    server_macs,
+                )
+                set_delta_answer(keys[q], answer)
+                all_docs[q] += self.delta_answer_docs(indices, answer)
+
+        self.verify_bitmap_consistency()
+        return all_docs
+
+    # apply a delta search response to the answer kept for the indices,
+    # response is [results, doc_ids, doc_versions, inserted_versions, removed,
+    # version] (see ResUsers.server_search_delta on the server)
+    # the macs of the indices are updated along with the rows, so the merged
+    # answer is checked against the column macs of the servers as a full one
+    @tracing.timed("merge_delta_answer")
+    def merge_delta_answer(self, indices, answer, response, server_macs):
+        self.ensure_one()
+        results, doc_ids, doc_versions, inserted_versions, removed, version = response
+        if answer is None:
+            since, macs, rows = -1, [0 for i in indices], dict()
+        else:
+            since, macs, rows = (
+                answer["version"],
+                list(answer["macs"]),
+                dict(answer["rows"]),
+            )
+
+        def toggle(doc_version, bits):
+            for (k, i) in enumerate(indices):
+                macs[k] ^= self.generate_mac(bits[k], i, doc_version)
+
+        for (doc_id, removed_version) in removed:
+            if removed_version > since and doc_id in rows:
+                toggle(*rows.pop(doc_id))
+        for (r, doc_id) in enumerate(doc_ids):
+            # a full answer gives no insertion versions
+            if inserted_versions and inserted_versions[r] <= since:
+                continue
+            if doc_id in rows:
+                # the row was rewritten with the document
+                toggle(*rows.pop(doc_id))
+            rows[doc_id] = (doc_versions[r], [col[r] for col in results])
+            toggle(*rows[doc_id])
+
+        if any(macs[k] != server_macs[i] for (k, i) in enumerate(indices)):
+            raise ValidationError(_("MACs don't match. Server could be corrupted."))
+        return {"version": version, "macs": macs, "rows": rows}
+
+    # the docs of the answer having all the indices
+    @tracing.timed("unmask")
+    def delta_answer_docs(self, indices, answer):
+        docs = []
+        for doc_id, (doc_version, bits) in sorted(answer["rows"].items()):
+            mask = self.get_mask_from_doc_version(doc_version)
+            if all(bits[k] ^ mask[i] for (k, i) in enumerate(indices)):
+                docs.append(doc_id)
         return docs
 
     # the naive model will just send the indices to the server
+    @tracing.traced("search_naive")
     def search_keywords_naive(self, keywords):
         self.verify_bitmap_consistency()
         # todo
@@ -530,12 +1076,18 @@ class ODoryAccount(models.Model):
     password = fields.Char(string="O-DORY API Key", required=True)
 
     # misc for client
+    @tracing.timed("connect")
     def connect(self):
         self.ensure_one()
-        # Logging in
+        key = (self.url, self.db, self.account, self.password)
+        # Logging in, once per process and credentials
         try:
-            common = client.ServerProxy("{}/xmlrpc/2/common".format(self.url))
-            uid = common.authenticate(self.db, self.account, self.password, {})
+            uid = _uids.get(key)
+            if not uid:
+                common = client.ServerProxy("{}/xmlrpc/2/common".format(self.url))
+                uid = common.authenticate(self.db, self.account, self.password, {})
+                if uid:
+                    _uids[key] = uid
             # getting models
             models = client.ServerProxy("{}/xmlrpc/2/object".format(self.url))
         except client.Error as err:
@@ -543,21 +1095,156 @@ class ODoryAccount(models.Model):
 
         return uid, models
 
+    # the next connect logs in again (credentials refused by the server)
+    def forget_uid(self):
+        _uids.pop((self.url, self.db, self.account, self.password), None)
+
+    # a method of res.users on the server, along with the trace id of the
+    # operation if any (see tracing.py), the spans of the server are then
+    # added to the trace
+    def execute(self, uid, models, method, args, kwargs=None):
+        kwargs = dict(kwargs or {})
+        trace_id = self.env.context.get("o_dory_trace_id")
+        trace = tracing.get(trace_id) if trace_id else None
+        if trace is not None:
+            kwargs["context"] = {"o_dory_trace_id": trace_id}
+        start = time.monotonic()
+        res = _XMLRPC
+        if self.manager_id.rpc_transport == "binary" and self.url not in _xmlrpc_only:
+            res = self.execute_binary(method, args, kwargs)
+        if res is _XMLRPC:
+            try:
+                res = models.execute_kw(
+                    self.db, uid, self.password, "res.users", method, args, kwargs
+                )
+            except client.Fault:
+                # the cached uid may be stale (account recreated on the server)
+                self.forget_uid()
+                raise
+        if trace is not None and isinstance(res, dict) and "o_dory_trace" in res:
+            source = "{}({})".format(self.url, self.db)
+            trace.record_remote(
+                source, method, start, time.monotonic(), res["o_dory_trace"]
+            )
+            res = res.get("result")
+        return res
+
+    # same as execute over POST /o_dory/rpc/<method> (see frames.py),
+    # should give _XMLRPC when the server does not serve the method that way,
+    # nothing was executed then
+    def execute_binary(self, method, args, kwargs):
+        trace_id = self.env.context.get("o_dory_trace_id")
+        compression = self.manager_id.rpc_compression
+        accept = "" if compression == "none" else compression
+        data = frames.encode({"args": args, "kwargs": kwargs})
+        size, encoding = len(data), None
+        # requests are only compressed once the server said it reads them
+        if accept in _server_encodings.get(self.url, ()):
+            with tracing.span(trace_id, "compress"):
+                data, encoding = frames.compress(data, accept)
+        headers = {
+            "Content-Type": "application/octet-stream",
+            "X-O-Dory-Accept-Encoding": accept,
+        }
+        if encoding:
+            headers["X-O-Dory-Encoding"] = encoding
+        try:
+            resp = requests.post(
+                "{}/o_dory/rpc/{}".format(self.url, method),
+                params={"db": self.db},
+                data=data,
+                auth=(self.account, self.password),
+                headers=headers,
+                # searches may take long, as over xml-rpc
+                timeout=(DOWNLOAD_TIMEOUT, None),
+            )
+        except requests.RequestException as err:
+            raise ValidationError(_("Connection Failed: {}").format(err))
+        self.record_compression(method, "out", encoding, size, len(data))
+        if resp.status_code == 404 and "X-O-Dory-Accept-Encoding" not in resp.headers:
+            # no route at all, an older server
+            _xmlrpc_only.add(self.url)
+            return _XMLRPC
+        accepted = resp.headers.get("X-O-Dory-Accept-Encoding", "")
+        _server_encodings[self.url] = {e.strip() for e in accepted.split(",")}
+        encoding = resp.headers.get("X-O-Dory-Encoding")
+        try:
+            with tracing.span(trace_id, "decompress"):
+                content = frames.decompress(resp.content, encoding, MAX_RPC_SIZE)
+            self.record_compression(
+                method, "in", encoding, len(content), len(resp.content)
+            )
+            body = frames.decode(content)
+        except ValueError:
+            body = {}
+        if resp.status_code == 404:
+            return _XMLRPC
+        if resp.status_code == 401:
+            self.forget_uid()
+            raise ValidationError(_("Connection Failed: unauthorized."))
+        if resp.status_code != 200 or "result" not in body:
+            raise ValidationError(
+                body.get("error") or _("Server error ({})").format(resp.status_code)
+            )
+        return body["result"]
+
+    def record_compression(self, method, direction, encoding, size, wire_size):
+        key = (self.url, method, direction)
+        with _compression_lock:
+            stats = _compression_stats.setdefault(key, [0, 0, 0, 0])
+            stats[0] += 1
+            stats[1] += 1 if encoding else 0
+            stats[2] += size
+            stats[3] += wire_size
+        if encoding:
+            _logger.info(
+                "{} {} {}: {} bytes as {} {} bytes ({:.1f}x)".format(
+                    self.url,
+                    method,
+                    direction,
+                    size,
+                    encoding,
+                    wire_size,
+                    size / max(wire_size, 1),
+                )
+            )
+
+    # the compression of the calls of this process to the server, per method
+    # and direction, with the calls, bytes and bytes on the wire
+    def get_compression_stats(self):
+        self.ensure_one()
+        with _compression_lock:
+            return [
+                {
+                    "method": method,
+                    "direction": direction,
+                    "calls": calls,
+                    "compressed_calls": compressed,
+                    "bytes": size,
+                    "wire_bytes": wire_size,
+                    "ratio": size / max(wire_size, 1),
+                }
+                for (
+                    (url, method, direction),
+                    (calls, compressed, size, wire_size),
+                ) in sorted(_compression_stats.items())
+                if url == self.url
+            ]
+
     # let the account object handle uploading, removing,
     # and updating (removing and uploading)
 
     # get the bitmap version from the server
-    def retrieve_bitmaps_version(self):
+    def retrieve_bitmaps_version(self, partition=0):
         uid, models = self.connect()
         if not uid:
             raise ValidationError(_("Connection Failed."))
-        version = models.execute_kw(
-            self.db,
+        version = self.execute(
             uid,
-            self.password,
-            "res.users",
+            models,
             "get_bitmaps_version",
             [[uid]],
+            {"partition": partition},
         )
         if version != None:
             return version
@@ -570,27 +1257,30 @@ class ODoryAccount(models.Model):
                 )
             )
 
-    def retrieve_doc_count(self):
+    def retrieve_doc_count(self, partition=0):
         uid, models = self.connect()
         if not uid:
             raise ValidationError(_("Connection Failed."))
-        count = models.execute_kw(
-            self.db,
+        count = self.execute(
             uid,
-            self.password,
-            "res.users",
+            models,
             "get_indexed_document_count",
             [[uid]],
+            {"partition": partition},
         )
         return count
 
-    def retrieve_col_macs(self):
+    def retrieve_col_macs(self, partition=0):
         uid, models = self.connect()
         if not uid:
             raise ValidationError(_("Connection Failed."))
 
-        col_macs_json = models.execute_kw(
-            self.db, uid, self.password, "res.users", "retrieve_col_macs", [[uid]]
+        col_macs_json = self.execute(
+            uid,
+            models,
+            "retrieve_col_macs",
+            [[uid]],
+            {"partition": partition},
         )
         # print(col_macs_json)
         if not col_macs_json:
@@ -598,18 +1288,17 @@ class ODoryAccount(models.Model):
         col_macs = json.loads(col_macs_json)
         return col_macs
 
-    def compute_macs_for_doc_ids(self, doc_ids):
+    def compute_macs_for_doc_ids(self, doc_ids, partition=0):
         uid, models = self.connect()
         if not uid:
             raise ValidationError(_("Connection Failed."))
 
-        serialized_bitmaps_doc_versions = models.execute_kw(
-            self.db,
+        serialized_bitmaps_doc_versions = self.execute(
             uid,
-            self.password,
-            "res.users",
+            models,
             "get_bitmaps_doc_versions_by_doc_ids",
             [[uid], doc_ids],
+            {"partition": partition},
         )
         bitmaps_doc_versions = json.loads(serialized_bitmaps_doc_versions)
         macs_lst = [
@@ -626,29 +1315,107 @@ class ODoryAccount(models.Model):
         return macs
 
     # given raw files, we should upload to a partition
-    # (randomly for now as it is out of the scope)
-    # we also should add a row to every partition's bitmaps
-    # (or we can tell the master and let the master to do it)
-    def upload(self, data):
+    # (the client manager picks it, see ClientManager.assign_partitions)
+    def upload(self, data, partition=0):
         uid, models = self.connect()
         if not uid:
             raise ValidationError(_("Connection Failed."))
 
         # todo catch exception
-        res_ids = models.execute_kw(
-            self.db,
+        res_ids = self.execute(
             uid,
-            self.password,
-            "res.users",
+            models,
             "upload_encrypted_files",
             [[uid], data],
+            {"partition": partition},
+        )
+
+        return res_ids
+
+    # same as upload, with the macs of the new rows only (see
+    # ResUsers.append_encrypted_files on the server)
+    def append(self, data, partition=0):
+        uid, models = self.connect()
+        if not uid:
+            raise ValidationError(_("Connection Failed."))
+
+        res_ids = self.execute(
+            uid,
+            models,
+            "append_encrypted_files",
+            [[uid], data],
+            {"partition": partition},
         )
 
         return res_ids
 
+    # same as append, the blobs are sent by chunks to a staging area and
+    # the documents are only created once all of them arrived, an interrupted
+    # upload resumes from the last chunk acknowledged by the server
+    def upload_staged(self, data, partition=0):
+        files, rows, macs = data
+        uid, models = self.connect()
+        if not uid:
+            raise ValidationError(_("Connection Failed."))
+        # the fields hold the files in base64
+        blobs = [base64.b64decode(f) for (f, __) in files]
+        token = self.execute(
+            uid,
+            models,
+            "upload_session_start",
+            [[uid], [len(b) for b in blobs]],
+            {"partition": partition},
+        )
+
+        for attempt in range(UPLOAD_RETRIES):
+            try:
+                self.upload_chunks(uid, models, token, blobs)
+                break
+            except requests.RequestException as err:
+                _logger.warning(
+                    "Upload interrupted ({}), resuming: {}".format(attempt, err)
+                )
+        else:
+            raise ValidationError(_("Upload failed."))
+
+        res_ids = self.execute(
+            uid,
+            models,
+            "upload_session_commit",
+            [[uid], token, [[v for (__, v) in files], rows, macs]],
+        )
+        return res_ids
+
+    # send what the server did not acknowledge yet
+    def upload_chunks(self, uid, models, token, blobs):
+        status = self.execute(
+            uid,
+            models,
+            "upload_session_status",
+            [[uid], token],
+        )
+        url = "{}/o_dory/upload/{}".format(self.url, token)
+        with requests.Session() as session:
+            session.auth = (self.account, self.password)
+            for (index, offset) in enumerate(status["received"]):
+                blob = blobs[index]
+                while offset < len(blob):
+                    resp = session.put(
+                        "{}/{}".format(url, index),
+                        params={"db": self.db, "offset": offset},
+                        data=blob[offset : offset + UPLOAD_CHUNK_SIZE],
+                        timeout=DOWNLOAD_TIMEOUT,
+                    )
+                    # 409: the server has another offset, continue from there
+                    if resp.status_code not in (200, 409):
+                        raise ValidationError(
+                            _("Upload failed ({})").format(resp.status_code)
+                        )
+                    offset = resp.json()["offset"]
+
     # given document ids, we should remove the file from the server
     # the corresponding bitmaps row also need to be removed
-    def remove(self, data):
+    def remove(self, data, partition=0):
         if not data:
             return False
 
@@ -656,19 +1423,18 @@ class ODoryAccount(models.Model):
         if not uid:
             raise ValidationError(_("Connection Failed."))
 
-        res = models.execute_kw(
-            self.db,
+        res = self.execute(
             uid,
-            self.password,
-            "res.users",
+            models,
             "remove_encrypted_files_by_ids",
             [[uid], data],
+            {"partition": partition},
         )
 
         return res
 
     # updating old file with the new raw file
-    def update(self, data):
+    def update(self, data, partition=0):
         fids, encrypted_files, rows, new_macs = data
         if not fids or not (len(fids) == len(encrypted_files) == len(rows)):
             return False
@@ -677,13 +1443,12 @@ class ODoryAccount(models.Model):
         if not uid:
             raise ValidationError(_("Connection Failed."))
 
-        res = models.execute_kw(
-            self.db,
+        res = self.execute(
             uid,
-            self.password,
-            "res.users",
+            models,
             "update_files_by_ids",
             [[uid], data],
+            {"partition": partition},
         )
         return res
 
@@ -692,11 +1457,9 @@ class ODoryAccount(models.Model):
         if not uid:
             raise ValidationError(_("Connection Failed."))
 
-        ids = models.execute_kw(
-            self.db,
+        ids = self.execute(
             uid,
-            self.password,
-            "res.users",
+            models,
             "retrieve_doc_ids",
             [[uid]],
         )
@@ -704,34 +1467,82 @@ class ODoryAccount(models.Model):
         return ids
 
     # retrieve documents by ids
-    def retrieve_files(self, fids):  # a list of fid
-        uid, models = self.connect()
-        if not uid:
-            raise ValidationError(_("Connection Failed."))
-
-        encrypted_documents = models.execute_kw(
-            self.db,
-            uid,
-            self.password,
-            "res.users",
-            "retrieve_encrypted_files_by_ids",
-            [[uid], fids],
+    # the blobs are streamed from /o_dory/blobs (see the server controllers)
+    # into a .part file, an interrupted download resumes where it stopped
+    # the frames are then split into one file per document in directory
+    def retrieve_files(self, fids, directory=None):  # a list of fid
+        self.ensure_one()
+        directory = directory or os.path.join(
+            tools.config["data_dir"], "o_dory_downloads", self.db
         )
+        os.makedirs(directory, exist_ok=True)
+        key = hashlib.sha256(
+            "{}|{}|{}".format(self.url, self.account, fids).encode()
+        ).hexdigest()[:16]
+        part_path = os.path.join(directory, "{}.part".format(key))
+        etag_path = part_path + ".etag"
+
+        headers = {}
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if offset and os.path.exists(etag_path):
+            with open(etag_path) as f:
+                headers["Range"] = "bytes={}-".format(offset)
+                headers["If-Range"] = f.read()
 
-        # todo, the following should be done from the manager
-        # res = [self.decrypt(e) for e in encrypted_documents]
-        # should do the auto download thing
-        return res
+        try:
+            with requests.get(
+                "{}/o_dory/blobs".format(self.url),
+                params={"db": self.db, "ids": ",".join(str(fid) for fid in fids)},
+                auth=(self.account, self.password),
+                headers=headers,
+                stream=True,
+                timeout=DOWNLOAD_TIMEOUT,
+            ) as resp:
+                # 416: the previous attempt already got the whole body
+                if resp.status_code not in (200, 206, 416):
+                    raise ValidationError(
+                        _("retrieve files failed ({})").format(resp.status_code)
+                    )
+                if resp.status_code != 416:
+                    with open(etag_path, "w") as f:
+                        f.write(resp.headers.get("ETag", ""))
+                    # 200 when the documents changed since the previous attempt
+                    mode = "ab" if resp.status_code == 206 else "wb"
+                    with open(part_path, mode) as f:
+                        for chunk in resp.iter_content(DOWNLOAD_CHUNK_SIZE):
+                            f.write(chunk)
+        except requests.RequestException as err:
+            _logger.warning("Download interrupted, it will resume: {}".format(err))
+            raise ValidationError(_("retrieve files failed"))
+
+        paths = dict()
+        with open(part_path, "rb") as f:
+            header = f.read(FRAME_HEADER.size)
+            while header:
+                doc_id, size = FRAME_HEADER.unpack(header)
+                path = os.path.join(directory, str(doc_id))
+                with open(path, "wb") as out:
+                    remaining = size
+                    while remaining > 0:
+                        chunk = f.read(min(DOWNLOAD_CHUNK_SIZE, remaining))
+                        if not chunk:
+                            raise ValidationError(_("retrieve files failed"))
+                        out.write(chunk)
+                        remaining -= len(chunk)
+                paths[doc_id] = path
+                header = f.read(FRAME_HEADER.size)
+        os.unlink(part_path)
+        if os.path.exists(etag_path):
+            os.unlink(etag_path)
+        return paths
 
     def search_keywords_indices(self, indices):
         uid, models = self.connect()
         if not uid:
             raise ValidationError(_("Connection Failed."))
-        res_ids = models.execute_kw(
-            self.db,
+        res_ids = self.execute(
             uid,
-            self.password,
-            "res.users",
+            models,
             "search_documents_by_keyword_indices",
             [[uid], indices],
         )
@@ -740,17 +1551,79 @@ class ODoryAccount(models.Model):
 
     # prepare dpf secrets here and send to each partitions
     # should not send all secrets to central server/master
-    def search_keywords(self, y, secrets, async_enabled=False):
+    # secrets are either compact keys (see ClientManager.prepare_dpf_compact)
+    # or one key per bloom filter column
+    def search_keywords(self, y, secrets, async_enabled=False, engine=None):
         uid, models = self.connect()
         if not uid:
             raise ValidationError(_("Connection Failed."))
-        res_ids = models.execute_kw(
-            self.db,
+        res_ids = self.execute(
             uid,
-            self.password,
-            "res.users",
+            models,
             "server_search",
-            [[uid], y, secrets, async_enabled],
+            [[uid], y, secrets, async_enabled, engine],
+        )
+
+        return res_ids
+
+
+    # one dpf key set per queried index, the server folds the columns
+    def search_keywords_fold(self, y, secrets, engine=None):
+        uid, models = self.connect()
+        if not uid:
+            raise ValidationError(_("Connection Failed."))
+        res_ids = self.execute(
+            uid,
+            models,
+            "server_search_fold",
+            [[uid], y, secrets, engine],
+        )
+
+        return res_ids
+
+    # many searches in one call, secrets_list holds the secrets of each query
+    def search_keywords_batch(self, y, secrets_list, protocol="fold", engine=None):
+        uid, models = self.connect()
+        if not uid:
+            raise ValidationError(_("Connection Failed."))
+        res_ids = self.execute(
+            uid,
+            models,
+            "server_search_batch",
+            [[uid], y, secrets_list, protocol, engine],
+        )
+
+        return res_ids
+
+    # same as search_keywords_batch, over the rows written after since_version
+    def search_keywords_delta(
+        self, y, secrets_list, since_version, protocol="fold", engine=None, partition=0
+    ):
+        uid, models = self.connect()
+        if not uid:
+            raise ValidationError(_("Connection Failed."))
+        res_ids = self.execute(
+            uid,
+            models,
+            "server_search_delta",
+            [[uid], y, secrets_list, since_version, protocol, engine, partition],
+        )
+
+        return res_ids
+
+    # same as search_keywords_batch over the first partition_count partitions,
+    # the server answers [results, doc_ids, doc_versions] per partition
+    def search_keywords_partitions(
+        self, y, secrets_list, protocol="fold", engine=None, partition_count=1
+    ):
+        uid, models = self.connect()
+        if not uid:
+            raise ValidationError(_("Connection Failed."))
+        res_ids = self.execute(
+            uid,
+            models,
+            "server_search_partitions",
+            [[uid], y, secrets_list, protocol, engine, partition_count],
         )
 
         return res_ids
@@ -770,3 +1643,5 @@ class DocumentRecord(models.Model):
         required=True,
         readonly=True,
     )
+    # the server folder partition holding the document
+    partition = fields.Integer("Partition", default=0, readonly=True)
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+# one breakdown of the time of an operation (search, upload, ...) across the
+# client and both servers
+#
+# the trace id is passed in the context of the client manager, the accounts
+# send it to the servers (see ODoryAccount.execute) which answer their own
+# spans along with the result; server spans are placed inside the span of
+# the rpc, shifted by half of the time not spent on the server (the transfer
+# both ways), so the clocks of the hosts do not need to agree
+#
+# traces are kept by id in this process since the accounts record their
+# spans from threads, the finished ones for a while so that the caller of an
+# operation can show them (see ClientWizard.action_do_search)
+import collections, contextlib, functools, logging, threading, time, uuid
+
+_logger = logging.getLogger(__name__)
+
+# finished traces kept for their callers
+MAX_FINISHED = 100
+
+_traces = dict()
+_finished = collections.OrderedDict()
+_lock = threading.Lock()
+
+
+class Trace(object):
+    def __init__(self, trace_id):
+        self.trace_id = trace_id
+        self.start = time.monotonic()
+        # [source, name, start, duration], milliseconds from the start
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def record(self, source, name, start, duration):
+        with self._lock:
+            self.spans.append([source, name, round(start, 3), round(duration, 3)])
+
+    # spans of a server answer, remote holds [name, start, duration] from the
+    # start of the call on the server, the first span being the whole call
+    def record_remote(self, source, method, start, end, remote):
+        rpc_start = (start - self.start) * 1000
+        rpc_time = (end - start) * 1000
+        self.record(source, "rpc {}".format(method), rpc_start, rpc_time)
+        spans = remote.get("spans") or []
+        server_time = max((span[2] for span in spans), default=0)
+        offset = rpc_start + max(rpc_time - server_time, 0) / 2
+        self.record(source, "transfer", rpc_start, max(rpc_time - server_time, 0))
+        for (name, span_start, duration) in spans:
+            self.record(source, name, offset + span_start, duration)
+
+    # time spent per source and span name, in milliseconds
+    def totals(self):
+        totals = collections.OrderedDict()
+        with self._lock:
+            for (source, name, start, duration) in sorted(
+                self.spans, key=lambda span: span[2]
+            ):
+                key = (source, name)
+                count, total = totals.get(key, (0, 0))
+                totals[key] = (count + 1, total + duration)
+        return totals
+
+    def breakdown(self):
+        lines = ["trace {}".format(self.trace_id)]
+        for ((source, name), (count, total)) in self.totals().items():
+            lines.append(
+                "{:<24} {:<28} {:>10.1f} ms{}".format(
+                    source, name, total, " ({}x)".format(count) if count > 1 else ""
+                )
+            )
+        return "\n".join(lines)
+
+
+def get(trace_id):
+    with _lock:
+        return _traces.get(trace_id)
+
+
+# the finished trace of trace_id, None when the operation did not trace
+def pop_finished(trace_id):
+    with _lock:
+        return _finished.pop(trace_id, None)
+
+
+def new_trace_id():
+    return uuid.uuid4().hex
+
+
+@contextlib.contextmanager
+def span(trace_id, name, source="client"):
+    trace = get(trace_id) if trace_id else None
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        if trace is not None:
+            end = time.monotonic()
+            trace.record(
+                source, name, (start - trace.start) * 1000, (end - start) * 1000
+            )
+
+
+# trace an operation of the client manager, with the trace id of the context
+# or a new one, the breakdown is logged once it is done; methods called while
+# their trace is recorded are spans of it
+def traced(name):
+    def decorate(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            trace_id = self.env.context.get("o_dory_trace_id")
+            if get(trace_id) is not None:
+                with span(trace_id, name):
+                    return method(self, *args, **kwargs)
+            trace_id = trace_id or new_trace_id()
+            trace = Trace(trace_id)
+            with _lock:
+                _traces[trace_id] = trace
+            try:
+                with span(trace_id, name):
+                    return method(
+                        self.with_context(o_dory_trace_id=trace_id), *args, **kwargs
+                    )
+            finally:
+                with _lock:
+                    del _traces[trace_id]
+                    _finished[trace_id] = trace
+                    while len(_finished) > MAX_FINISHED:
+                        _finished.popitem(last=False)
+                _logger.info(trace.breakdown())
+
+        return wrapper
+
+    return decorate
+
+
+# a span of the trace of the context, when there is one
+def timed(name):
+    def decorate(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with span(self.env.context.get("o_dory_trace_id"), name):
+                return method(self, *args, **kwargs)
+
+        return wrapper
+
+    return decorate
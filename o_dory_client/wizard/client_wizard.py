@@ -4,6 +4,8 @@ from odoo import models, fields, api, _
 from odoo.exceptions import ValidationError
 import ujson as json
 
+from ..models import tracing
+
 
 # wizard objects are deleted from the databaase
 # after a short period of time
@@ -32,6 +34,8 @@ class ClientWizard(models.TransientModel):
     _description = "Client Wizard"
 
     data_ids = fields.One2many("client.data.wizard", "wizard_id", string="Data")
+    # time of the last search per step, on the client and each server
+    trace_summary = fields.Text("Time Breakdown", readonly=True)
 
     # explicitly pass in context
     def _default_manager(self):
@@ -67,8 +71,14 @@ class ClientWizard(models.TransientModel):
 
     def action_do_search(self):
         self.ensure_one()
-        for data in self.data_ids:
-            res = self.manager_id.search_keywords([data.search_term])
+        # all the keywords are searched with one call per server
+        trace_id = tracing.new_trace_id()
+        all_res = self.manager_id.with_context(
+            o_dory_trace_id=trace_id
+        ).search_keywords_batch(self.data_ids.mapped("search_term"))
+        trace = tracing.pop_finished(trace_id)
+        self.trace_summary = trace.breakdown() if trace else False
+        for data, res in zip(self.data_ids, all_res):
             # give a list of document ids that contains that keyword
             # data.search_result = "These documents may contain '{}': {}".format(
             data.search_result = "{}".format(res)
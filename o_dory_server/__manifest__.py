@@ -9,7 +9,7 @@ Reproducing Keyword Search and Document Retrieval in Encrypted File-storing Syst
     """,
     "author": "Emmie He",
     "website": "",
-    "version": "0.1",
+    "version": "0.5",
     # any module necessary for this one to work correctly
     "depends": ["web"],
     "data": [
@@ -17,6 +17,7 @@ Reproducing Keyword Search and Document Retrieval in Encrypted File-storing Syst
         "security/ir.model.access.csv",
         # "data/server_database.xml",
         "data/server_folder.xml",
+        "data/ir_cron.xml",
         "views/server_views.xml",
     ],
     "assets": {
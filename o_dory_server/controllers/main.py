@@ -0,0 +1,418 @@
+# -*- coding: utf-8 -*-
+# streaming download of encrypted documents
+#
+#   GET /o_dory/blobs?db=<db>&ids=<id>,<id>,...
+#   Authorization: Basic <account:password>
+#
+# the body is one frame per document, in the order of the ids
+#
+#   frame : doc id (int64) | size (uint64) | blob, little endian
+#
+# blobs are read from the filestore by chunks, so the memory used does not
+# depend on their size; a single Range is served on the whole body, with an
+# ETag over the ids, versions and sizes so that a resumed download can tell
+# (If-Range) when the documents changed in between
+#
+#   PUT /o_dory/upload/<token>/<index>?db=<db>&offset=<bytes already sent>
+#
+# appends a chunk to a blob of a staged upload (see upload_session.py) and
+# answers {"offset": <bytes received>}, 409 when offset is not the number of
+# bytes received, the client then resumes from the offset of the answer
+#
+#   POST /o_dory/rpc/<method>?db=<db>
+#   Authorization: Basic <account:password>
+#
+# the res.users methods the client calls over xml-rpc, with the arguments
+# and the answer as length prefixed frames (see models/frames.py), the body
+# is {"args", "kwargs"} as for execute_kw, the answer {"result"} or, with a
+# 4xx or 5xx status, {"error"}; methods not listed in RPC_METHODS answer 404
+# so that the client falls back to xml-rpc
+#
+# bodies may be compressed (X-O-Dory-Encoding: zlib or lzma), the encodings
+# a side reads are sent in X-O-Dory-Accept-Encoding with every request and
+# answer, the answer is compressed with the first one of the request the
+# server supports
+#
+#   GET /o_dory/snapshot?db=<db>&partition=<n>[&login=<login>]
+#   PUT /o_dory/snapshot?db=<db>&partition=<n>[&login=<login>]
+#   Authorization: Basic <account:password>
+#
+# export or import the folder of a partition as one binary snapshot (see
+# models/snapshot.py), the folder of the account or, for administrators, the
+# one of the user with that login; an import needs an empty folder and
+# answers {"doc_ids"}, or {"error"} with a 4xx status
+#
+#   GET /o_dory/metrics
+#   Authorization: Bearer <o_dory_metrics_token>
+#
+# the metrics of all the workers in the prometheus text format (see
+# models/metrics.py), without o_dory_metrics_token in the odoo configuration
+# only requests from the host itself are answered
+import hashlib, hmac, logging, struct, threading, time
+
+import ujson as json
+
+import odoo
+from odoo import api, http, tools
+from odoo.exceptions import AccessDenied, AccessError, UserError, ValidationError
+from odoo.service import model as service_model
+from odoo.http import request
+from werkzeug.wrappers import Response
+
+from ..models import frames, metrics
+
+_logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+FRAME_HEADER = struct.Struct("<qQ")
+MAX_UPLOAD_CHUNK_SIZE = 16 * 1024 * 1024
+MAX_RPC_SIZE = 512 * 1024 * 1024
+AUTH_CACHE_TTL = 60
+
+# (db, login, sha256 of the password) -> (uid, expiry)
+_auth_cache = dict()
+_auth_lock = threading.Lock()
+
+# res.users methods served by /o_dory/rpc
+RPC_METHODS = {
+    "get_bitmaps_version",
+    "get_indexed_document_count",
+    "get_bitmaps_doc_versions_by_doc_ids",
+    "get_search_queue_depth",
+    "retrieve_col_macs",
+    "retrieve_doc_ids",
+    "retrieve_doc_versions",
+    "retrieve_doc_ids_versions",
+    "upload_encrypted_files",
+    "append_encrypted_files",
+    "upload_session_start",
+    "upload_session_status",
+    "upload_session_commit",
+    "remove_encrypted_files_by_ids",
+    "update_files_by_ids",
+    "search_documents_by_keyword_indices",
+    "server_search",
+    "server_search_fold",
+    "server_search_batch",
+    "server_search_delta",
+    "server_search_partitions",
+}
+
+
+class BlobStream(object):
+    """Framed blobs of several documents, read lazily by range."""
+
+    def __init__(self, sources):
+        # source is the path of a file or the bytes of the blob
+        self.segments = []
+        digest = hashlib.sha256()
+        for (doc_id, version, size, source) in sources:
+            self.segments.append((FRAME_HEADER.size, FRAME_HEADER.pack(doc_id, size)))
+            self.segments.append((size, source))
+            digest.update("{}:{}:{}\n".format(doc_id, version, size).encode())
+        self.size = sum(size for (size, __) in self.segments)
+        self.etag = digest.hexdigest()
+
+    # the bytes of [start, end)
+    def iter_range(self, start, end):
+        pos = 0
+        for (size, source) in self.segments:
+            seg_start, pos = pos, pos + size
+            if pos <= start or seg_start >= end:
+                continue
+            lo, hi = max(start, seg_start) - seg_start, min(end, pos) - seg_start
+            if isinstance(source, bytes):
+                yield source[lo:hi]
+                continue
+            with open(source, "rb") as f:
+                f.seek(lo)
+                remaining = hi - lo
+                while remaining > 0:
+                    chunk = f.read(min(CHUNK_SIZE, remaining))
+                    if not chunk:
+                        raise IOError("Truncated blob {}".format(source))
+                    remaining -= len(chunk)
+                    yield chunk
+
+
+# a successful basic auth is reused for AUTH_CACHE_TTL seconds, checking the
+# password is slow on purpose and logs the user in (a res_users_log row)
+def authenticate(db):
+    auth = request.httprequest.authorization
+    if not auth or not db or db not in http.db_filter([db]):
+        return None
+    password = auth.password or ""
+    key = (db, auth.username, hashlib.sha256(password.encode()).hexdigest())
+    now = time.monotonic()
+    with _auth_lock:
+        uid, expiry = _auth_cache.get(key, (None, 0))
+    if uid and now < expiry:
+        return uid
+    try:
+        uid = odoo.registry(db)["res.users"].authenticate(
+            db, auth.username, password, {"interactive": False}
+        )
+    except AccessDenied:
+        return None
+    with _auth_lock:
+        for k in [k for (k, (__, e)) in _auth_cache.items() if e <= now]:
+            del _auth_cache[k]
+        _auth_cache[key] = (uid, now + AUTH_CACHE_TTL)
+    return uid
+
+
+def unauthorized():
+    return Response(
+        "Unauthorized",
+        status=401,
+        headers=[("WWW-Authenticate", 'Basic realm="O-DORY"')],
+    )
+
+
+# accept is the X-O-Dory-Accept-Encoding of the request
+def frames_response(value, status=200, accept=None):
+    data = frames.encode(value)
+    size = len(data)
+    data, encoding = frames.compress(data, frames.choose(accept))
+    headers = [("X-O-Dory-Accept-Encoding", ", ".join(frames.ENCODINGS))]
+    if encoding:
+        headers.append(("X-O-Dory-Encoding", encoding))
+        metrics.compression("out", encoding, size, len(data))
+    metrics.payload("rpc", "out", len(data))
+    return Response(
+        data,
+        status=status,
+        headers=headers,
+        content_type="application/octet-stream",
+    )
+
+
+class ODoryController(http.Controller):
+    @http.route("/o_dory/blobs", type="http", auth="none", methods=["GET"], csrf=False)
+    def download_blobs(self, db=None, ids="", **kw):
+        uid = authenticate(db)
+        if not uid:
+            return unauthorized()
+        try:
+            fids = [int(i) for i in ids.split(",") if i]
+        except ValueError:
+            return Response("Bad Request", status=400)
+
+        # only the file paths are read in the transaction,
+        # the cursor is released before streaming
+        with odoo.registry(db).cursor() as cr:
+            env = api.Environment(cr, uid, {})
+            stream = BlobStream(env["res.users"].browse(uid).retrieve_blob_sources(fids))
+
+        headers = [
+            ("Content-Type", "application/octet-stream"),
+            ("Accept-Ranges", "bytes"),
+            ("ETag", '"{}"'.format(stream.etag)),
+        ]
+        status, start, end = 200, 0, stream.size
+        httprequest = request.httprequest
+        if_range = httprequest.if_range
+        if httprequest.range and (not if_range.etag or if_range.etag == stream.etag):
+            byte_range = httprequest.range.range_for_length(stream.size)
+            if byte_range is None:
+                return Response(
+                    status=416,
+                    headers=headers
+                    + [("Content-Range", "bytes */{}".format(stream.size))],
+                )
+            status, (start, end) = 206, byte_range
+            headers.append(
+                ("Content-Range", "bytes {}-{}/{}".format(start, end - 1, stream.size))
+            )
+        headers.append(("Content-Length", str(end - start)))
+        metrics.payload("download", "out", end - start)
+        _logger.info(
+            "User {} downloads {} bytes of {} documents".format(
+                uid, end - start, len(fids)
+            )
+        )
+        return Response(
+            stream.iter_range(start, end),
+            status=status,
+            headers=headers,
+            direct_passthrough=True,
+        )
+
+    @http.route(
+        "/o_dory/upload/<string:token>/<int:index>",
+        type="http",
+        auth="none",
+        methods=["PUT"],
+        csrf=False,
+    )
+    def upload_chunk(self, token, index, db=None, offset="0", **kw):
+        uid = authenticate(db)
+        if not uid:
+            return unauthorized()
+        httprequest = request.httprequest
+        if (httprequest.content_length or 0) > MAX_UPLOAD_CHUNK_SIZE:
+            return Response("Chunk Too Large", status=413)
+        try:
+            offset = int(offset)
+        except ValueError:
+            return Response("Bad Request", status=400)
+        data = httprequest.get_data()
+        metrics.payload("upload_chunk", "in", len(data))
+
+        with odoo.registry(db).cursor() as cr:
+            env = api.Environment(cr, uid, {})
+            try:
+                session = env["res.users"].browse(uid).get_upload_session(token)
+                received = session.write_chunk(index, offset, data)
+            except ValidationError as err:
+                return Response(str(err), status=400)
+
+        status = 200 if received == offset + len(data) else 409
+        return Response(
+            json.dumps({"offset": received}),
+            status=status,
+            content_type="application/json",
+        )
+
+    @http.route(
+        "/o_dory/rpc/<string:method>",
+        type="http",
+        auth="none",
+        methods=["POST"],
+        csrf=False,
+    )
+    def rpc(self, method, db=None, **kw):
+        uid = authenticate(db)
+        if not uid:
+            return unauthorized()
+        httprequest = request.httprequest
+        accept = httprequest.headers.get("X-O-Dory-Accept-Encoding")
+        if method not in RPC_METHODS:
+            return frames_response({"error": "Unknown method"}, 404, accept)
+        if (httprequest.content_length or 0) > MAX_RPC_SIZE:
+            return frames_response({"error": "Request Too Large"}, 413, accept)
+        data = httprequest.get_data()
+        metrics.payload("rpc", "in", len(data))
+        encoding = httprequest.headers.get("X-O-Dory-Encoding")
+        try:
+            body = frames.decompress(data, encoding, MAX_RPC_SIZE)
+            if encoding:
+                metrics.compression("in", encoding, len(body), len(data))
+            body = frames.decode(body)
+            args, kwargs = list(body["args"]), dict(body.get("kwargs") or {})
+        except (KeyError, TypeError, ValueError):
+            return frames_response({"error": "Bad Request"}, 400, accept)
+        # the records are always the authenticated user
+        args[:1] = [[uid]]
+
+        # the same path as execute_kw over xml-rpc (see service.model.dispatch):
+        # registry and cache invalidations of other workers, cursor, retries on
+        # serialization failures, context from kwargs
+        threading.current_thread().uid = uid
+        try:
+            registry = odoo.registry(db).check_signaling()
+            with registry.manage_changes():
+                result = service_model.execute_kw(
+                    db, uid, "res.users", method, args, kwargs
+                )
+        except (UserError, AccessDenied) as err:
+            return frames_response({"error": str(err)}, 400, accept)
+        except Exception:
+            _logger.exception("O-DORY rpc {} failed".format(method))
+            return frames_response({"error": "Internal Server Error"}, 500, accept)
+        return frames_response({"result": result}, 200, accept)
+
+    @http.route(
+        "/o_dory/snapshot", type="http", auth="none", methods=["GET"], csrf=False
+    )
+    def export_snapshot(self, db=None, partition="0", login=None, **kw):
+        uid = authenticate(db)
+        if not uid:
+            return unauthorized()
+        try:
+            partition = int(partition)
+        except ValueError:
+            return Response("Bad Request", status=400)
+
+        # as for the blobs, the cursor is released before streaming
+        with metrics.operation("snapshot_export"):
+            with odoo.registry(db).cursor() as cr:
+                env = api.Environment(cr, uid, {})
+                try:
+                    folder_id = env["res.users"].browse(uid).get_snapshot_folder(
+                        partition, login
+                    )
+                    chunks = folder_id.snapshot_export()
+                except AccessError as err:
+                    return Response(str(err), status=403)
+                except ValidationError as err:
+                    return Response(str(err), status=400)
+                name = "o_dory-{}-{}-{}.snapshot".format(
+                    folder_id.user_id.login, partition, folder_id.bitmap_version
+                )
+        _logger.info("User {} exports folder {}".format(uid, folder_id.id))
+        return Response(
+            chunks,
+            headers=[
+                ("Content-Type", "application/octet-stream"),
+                ("Content-Disposition", 'attachment; filename="{}"'.format(name)),
+            ],
+            direct_passthrough=True,
+        )
+
+    @http.route(
+        "/o_dory/snapshot", type="http", auth="none", methods=["PUT"], csrf=False
+    )
+    def import_snapshot(self, db=None, partition="0", login=None, **kw):
+        uid = authenticate(db)
+        if not uid:
+            return unauthorized()
+        try:
+            partition = int(partition)
+        except ValueError:
+            return Response("Bad Request", status=400)
+        httprequest = request.httprequest
+        metrics.payload("snapshot", "in", httprequest.content_length or 0)
+
+        # the body is read as a stream, blobs go to the staging directory
+        with odoo.registry(db).cursor() as cr:
+            env = api.Environment(cr, uid, {})
+            try:
+                folder_id = env["res.users"].browse(uid).get_snapshot_folder(
+                    partition, login, create=True
+                )
+                doc_ids = folder_id.snapshot_import(httprequest.stream)
+            except AccessError as err:
+                cr.rollback()
+                return Response(
+                    json.dumps({"error": str(err)}),
+                    status=403,
+                    content_type="application/json",
+                )
+            except ValidationError as err:
+                cr.rollback()
+                return Response(
+                    json.dumps({"error": str(err)}),
+                    status=400,
+                    content_type="application/json",
+                )
+        return Response(
+            json.dumps({"doc_ids": doc_ids}), content_type="application/json"
+        )
+
+    @http.route(
+        "/o_dory/metrics", type="http", auth="none", methods=["GET"], csrf=False
+    )
+    def serve_metrics(self, **kw):
+        httprequest = request.httprequest
+        token = tools.config.get("o_dory_metrics_token")
+        if token:
+            given = httprequest.headers.get("Authorization", "").encode()
+            if not hmac.compare_digest(given, "Bearer {}".format(token).encode()):
+                return Response("Unauthorized", status=401)
+        elif httprequest.remote_addr not in ("127.0.0.1", "::1"):
+            return Response("Forbidden", status=403)
+        return Response(
+            metrics.get_registry().render(),
+            content_type="text/plain; version=0.0.4; charset=utf-8",
+        )
@@ -0,0 +1,8 @@
+# -*- coding: utf-8 -*-
+from odoo import api, SUPERUSER_ID
+
+
+# 0.2 stores the folder bitmaps packed instead of json
+def migrate(cr, version):
+    env = api.Environment(cr, SUPERUSER_ID, {})
+    env["server.folder"].search([]).bitmaps_migrate()
@@ -0,0 +1,8 @@
+# -*- coding: utf-8 -*-
+from odoo import api, SUPERUSER_ID
+
+
+# 0.3 keeps one bitmap row per document instead of a folder blob
+def migrate(cr, version):
+    env = api.Environment(cr, SUPERUSER_ID, {})
+    env["server.folder"].search([("bitmaps", "!=", False)]).bitmaps_migrate()
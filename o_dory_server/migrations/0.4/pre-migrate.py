@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+
+
+# 0.4 stores the owner of encrypted documents,
+# fill the column in one statement instead of a recompute per record
+def migrate(cr, version):
+    cr.execute(
+        "ALTER TABLE encrypted_document ADD COLUMN IF NOT EXISTS user_id integer"
+    )
+    cr.execute(
+        """
+        UPDATE encrypted_document d
+           SET user_id = f.user_id
+          FROM server_folder f
+         WHERE f.id = d.folder_id
+        """
+    )
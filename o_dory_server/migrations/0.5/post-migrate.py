@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+
+
+# 0.5 tags bitmap rows with the version they were written at,
+# the existing rows are taken as written at the current version of their
+# folder, and delta searches from older versions give full answers
+def migrate(cr, version):
+    cr.execute(
+        """
+        UPDATE server_bitmap_row r
+           SET inserted_version = f.bitmap_version
+          FROM server_folder f
+         WHERE f.id = r.folder_id AND r.inserted_version IS NULL
+        """
+    )
+    cr.execute("UPDATE server_folder SET delta_floor = COALESCE(bitmap_version, 0)")
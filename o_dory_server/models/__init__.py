@@ -1,3 +1,4 @@
 # -*- coding: utf-8 -*-
 from . import server
 from . import res_users
+from . import upload_session
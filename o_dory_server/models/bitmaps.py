@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+# packed bitmaps of a server folder
+#
+# the legacy layout was a json dict of doc_id -> [0, 1, 0, ...],
+# the packed layout (format version 1) is
+#
+#   header  : magic | format version | reserved | width | row count
+#   row ids : row count * int64 (little endian), the encrypted.document ids
+#   rows    : row count * ceil(width / 8) bytes, one np.packbits row per doc
+#
+# this module does not depend on odoo so it can be used by scripts as well
+import struct
+
+import numpy as np
+import ujson as json
+
+MAGIC = b"ODBM"
+FORMAT_VERSION = 1
+HEADER = struct.Struct("<4sHHII")
+
+
+def row_size(width):
+    return (width + 7) // 8
+
+
+def pack_rows(rows, width):
+    # rows is a list of [0, 1, 0, ...], should give a (len(rows), row_size) array
+    if not len(rows):
+        return np.zeros((0, row_size(width)), dtype=np.uint8)
+    bits = np.asarray(rows, dtype=np.uint8)
+    if bits.ndim != 2 or bits.shape[1] != width:
+        raise ValueError("Expected rows of width {}.".format(width))
+    return np.packbits(bits, axis=1)
+
+
+def unpack_rows(packed, width):
+    return np.unpackbits(packed, axis=1, count=width)
+
+
+class PackedBitmaps(object):
+    """Bitmap rows of a folder, one packed row per encrypted document.
+
+    Rows keep their insertion order, same as the legacy json dict.
+    """
+
+    def __init__(self, width=0, doc_ids=None, rows=None):
+        self.width = width
+        self.doc_ids = (
+            np.asarray(doc_ids, dtype=np.int64)
+            if doc_ids is not None
+            else np.zeros(0, dtype=np.int64)
+        )
+        self.rows = (
+            rows
+            if rows is not None
+            else np.zeros((0, row_size(width)), dtype=np.uint8)
+        )
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    @staticmethod
+    def is_packed(blob):
+        # legacy json bitmaps may also be given as str
+        return isinstance(blob, (bytes, memoryview)) and bytes(blob[:4]) == MAGIC
+
+    @staticmethod
+    def peek_count(blob):
+        # the row count can be read without unpacking anything
+        __, __, __, __, count = HEADER.unpack_from(blob)
+        return count
+
+    @classmethod
+    def from_bytes(cls, blob):
+        magic, version, __, width, count = HEADER.unpack_from(blob)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError("Unsupported bitmaps format {}.".format(version))
+        offset = HEADER.size
+        doc_ids = np.frombuffer(blob, dtype="<i8", count=count, offset=offset)
+        offset += doc_ids.nbytes
+        rows = np.frombuffer(
+            blob, dtype=np.uint8, count=count * row_size(width), offset=offset
+        ).reshape(count, row_size(width))
+        # frombuffer gives read only views, copy so rows can be patched in place
+        return cls(width, doc_ids.astype(np.int64), rows.copy())
+
+    @classmethod
+    def from_packed_rows(cls, width, doc_ids, packed_rows):
+        # packed_rows is a list of bytes, one np.packbits row per doc
+        rows = np.frombuffer(b"".join(packed_rows), dtype=np.uint8)
+        rows = rows.reshape(len(doc_ids), row_size(width)).copy()
+        return cls(width, doc_ids, rows)
+
+    @classmethod
+    def from_legacy(cls, bitmaps_obj):
+        items = list(bitmaps_obj.items())
+        if not items:
+            return cls()
+        width = len(items[0][1])
+        doc_ids = [int(doc_id) for (doc_id, __) in items]
+        return cls(width, doc_ids, pack_rows([row for (__, row) in items], width))
+
+    @classmethod
+    def load(cls, blob):
+        if not blob:
+            return cls()
+        if cls.is_packed(blob):
+            return cls.from_bytes(blob)
+        return cls.from_legacy(json.loads(blob))
+
+    def to_bytes(self):
+        header = HEADER.pack(MAGIC, FORMAT_VERSION, 0, self.width, len(self))
+        return (
+            header
+            + self.doc_ids.astype("<i8").tobytes()
+            + np.ascontiguousarray(self.rows).tobytes()
+        )
+
+    def index_of(self, doc_ids):
+        # map of doc_id -> row index for the given ids that exist
+        positions = {int(d): i for (i, d) in enumerate(self.doc_ids)}
+        return {int(d): positions[int(d)] for d in doc_ids if int(d) in positions}
+
+    def get(self, doc_ids):
+        positions = self.index_of(doc_ids)
+        res = []
+        for doc_id in doc_ids:
+            i = positions.get(int(doc_id))
+            if i is None:
+                res.append(None)
+            else:
+                res.append(unpack_rows(self.rows[i : i + 1], self.width)[0].tolist())
+        return res
+
+    def update(self, doc_ids, rows):
+        if not len(doc_ids):
+            return self
+        if not len(self):
+            # an empty folder takes the width of its first rows
+            self.width = len(rows[0])
+            self.rows = np.zeros((0, row_size(self.width)), dtype=np.uint8)
+        packed = pack_rows(rows, self.width)
+        positions = self.index_of(doc_ids)
+        new_ids, new_rows = [], []
+        for k, doc_id in enumerate(doc_ids):
+            i = positions.get(int(doc_id))
+            if i is None:
+                new_ids.append(int(doc_id))
+                new_rows.append(k)
+            else:
+                self.rows[i] = packed[k]
+        if new_ids:
+            self.doc_ids = np.concatenate(
+                [self.doc_ids, np.asarray(new_ids, dtype=np.int64)]
+            )
+            self.rows = np.concatenate([self.rows, packed[new_rows]])
+        return self
+
+    def remove(self, doc_ids):
+        positions = self.index_of(doc_ids)
+        if positions:
+            keep = np.ones(len(self), dtype=bool)
+            keep[list(positions.values())] = False
+            self.doc_ids = self.doc_ids[keep]
+            self.rows = self.rows[keep]
+        return len(positions) == len(doc_ids)
+
+    # should give a 2d array of columns and a map of row_index to doc_id
+    def flip(self):
+        cols = []
+        if len(self):
+            cols = unpack_rows(self.rows, self.width).T.tolist()
+        row_to_doc = {i: int(doc_id) for (i, doc_id) in enumerate(self.doc_ids)}
+        return cols, row_to_doc
@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+# column-major search store of a server folder
+#
+# searches read the bitmaps column by column, so for each
+# (folder, bitmap_version) we keep a derived file in the data directory
+#
+#   header   : magic | format version | reserved | width | row count | words
+#              | versions size
+#   row ids  : row count * int64 (little endian), the encrypted.document ids
+#   columns  : width * words * uint64, bit r of a column is the bit of row r
+#   versions : (row count + 1) * uint64 offsets, then the utf-8 document
+#              versions in row order, version r is between offsets r and r + 1
+#
+# the file is memory-mapped read only, so every worker of the host shares
+# the same pages, and it is never modified once written:
+# a write bumps the bitmap version, which gets its own file
+#
+# processes that open a store by its path (the search pool) pin it first with
+# a shared flock, eviction leaves pinned files to a later run
+import contextlib, fcntl, glob, os, re, struct, tempfile, threading, time
+
+import numpy as np
+
+from .bitmaps import PackedBitmaps, unpack_rows
+from .search_kernel import unpack_columns
+
+MAGIC = b"ODCS"
+FORMAT_VERSION = 3
+# padded to 32 bytes so the row ids and columns are word aligned
+HEADER = struct.Struct("<4sHHIIIQ4x")
+# rows are transposed by blocks to bound the memory used while building
+BLOCK_ROWS = 4096
+
+_stores = dict()  # (directory, folder id) -> ColumnStore
+_stores_lock = threading.Lock()
+
+
+def words_per_column(row_count):
+    return (row_count + 63) // 64
+
+
+def store_path(directory, folder_id, version):
+    return os.path.join(directory, "folder_{}_v{}.cols".format(folder_id, version))
+
+
+# the columns of the packed rows, (width, words * 8) bytes, bit order little
+def transpose_rows(bitmaps_obj):
+    count, width = len(bitmaps_obj), bitmaps_obj.width
+    columns = np.zeros((width, words_per_column(count) * 8), dtype=np.uint8)
+    for start in range(0, count, BLOCK_ROWS):
+        block = unpack_rows(bitmaps_obj.rows[start : start + BLOCK_ROWS], width)
+        # start is a multiple of 8, so each block fills whole bytes
+        packed = np.packbits(block.T, axis=1, bitorder="little")
+        columns[:, start // 8 : start // 8 + packed.shape[1]] = packed
+    return columns
+
+
+# versions are given by the clients and may hold any character,
+# so they are delimited by offsets rather than by a separator
+def encode_versions(versions):
+    encoded = [(v or "").encode() for v in versions]
+    offsets = np.zeros(len(encoded) + 1, dtype="<u8")
+    np.cumsum([len(v) for v in encoded], out=offsets[1:])
+    return offsets.tobytes() + b"".join(encoded)
+
+
+def decode_versions(blob, count):
+    offsets = np.frombuffer(bytes(blob[: (count + 1) * 8]), dtype="<u8").tolist()
+    data = bytes(blob[(count + 1) * 8 :])
+    return [data[offsets[i] : offsets[i + 1]].decode() for i in range(count)]
+
+
+class ColumnStore(object):
+    """Read only, memory-mapped column-major bitmaps of one folder version."""
+
+    def __init__(self, path, version):
+        self.path = path
+        self.version = version
+        self._mmap = np.memmap(path, dtype=np.uint8, mode="r")
+        magic, fmt, __, width, count, words, versions_size = HEADER.unpack_from(
+            self._mmap
+        )
+        if magic != MAGIC or fmt != FORMAT_VERSION:
+            raise ValueError("Unsupported search store format {}.".format(fmt))
+        self.width = width
+        offset = HEADER.size
+        self.doc_ids = self._mmap[offset : offset + count * 8].view("<i8")
+        offset += count * 8
+        self.words = (
+            self._mmap[offset : offset + width * words * 8]
+            .view("<u8")
+            .reshape(width, words)
+        )
+        offset += width * words * 8
+        self._versions = self._mmap[offset : offset + versions_size]
+        self._response_rows = None
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    # row aligned doc ids and versions, as sent in search responses
+    # decoded once per process and store version
+    def response_rows(self):
+        if self._response_rows is None:
+            self._response_rows = (
+                self.doc_ids.tolist(),
+                decode_versions(self._versions, len(self)),
+            )
+        return self._response_rows
+
+    # versions holds the document version of each row of bitmaps_obj
+    @classmethod
+    def build(cls, path, version, bitmaps_obj, versions):
+        count, width = len(bitmaps_obj), bitmaps_obj.width
+        words = words_per_column(count)
+        columns = transpose_rows(bitmaps_obj)
+
+        # write aside then rename, readers never see a partial file
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        versions = encode_versions(versions)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(
+                    HEADER.pack(
+                        MAGIC, FORMAT_VERSION, 0, width, count, words, len(versions)
+                    )
+                )
+                f.write(bitmaps_obj.doc_ids.astype("<i8").tobytes())
+                f.write(columns.tobytes())
+                f.write(versions)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        return cls(path, version)
+
+    # the columns as a (width, row count) array of 0s and 1s
+    def unpack(self, indices=None):
+        words = self.words if indices is None else self.words[indices]
+        return unpack_columns(words, len(self))
+
+    # same output as ServerFolder.bitmaps_flip
+    def flip(self):
+        cols = self.unpack().tolist() if len(self) else []
+        row_to_doc = {i: int(doc_id) for (i, doc_id) in enumerate(self.doc_ids)}
+        return cols, row_to_doc
+
+
+class MemoryStore(ColumnStore):
+    """Same as ColumnStore for a few rows, built in memory (delta searches)."""
+
+    def __init__(self, bitmaps_obj, versions):
+        self.path = None
+        self.version = None
+        self.width = bitmaps_obj.width
+        self.doc_ids = np.asarray(bitmaps_obj.doc_ids, dtype="<i8")
+        self.words = transpose_rows(bitmaps_obj).view("<u8")
+        self._versions = encode_versions(versions)
+        self._response_rows = None
+
+
+# the store of a partition that was never written
+def empty():
+    return MemoryStore(PackedBitmaps(), [])
+
+
+# give the store of the folder at the given version, loader is only called
+# to build it when no worker did it yet, and gives the bitmaps and versions
+def open_store(directory, folder_id, version, loader):
+    key = (directory, folder_id)
+    with _stores_lock:
+        store = _stores.get(key)
+        if store is not None and store.version == version:
+            return store
+
+    path = store_path(directory, folder_id, version)
+    try:
+        store = ColumnStore(path, version)
+    except (FileNotFoundError, ValueError):
+        store = ColumnStore.build(path, version, *loader())
+
+    with _stores_lock:
+        _stores[key] = store
+    return store
+
+
+# keep the file of store on disk until the context exits, gives whether it
+# still was, processes opening it by path meanwhile then find it
+@contextlib.contextmanager
+def pinned(store):
+    try:
+        f = open(store.path, "rb")
+    except (FileNotFoundError, TypeError):
+        yield False
+        return
+    with f:
+        fcntl.flock(f, fcntl.LOCK_SH)
+        # it may have been unlinked between the open and the flock
+        yield os.fstat(f.fileno()).st_nlink > 0
+
+
+# remove the files of all other versions of the folder
+# (all of them when keep_version is None), should give the bytes reclaimed
+def evict(directory, folder_id, keep_version=None):
+    with _stores_lock:
+        store = _stores.get((directory, folder_id))
+        if store is not None and store.version != keep_version:
+            del _stores[(directory, folder_id)]
+
+    reclaimed = 0
+    pattern = re.compile(r"folder_{}_v(\d+)\.cols$".format(folder_id))
+    for path in glob.glob(os.path.join(directory, "folder_{}_v*.cols".format(folder_id))):
+        match = pattern.search(path)
+        if match and int(match.group(1)) != keep_version:
+            reclaimed += _unlink(path)
+    return reclaimed
+
+
+# remove the files of folders not in folder_ids, and the temporary files
+# of builds that did not finish within max_age seconds
+def sweep(directory, folder_ids, max_age=3600):
+    reclaimed = 0
+    pattern = re.compile(r"folder_(\d+)_v\d+\.cols$")
+    for path in glob.glob(os.path.join(directory, "folder_*_v*.cols")):
+        match = pattern.search(path)
+        if match and int(match.group(1)) not in folder_ids:
+            reclaimed += _unlink(path)
+    for path in glob.glob(os.path.join(directory, "*.tmp")):
+        try:
+            if time.time() - os.path.getmtime(path) > max_age:
+                reclaimed += _unlink(path)
+        except FileNotFoundError:
+            pass
+    return reclaimed
+
+
+def _unlink(path):
+    try:
+        with open(path, "rb") as f:
+            # files pinned by a running search are left for a later eviction
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return 0
+            size = os.fstat(f.fileno()).st_size
+            # workers still mapping it keep their pages until they reopen
+            os.unlink(path)
+    except FileNotFoundError:
+        return 0
+    return size
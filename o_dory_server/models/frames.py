@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+# length prefixed frames of the binary rpc (POST /o_dory/rpc/<method>)
+#
+#   body  : frame | frame | ...
+#   frame : size (uint32, little endian) | bytes
+#
+# the first frame is a json header holding the value, the strings of the
+# value longer than INLINE_SIZE (the json payloads of the searches, the
+# blobs) and the bytes are moved to frames of their own, referred to from
+# the header as {"__frame__": n}, so they are neither escaped nor parsed
+# by the transport
+#
+# a body may also be compressed as a whole, the encodings a side reads are
+# sent along with each request and answer (see the controllers), bodies
+# under COMPRESS_MIN_SIZE or that do not shrink are sent as they are
+#
+# the same file is in o_dory_client/models, keep them in sync
+import lzma, struct, zlib
+
+import ujson as json
+
+FRAME_SIZE = struct.Struct("<I")
+INLINE_SIZE = 1024
+REF = "__frame__"
+
+COMPRESS_MIN_SIZE = 16 * 1024
+# the ones this side reads, in order of preference
+ENCODINGS = ("lzma", "zlib")
+ZLIB_LEVEL = 6
+# higher presets gain little on these payloads and take much longer
+LZMA_PRESET = 3
+
+
+def encode(value):
+    frames = []
+
+    def strip(v):
+        if isinstance(v, str) and len(v) > INLINE_SIZE:
+            frames.append(v.encode())
+            return {REF: len(frames)}
+        if isinstance(v, (bytes, bytearray)):
+            frames.append(bytes(v))
+            return {REF: len(frames), "bytes": True}
+        if isinstance(v, (list, tuple)):
+            return [strip(x) for x in v]
+        if isinstance(v, dict):
+            return {k: strip(x) for (k, x) in v.items()}
+        return v
+
+    header = json.dumps(strip(value)).encode()
+    chunks = []
+    for frame in [header] + frames:
+        chunks.append(FRAME_SIZE.pack(len(frame)))
+        chunks.append(frame)
+    return b"".join(chunks)
+
+
+# ValueError when data is not a whole set of frames
+def decode(data):
+    frames, pos = [], 0
+    view = memoryview(data)
+    while pos < len(data):
+        if pos + FRAME_SIZE.size > len(data):
+            raise ValueError("Truncated frame")
+        (size,) = FRAME_SIZE.unpack_from(data, pos)
+        pos += FRAME_SIZE.size
+        if pos + size > len(data):
+            raise ValueError("Truncated frame")
+        frames.append(view[pos : pos + size])
+        pos += size
+    if not frames:
+        raise ValueError("No frame")
+
+    def restore(v):
+        if isinstance(v, dict):
+            if REF in v:
+                n = v[REF]
+                if not isinstance(n, int) or not 0 < n < len(frames):
+                    raise ValueError("Invalid frame reference")
+                if v.get("bytes"):
+                    return bytes(frames[n])
+                return str(frames[n], "utf-8")
+            return {k: restore(x) for (k, x) in v.items()}
+        if isinstance(v, list):
+            return [restore(x) for x in v]
+        return v
+
+    return restore(json.loads(bytes(frames[0])))
+
+
+# the first of the encodings of header (a comma separated list) this side
+# supports, None if none
+def choose(header):
+    for encoding in (header or "").split(","):
+        if encoding.strip() in ENCODINGS:
+            return encoding.strip()
+    return None
+
+
+# should give data and the encoding it ended up with (None: as it is)
+def compress(data, encoding):
+    if encoding not in ENCODINGS or len(data) < COMPRESS_MIN_SIZE:
+        return data, None
+    if encoding == "zlib":
+        packed = zlib.compress(data, ZLIB_LEVEL)
+    else:
+        packed = lzma.compress(data, preset=LZMA_PRESET)
+    if len(packed) >= len(data):
+        return data, None
+    return packed, encoding
+
+
+# ValueError when data does not decompress to at most max_size bytes
+def decompress(data, encoding, max_size):
+    if not encoding:
+        return data
+    if encoding == "zlib":
+        decompressor = zlib.decompressobj()
+        error = zlib.error
+    elif encoding == "lzma":
+        decompressor = lzma.LZMADecompressor()
+        error = lzma.LZMAError
+    else:
+        raise ValueError("Unknown encoding {}".format(encoding))
+    try:
+        res = decompressor.decompress(data, max_size)
+    except error as err:
+        raise ValueError(str(err))
+    if not decompressor.eof:
+        raise ValueError("Body too large or truncated")
+    return res
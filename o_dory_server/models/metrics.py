@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+# counters and histograms of the o-dory hot paths, served in the prometheus
+# text format by GET /o_dory/metrics (see the controllers)
+#
+# each odoo worker process records its own metrics and writes them every
+# few seconds to <data_dir>/o_dory/metrics/<pid>.json, the route sums the
+# files of all the workers, so a scrape answered by any worker sees them all
+#
+# the files of the workers that exited are merged into retired.json, so the
+# counters keep growing when workers are recycled
+#
+# metrics are recorded from threads that have no cursor (partitioned
+# searches), so nothing here touches the database
+import bisect, contextlib, fcntl, glob, logging, os, threading, time
+
+import ujson as json
+
+from odoo import tools
+
+from . import tracing
+
+_logger = logging.getLogger(__name__)
+
+# seconds between two writes of the metrics of a worker
+FLUSH_INTERVAL = 5
+
+LATENCY_BUCKETS = (
+    0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300
+)
+SIZE_BUCKETS = tuple(1024 * 4 ** i for i in range(11))  # 1 KB to 1 GB
+COUNT_BUCKETS = tuple(10 ** i for i in range(8))
+RATIO_BUCKETS = (1.25, 1.5, 2, 3, 5, 10, 20, 50, 100)
+
+# name -> (type, help, buckets)
+METRICS = {
+    "o_dory_operations_total": (
+        "counter",
+        "Operations served, by operation and outcome.",
+        None,
+    ),
+    "o_dory_operation_seconds": (
+        "histogram",
+        "Latency of the operations.",
+        LATENCY_BUCKETS,
+    ),
+    "o_dory_search_phase_seconds": (
+        "histogram",
+        "Latency of the phases of the searches.",
+        LATENCY_BUCKETS,
+    ),
+    "o_dory_payload_bytes": (
+        "histogram",
+        "Size of the payloads, by operation and direction.",
+        SIZE_BUCKETS,
+    ),
+    "o_dory_compression_ratio": (
+        "histogram",
+        "Uncompressed over compressed size of the rpc bodies, by direction "
+        "and encoding.",
+        RATIO_BUCKETS,
+    ),
+    "o_dory_compressed_bytes_saved_total": (
+        "counter",
+        "Bytes not sent thanks to the compression of the rpc bodies.",
+        None,
+    ),
+    "o_dory_folder_documents": (
+        "histogram",
+        "Documents of the folders at each search.",
+        COUNT_BUCKETS,
+    ),
+    "o_dory_folder_bytes": (
+        "histogram",
+        "Size of the packed columns of the folders at each search.",
+        SIZE_BUCKETS,
+    ),
+}
+
+
+class Registry(object):
+    def __init__(self, path=None):
+        self.path = path
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        # (name, labels) -> value for counters,
+        # [bucket counts..., +Inf count, sum] for histograms
+        self._values = dict()
+        self._flushed = 0
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+        self._maybe_flush()
+
+    def observe(self, name, value, **labels):
+        buckets = METRICS[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(buckets) + 2)
+            # not cumulative here, render sums the lower buckets
+            counts[bisect.bisect_left(buckets, value)] += 1
+            counts[-1] += value
+        self._maybe_flush()
+
+    def snapshot(self):
+        with self._lock:
+            return _snapshot(self._values)
+
+    def _maybe_flush(self, force=False):
+        if not self.path:
+            return
+        if not force and time.monotonic() - self._flushed < FLUSH_INTERVAL:
+            return
+        with self._flush_lock:
+            now = time.monotonic()
+            if not force and now - self._flushed < FLUSH_INTERVAL:
+                return
+            self._flushed = now
+            try:
+                os.makedirs(self.path, exist_ok=True)
+                path = os.path.join(self.path, "{}.json".format(os.getpid()))
+                _write(path, self.snapshot())
+            except OSError:
+                _logger.warning("Cannot write the o-dory metrics", exc_info=True)
+
+    def flush(self):
+        self._maybe_flush(force=True)
+
+    # sum of the snapshots written by all the workers
+    def collect(self):
+        if not self.path:
+            return _merge(dict(), self.snapshot())
+        self.flush()
+        with open(os.path.join(self.path, ".lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            retired_path = os.path.join(self.path, "retired.json")
+            retired = _merge(dict(), _read(retired_path))
+            values = dict()
+            for path in glob.glob(os.path.join(self.path, "*.json")):
+                name = os.path.basename(path)[: -len(".json")]
+                if not name.isdigit():
+                    continue
+                snapshot = _read(path)
+                if _alive(int(name)):
+                    _merge(values, snapshot)
+                    continue
+                _merge(retired, snapshot)
+                _write(retired_path, _snapshot(retired))
+                os.unlink(path)
+        return _merge(values, _snapshot(retired))
+
+    def render(self):
+        values = self.collect()
+        lines = []
+        for (name, (kind, description, buckets)) in METRICS.items():
+            lines.append("# HELP {} {}".format(name, description))
+            lines.append("# TYPE {} {}".format(name, kind))
+            for ((n, labels), value) in sorted(values.items()):
+                if n != name:
+                    continue
+                if kind == "counter":
+                    lines.append("{}{} {}".format(name, _labels(labels), value))
+                    continue
+                cumulative = 0
+                for (bound, count) in zip(buckets + ("+Inf",), value[:-1]):
+                    cumulative += count
+                    lines.append(
+                        "{}_bucket{} {}".format(
+                            name, _labels(labels + (("le", str(bound)),)), cumulative
+                        )
+                    )
+                lines.append("{}_sum{} {}".format(name, _labels(labels), value[-1]))
+                lines.append("{}_count{} {}".format(name, _labels(labels), cumulative))
+        return "\n".join(lines) + "\n"
+
+
+def _snapshot(values):
+    return [
+        [name, list(labels), list(v) if isinstance(v, list) else v]
+        for ((name, labels), v) in values.items()
+    ]
+
+
+def _write(path, snapshot):
+    tmp = "{}.tmp".format(path)
+    with open(tmp, "w") as f:
+        f.write(json.dumps(snapshot))
+    os.replace(tmp, path)
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return json.loads(f.read())
+    except (OSError, ValueError):
+        return []
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+# add the metrics of a snapshot to values, should give values
+def _merge(values, snapshot):
+    for (name, labels, value) in snapshot:
+        if name not in METRICS:
+            continue
+        key = (name, tuple(tuple(label) for label in labels))
+        if isinstance(value, list):
+            total = values.setdefault(key, [0] * len(value))
+            for (i, v) in enumerate(value):
+                total[i] += v
+        else:
+            values[key] = values.get(key, 0) + value
+    return values
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{{{}}}".format(
+        ",".join(
+            '{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+            for (k, v) in labels
+        )
+    )
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry():
+    global _registry
+    with _registry_lock:
+        # a forked worker starts from empty metrics, not the ones of its parent
+        if _registry is None or _registry.pid != os.getpid():
+            data_dir = tools.config.get("data_dir")
+            path = os.path.join(data_dir, "o_dory", "metrics") if data_dir else None
+            _registry = Registry(path)
+        return _registry
+
+
+def inc(name, value=1, **labels):
+    get_registry().inc(name, value, **labels)
+
+
+def observe(name, value, **labels):
+    get_registry().observe(name, value, **labels)
+
+
+# time a phase of a search, also a span of the trace of the request if any
+@contextlib.contextmanager
+def phase(name):
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        end = time.monotonic()
+        observe("o_dory_search_phase_seconds", end - start, phase=name)
+        tracing.record(name, start, end)
+
+
+# count and time an operation, also works as a method decorator
+@contextlib.contextmanager
+def operation(name):
+    start = time.monotonic()
+    outcome = "error"
+    try:
+        yield
+        outcome = "ok"
+    finally:
+        observe("o_dory_operation_seconds", time.monotonic() - start, operation=name)
+        inc("o_dory_operations_total", operation=name, outcome=outcome)
+
+
+def payload(name, direction, size):
+    observe("o_dory_payload_bytes", size, operation=name, direction=direction)
+
+
+# a body of size bytes sent or received as wire_size compressed bytes
+def compression(direction, encoding, size, wire_size):
+    observe(
+        "o_dory_compression_ratio",
+        size / max(wire_size, 1),
+        direction=direction,
+        encoding=encoding,
+    )
+    inc(
+        "o_dory_compressed_bytes_saved_total",
+        size - wire_size,
+        direction=direction,
+        encoding=encoding,
+    )
@@ -1,143 +1,258 @@
-from odoo import api, fields, models, _
-from odoo.exceptions import UserError, ValidationError
+from odoo import api, fields, models, tools, _
+from odoo.exceptions import AccessError, UserError, ValidationError
 import ujson as json
-import logging, random, math
+import concurrent.futures, contextlib, functools, logging, random, threading
 import numpy as np
 import sycret
 import multiprocessing
 
-# force to use fork instead of spawn on mac os
-# ! this is not safe on mac os
-# https://bugs.python.org/issue33725
-multiprocessing.set_start_method("fork")
+from . import column_store, metrics, search_pool, tracing
+from .search_scheduler import get_queue_timeout, get_scheduler
+from .search_coalescer import coalescer, write_coalescer
+from .search_kernel import fold_many, match_all, scan_many, unpack_columns
 
 _logger = logging.getLogger(__name__)
 
-eq = sycret.EqFactory(n_threads=10)
+# seconds a queued write waits for the transaction that applies it
+WRITE_COALESCE_TIMEOUT = 600
 
+# dpf factories are made on first use, one per thread count,
+# so that loading the module and forking workers stays cheap
+_eq_factories = dict()
+_eq_lock = threading.Lock()
 
-def server_search_worker(outputs, cols, results, start, end):
-    # the difference is results is a shared memory 1d array
-    row_size = len(cols[0])
-    for i in range(start, end):
-        results[i] ^= outputs[i // row_size] & cols[i // row_size][i % row_size]
 
-
-def server_search_async(outputs, cols, results):
-    col_num = len(cols)
-    row_num = len(cols[0])
-    size = col_num * row_num
-    # results_sm is 1d array
-    results_sm = multiprocessing.Array("i", size)
-    nproc = min(multiprocessing.cpu_count(), size)
-    bsize = math.ceil(len(results_sm) / nproc)
-    procs = [None] * nproc
-
-    for i in range(nproc):
-        # split into chunks
-        start, end = i * bsize, min((i + 1) * bsize, len(results_sm))
-        p = multiprocessing.Process(
-            target=server_search_worker, args=(outputs, cols, results_sm, start, end)
-        )
-        p.start()
-        procs[i] = p
-
-    for p in procs:
-        p.join()
-    # now convert results_sm to results
-    for i in range(len(results_sm)):
-        results[i // row_num][i % row_num] = results_sm[i]
+def get_eq(n_threads):
+    with _eq_lock:
+        if n_threads not in _eq_factories:
+            _eq_factories[n_threads] = sycret.EqFactory(n_threads=n_threads)
+        return _eq_factories[n_threads]
 
 
 class ResUsers(models.Model):
     _inherit = "res.users"
 
-    def get_folder(self):
+    # partitions are 0 to o_dory.max_partitions (64 by default) excluded
+    def check_partition(self, partition):
+        params = self.env["ir.config_parameter"].sudo()
+        max_partitions = int(params.get_param("o_dory.max_partitions", 64))
+        if not isinstance(partition, int) or not 0 <= partition < max_partitions:
+            raise ValidationError(_("Invalid partition {}.".format(partition)))
+
+    # the folder of a partition, an empty recordset when it was never written
+    def find_folder(self, partition=0):
+        self.ensure_one()
+        self.check_partition(partition)
+        return self.env["server.folder"].search(
+            [("user_id", "=", self.id), ("partition_index", "=", partition)], limit=1
+        )
+
+    # one user has one folder per partition on a server, the first partition
+    # is set up with the user, the others are made by the first write (create)
+    # reads of a partition never written go through find_folder instead
+    def get_folder(self, partition=0, create=False):
         self.ensure_one()
-        folder_ids = self.env["server.folder"].search(
-            [("user_id", "=", self.id)], limit=1
-        )  # one user should only have one folder on a server
+        folder_ids = self.find_folder(partition)
+        if not folder_ids and partition and create:
+            first_id, __ = self.get_folder()
+            folder_ids = (
+                self.env["server.folder"]
+                .sudo()
+                .create(
+                    {
+                        "name": "{} #{}".format(first_id.name or "", partition),
+                        "user_id": self.id,
+                        "partition_index": partition,
+                    }
+                )
+            )
         if not folder_ids:
             raise ValidationError(_("Cannot find related folder."))
         folder_id = folder_ids[0]
         version = folder_id.bitmap_version
-        bitmaps = folder_id.bitmaps
-        return folder_id, bitmaps, version
+        return folder_id, version
 
-    def get_bitmaps_doc_versions_by_doc_ids(self, doc_ids):
+    @tracing.traced("get_bitmaps_doc_versions")
+    def get_bitmaps_doc_versions_by_doc_ids(self, doc_ids, partition=0):
         self.ensure_one()
-        folder_id, bitmaps, version = self.get_folder()
-        docs = self.env["encrypted.document"].search_read(
-            [
-                ("user_id", "=", self.id),
-                ("folder_id", "=", folder_id.id),
-                ("id", "in", doc_ids),
-            ],
-            fields=["version"],
+        folder_id = self.find_folder(partition)
+        if not folder_id:
+            return json.dumps([])
+        ids, versions = self.env["encrypted.document"].read_ids_versions(
+            self.id, folder_id.id, doc_ids
         )
-        doc_versions = {doc.get("id"): doc.get("version") for doc in docs}
-        bitmaps = folder_id.bitmaps_get(folder_id.bitmaps_deserialize(bitmaps), doc_ids)
+        doc_versions = dict(zip(ids, versions))
+        bitmaps = folder_id.bitmaps_get(folder_id.bitmaps_load(doc_ids), doc_ids)
         ret = [
             [bitmaps[i], doc_versions.get(doc_ids[i])] for i in range(len(doc_versions))
         ]
         return json.dumps(ret)
 
-    def get_bitmaps_version(self):
-        __, __, version = self.get_folder()
-        return version
-
-    def get_indexed_document_count(self):
-        folder_id, bitmaps, __ = self.get_folder()
-        return len(folder_id.bitmaps_deserialize(bitmaps))
+    # the folders of the first partition_count partitions (all when not given)
+    def get_partition_folders(self, partition_count=None):
+        self.ensure_one()
+        if partition_count is None:
+            return self.env["server.folder"].search(
+                [("user_id", "=", self.id)], order="partition_index"
+            )
+        return self.env["server.folder"].concat(
+            *[self.find_folder(p) for p in range(partition_count)]
+        )
 
-    def upload_encrypted_files(self, encrypted_data):
+    # the folder of a partition to export or import (create) as a snapshot
+    # (see the controllers), administrators may name the login of another user
+    def get_snapshot_folder(self, partition=0, login=None, create=False):
+        self.ensure_one()
+        user = self
+        if login and login != self.login:
+            if not self.has_group("base.group_system"):
+                raise AccessError(_("Only administrators can move other folders."))
+            user = self.sudo().search([("login", "=", login)], limit=1)
+            if not user:
+                raise ValidationError(_("Unknown user {}.".format(login)))
+        folder_id, __ = user.get_folder(partition, create)
+        return folder_id
+
+    @tracing.traced("get_bitmaps_version")
+    def get_bitmaps_version(self, partition=0):
+        return self.find_folder(partition).bitmap_version or 0
+
+    @tracing.traced("get_indexed_document_count")
+    def get_indexed_document_count(self, partition=0):
+        folder_id = self.find_folder(partition)
+        return folder_id.bitmaps_count() if folder_id else 0
+
+    @tracing.traced("upload")
+    def upload_encrypted_files(self, encrypted_data, partition=0):
         self.ensure_one()
         encrypted_documents, bloom_filter_rows, new_col_macs = encrypted_data
-        folder_id, bitmaps, version = self.get_folder()
+        return self.upload_documents(
+            encrypted_documents, bloom_filter_rows, "set", new_col_macs, partition
+        )
 
-        # upload the encrypted_document
-        doc_ids = self.env["encrypted.document"].create(
-            [
-                {
-                    "blob": encrypted_document,
-                    "folder_id": folder_id.id,
-                    "user_id": self.id,
-                    "version": doc_version,
-                }
-                for (encrypted_document, doc_version) in encrypted_documents
-            ]
+    # same as upload_encrypted_files, with the macs of the new rows only,
+    # xored into the macs of the folder so that concurrent uploads commute
+    @tracing.traced("upload")
+    def append_encrypted_files(self, encrypted_data, partition=0):
+        self.ensure_one()
+        encrypted_documents, bloom_filter_rows, col_macs_delta = encrypted_data
+        return self.upload_documents(
+            encrypted_documents, bloom_filter_rows, "xor", col_macs_delta, partition
         )
 
-        if not doc_ids:
+    @metrics.operation("upload")
+    def upload_documents(
+        self, encrypted_documents, bloom_filter_rows, op, macs, partition=0
+    ):
+        folder_id, version = self.get_folder(partition, create=True)
+        metrics.payload(
+            "upload", "in", sum(len(blob or "") for (blob, __) in encrypted_documents)
+        )
+        vals_list = [
+            {
+                "blob": encrypted_document,
+                "folder_id": folder_id.id,
+                "version": doc_version,
+            }
+            for (encrypted_document, doc_version) in encrypted_documents
+        ]
+        if not vals_list:
             # todo: need some better handling
             raise ValidationError(_("Error creating files."))
 
-        # bitmap operations
-        bitmaps_obj = folder_id.bitmaps_deserialize(bitmaps)
+        def create(env):
+            return env["encrypted.document"].create(vals_list)
 
-        bitmaps_obj = folder_id.bitmaps_update(
-            bitmaps_obj, doc_ids.ids, bloom_filter_rows
-        )
-        new_bitmaps = folder_id.bitmaps_serialize(bitmaps_obj)
+        return self.write_coalesced(folder_id, create, bloom_filter_rows, op, macs)
 
-        folder_id.sudo().write(
-            {
-                "bitmaps": new_bitmaps,
-                "bitmap_version": version + 1,
-                "col_macs": new_col_macs,
-            }
+    def get_write_coalesce_window(self):
+        params = self.env["ir.config_parameter"].sudo()
+        window = int(params.get_param("o_dory.write_coalesce_ms", 0))
+        max_size = int(params.get_param("o_dory.write_coalesce_max", 64))
+        return window / 1000.0, max_size
+
+    # queue a batch of new documents of the folder, with a write coalesce
+    # window the batches arriving while a writer holding the folder lock waits
+    # are written by it in its transaction, one version bump per batch, the
+    # others get their doc ids once that transaction is committed; without a
+    # window every batch is written by its own caller
+    # (see ServerFolder.bitmaps_append for create, op and macs)
+    def write_coalesced(self, folder_id, create, rows, op, macs):
+        self.ensure_one()
+        window, max_size = self.get_write_coalesce_window()
+        cr = self.env.cr
+
+        def run(batches):
+            return folder_id.bitmaps_append(batches)
+
+        def defer(release):
+            cr.postcommit.add(release)
+            cr.postrollback.add(
+                functools.partial(
+                    release, ValidationError(_("Concurrent upload failed, please retry."))
+                )
+            )
+
+        try:
+            with tracing.span("write"):
+                return write_coalescer.submit(
+                    (cr.dbname, folder_id.id),
+                    (create, rows, op, macs),
+                    run,
+                    window,
+                    max_size,
+                    prepare=folder_id.lock,
+                    defer=defer,
+                    timeout=WRITE_COALESCE_TIMEOUT,
+                )
+        except TimeoutError:
+            raise ValidationError(_("Concurrent upload timed out, please retry."))
+
+    # staged uploads (see upload_session.py), sizes are the blob sizes in bytes
+    # should give the token to send the chunks with
+    @tracing.traced("upload_session_start")
+    def upload_session_start(self, sizes, partition=0):
+        self.ensure_one()
+        folder_id, version = self.get_folder(partition, create=True)
+        session = self.env["server.upload.session"].start(self.id, folder_id.id, sizes)
+        return session.token
+
+    def get_upload_session(self, token):
+        session = self.env["server.upload.session"].search(
+            [("token", "=", token), ("user_id", "=", self.id)]
         )
+        if not session:
+            raise ValidationError(_("Unknown upload session."))
+        return session
 
-        return doc_ids.ids
+    @tracing.traced("upload_session_status")
+    def upload_session_status(self, token):
+        self.ensure_one()
+        return self.get_upload_session(token).status()
 
-    def remove_encrypted_files_by_ids(self, data):
+    # same data as append_encrypted_files, without the blobs:
+    # [versions, bloom_filter_rows, col_macs_delta]
+    @tracing.traced("upload_commit")
+    @metrics.operation("upload_commit")
+    def upload_session_commit(self, token, data):
         self.ensure_one()
-        folder_id, bitmaps, version = self.get_folder()
+        versions, bloom_filter_rows, col_macs_delta = data
+        return self.get_upload_session(token).commit(
+            versions, bloom_filter_rows, "xor", col_macs_delta
+        )
+
+    @tracing.traced("remove")
+    @metrics.operation("remove")
+    def remove_encrypted_files_by_ids(self, data, partition=0):
+        self.ensure_one()
+        folder_id, version = self.get_folder(partition)
+        with tracing.span("lock"):
+            folder_id.lock()
         fids, new_col_macs = data
 
         # iterate over doc_ids to avoid deleting files not belonging to the user
         doc_ids = self.env["encrypted.document"].search(
-            [("id", "in", fids), ("user_id", "=", self.id)]
+            [("id", "in", fids), ("folder_id", "=", folder_id.id)]
         )
 
         res = True
@@ -150,30 +265,26 @@ class ResUsers(models.Model):
                 )
                 return False
 
-            ddoc_ids = [str(i) for i in doc_ids.ids]
+            # the bitmap rows are removed along with the documents
             doc_ids.unlink()
-            # deserialize
-            bitmaps_obj = folder_id.bitmaps_deserialize(bitmaps)
-            res = folder_id.bitmaps_remove(bitmaps_obj, ddoc_ids)
-            new_bitmaps = folder_id.bitmaps_serialize(bitmaps_obj)
-
-            folder_id.sudo().write(
-                {
-                    "bitmaps": new_bitmaps,
-                    "bitmap_version": version + 1,
-                    "col_macs": new_col_macs,
-                }
-            )
+            folder_id.bitmaps_bump_version(new_col_macs)
 
         return res
 
-    def update_files_by_ids(self, encrypted_data):
+    @tracing.traced("update")
+    @metrics.operation("update")
+    def update_files_by_ids(self, encrypted_data, partition=0):
         fids, encrypted_documents, bloom_filter_rows, new_col_macs = encrypted_data
-        folder_id, bitmaps, version = self.get_folder()
+        metrics.payload(
+            "update", "in", sum(len(blob or "") for (blob, __) in encrypted_documents)
+        )
+        folder_id, version = self.get_folder(partition)
+        with tracing.span("lock"):
+            folder_id.lock()
 
         # verify the old file exists
         doc_ids = self.env["encrypted.document"].search(
-            [("user_id", "=", self.id), ("id", "in", fids)]
+            [("folder_id", "=", folder_id.id), ("id", "in", fids)]
         )
         if not doc_ids:
             raise ValidationError(_("Error creating file."))
@@ -181,55 +292,50 @@ class ResUsers(models.Model):
         if len(fids) != len(doc_ids):
             return False
 
-        for i in range(len(doc_ids)):
+        # encrypted_documents and bloom_filter_rows follow the order of fids
+        for i in range(len(fids)):
 
-            doc_id = doc_ids[i]
+            doc_id = doc_ids.browse(fids[i])
             encrypted_document, doc_version = encrypted_documents[i]
 
             doc_id.write({"blob": encrypted_document, "version": doc_version})
 
-        # bitmap operations
-        bitmaps_obj = folder_id.bitmaps_deserialize(bitmaps)
-        bitmaps_obj = folder_id.bitmaps_update(
-            bitmaps_obj, doc_ids.ids, bloom_filter_rows
-        )
-        new_bitmaps = folder_id.bitmaps_serialize(bitmaps_obj)
-
-        folder_id.sudo().write(
-            {
-                "bitmaps": new_bitmaps,
-                "bitmap_version": version + 1,
-                "col_macs": new_col_macs,
-            }
-        )
+        # bitmap operations, only the updated rows are written
+        folder_id.bitmaps_write(fids, bloom_filter_rows)
+        folder_id.bitmaps_bump_version(new_col_macs)
 
         return True
 
     # well this is not really necessary
+    @tracing.traced("retrieve_doc_ids")
     def retrieve_doc_ids(self):
         self.ensure_one()
-
-        docs = self.env["encrypted.document"].search_read(
-            [("user_id", "=", self.id)], fields=["id"]
-        )
-
-        ids = [doc.get("id") for doc in docs]
-
+        ids, __ = self.env["encrypted.document"].read_ids_versions(self.id)
         return ids
 
+    @tracing.traced("retrieve_doc_versions")
     def retrieve_doc_versions(self):
         self.ensure_one()
+        ids, versions = self.env["encrypted.document"].read_ids_versions(self.id)
+        return [{"id": i, "version": v} for (i, v) in zip(ids, versions)]
 
-        docs = self.env["encrypted.document"].search_read(
-            [("user_id", "=", self.id)], fields=["version"]
-        )
-        return docs
+    # same as retrieve_doc_versions, as [ids, versions] flat lists
+    @tracing.traced("retrieve_doc_ids_versions")
+    def retrieve_doc_ids_versions(self):
+        self.ensure_one()
+        ids, versions = self.env["encrypted.document"].read_ids_versions(self.id)
+        return [ids, versions]
 
-    def retrieve_col_macs(self):
+    @tracing.traced("retrieve_col_macs")
+    def retrieve_col_macs(self, partition=0):
         self.ensure_one()
+        folder_id = self.find_folder(partition)
+        if not folder_id:
+            # same as a new folder (see ServerFolder.col_macs_create)
+            return folder_id.col_macs_serialize([])
 
         folders = self.env["server.folder"].search_read(
-            [("user_id", "=", self.id)], fields=["col_macs"]
+            [("id", "=", folder_id.id)], fields=["col_macs"]
         )
 
         col_macs = [folder.get("col_macs") for folder in folders]
@@ -253,65 +359,443 @@ class ResUsers(models.Model):
 
         return [d.blob for d in doc_ids]
 
+    # where to read the blob of each of the given documents (in that order),
+    # should give [doc_id, version, size, source] for the documents of the user,
+    # source is the path of the file in the filestore, or the bytes
+    # when the attachment is stored in the database
+    def retrieve_blob_sources(self, fids):
+        self.ensure_one()
+        doc_ids = self.env["encrypted.document"].search(
+            [("id", "in", fids), ("user_id", "=", self.id)]
+        )
+        if len(doc_ids) < len(set(fids)):
+            _logger.warning(
+                "User {} attempts to retrieve non-existent files {}".format(
+                    self.id, fids
+                )
+            )
+        found = set(doc_ids.ids)
+        return (
+            self.env["encrypted.document"]
+            .browse([fid for fid in fids if fid in found])
+            .blob_sources()
+        )
+
     # this is the naive model
     # all_indices = [[1, 2, 5], [9, 39, 4], [4, 7, 8]]
     # should return [[doc id1, doc id2, ...], [], []]
+    # each index set is an AND of packed columns of the search store, which is
+    # kept per bitmap version, so nothing is unpacked but the matches
+    @tracing.traced("search_naive")
+    @metrics.operation("search_naive")
     def search_documents_by_keyword_indices(self, all_indices):
         self.ensure_one()
-        # todo: the returned bitmaps should be deserialized?
-        folder_id, bitmaps, version = self.get_folder()
-        cols, row_to_doc = folder_id.bitmaps_flip(
-            folder_id.bitmaps_deserialize(bitmaps)
-        )
         all_ret = [[] for i in all_indices]
-        if not cols:
-            return all_ret
-        # i is row
-        for i in range(len(cols[0])):
-            # j is return slot
-            for j, indices in enumerate(all_indices):
-                # k is the actual index
-                if all([cols[k][i] for k in indices]):
-                    all_ret[j].append(row_to_doc.get(i))
+        for folder_id in self.get_partition_folders():
+            with metrics.phase("load"):
+                store = folder_id.search_store()
+            if not len(store):
+                continue
+            self.observe_folder(store)
+            with metrics.phase("scan"):
+                try:
+                    rows = match_all(store.words, len(store), all_indices)
+                except (TypeError, ValueError):
+                    raise ValidationError(_("Invalid keyword indices."))
+            for (j, matched) in enumerate(rows):
+                all_ret[j] += store.doc_ids[matched].tolist()
 
         return all_ret
 
-    def eval_dpf(self, y, secrets):
-        x, keys = secrets
-        x = np.array(x, dtype=np.int32)
-        keys = np.array(keys, dtype=np.uint8)
-        outputs = eq.eval(y, x, keys)
+    # expand one compact key over the width positions of the bloom filter
+    # (see ClientManager.prepare_dpf_compact)
+    def eval_dpf_compact(self, y, secret, width, eq=None):
+        eq = eq or get_eq(self.get_dpf_threads())
+        x = (secret["offset"] + np.arange(width, dtype=np.int64)) % 2 ** 32
+        x = x.astype(np.uint32).view(np.int32)
+        key = np.array(secret["key"], dtype=np.uint8)
+        keys = np.repeat(key[np.newaxis, :], width, axis=0)
+        return eq.eval(y, x, keys)
+
+    # secrets is either [x, keys] with one key per bloom filter column,
+    # a compact key, or a list of compact keys (one per target index)
+    # outputs are kept as a numpy array when as_array is set
+    def eval_dpf(self, y, secrets, as_array=False, width=None):
+        threads = self.get_dpf_threads()
+        eq = get_eq(threads)
+        with self.search_slot(threads), metrics.phase("eval_dpf"):
+            if isinstance(secrets, dict):
+                outputs = self.eval_dpf_compact(y, secrets, width, eq)
+            elif secrets and isinstance(secrets[0], dict):
+                # targets are distinct, so xoring the low bits of the outputs
+                # gives shares that combine to 1 at every target
+                outputs = np.bitwise_xor.reduce(
+                    [
+                        self.eval_dpf_compact(y, secret, width, eq) & 1
+                        for secret in secrets
+                    ]
+                )
+            else:
+                x, keys = secrets
+                x = np.array(x, dtype=np.int32)
+                keys = np.array(keys, dtype=np.uint8)
+                outputs = eq.eval(y, x, keys)
+        if as_array:
+            return outputs
         outputs = outputs.tolist()
         return outputs
 
+    # threads of a dpf evaluation, also the cores it takes from the search
+    # budget: o_dory_dpf_threads in the odoo configuration, else the
+    # o_dory.dpf_threads parameter, else the cores of the host
+    def get_dpf_threads(self):
+        threads = tools.config.get("o_dory_dpf_threads")
+        if not threads:
+            params = self.env["ir.config_parameter"].sudo()
+            threads = params.get_param("o_dory.dpf_threads")
+        return max(int(threads or multiprocessing.cpu_count()), 1)
+
+    # cores taken for a part of a search, queued per user while the worker is
+    # busy (see search_scheduler.py), this runs in threads of partitioned
+    # searches too, so it must not touch the cursor
+    @contextlib.contextmanager
+    def search_slot(self, cost):
+        scheduler = get_scheduler()
+        try:
+            with metrics.phase("queue"):
+                cost = scheduler.acquire(self.id, cost, get_queue_timeout())
+        except TimeoutError:
+            # not translated, that would need the cursor
+            raise ValidationError("The server is busy, please retry the search.")
+        try:
+            yield cost
+        finally:
+            scheduler.release(cost)
+
+    # the scans of the async engine are split over the whole search pool
+    def get_scan_cost(self, engine):
+        return multiprocessing.cpu_count() if engine == "async" else 1
+
+    # load of the search scheduler of this worker
+    def get_search_queue_depth(self):
+        return get_scheduler().depth()
+
     def server_search_seq(self, outputs, cols, results, col_s, col_e, row_s, row_e):
         for j in range(col_s, col_e):
             for i in range(row_s, row_e):
                 results[j][i] ^= outputs[j] & cols[j][i]
 
-    # server evals the secret
-    def server_search(self, y, secrets, async_enabled=False):
-        _logger.warning("Started server search")
-        secrets = json.loads(secrets)
-        folder_id, bitmaps, version = self.get_folder()
-        doc_versions = self.retrieve_doc_versions()
-        bitmaps = folder_id.bitmaps_deserialize(bitmaps)
-        cols, row_to_doc = folder_id.bitmaps_flip(bitmaps)
-        doc_count = len(bitmaps)
-        bloom_filter_width = len(cols)
-        if not doc_count or not bloom_filter_width:
-            return json.dumps(([], list(row_to_doc.items()), doc_versions))
-
-        outputs = self.eval_dpf(y, secrets)
-        results = [[0 for x in range(doc_count)] for y in range(bloom_filter_width)]
-        if async_enabled:
-            # raise ValidationError("Server Search Async currently not available")
-            server_search_async(outputs, cols, results)
-        else:
+    # the same as server_search_seq, over the packed columns of the search store
+    # for each of outputs_list
+    def server_search_numpy(self, outputs_list, store):
+        results = scan_many(outputs_list, store.words)
+        return [unpack_columns(r, len(store)).tolist() for r in results]
+
+    # everything a search needs from the folder, loaded once per call
+    # doc_ids and doc_versions are row aligned, cached with the search store
+    def get_search_context(self, partition=0):
+        self.ensure_one()
+        with metrics.phase("load"):
+            folder_id = self.find_folder(partition)
+            store = folder_id.search_store() if folder_id else column_store.empty()
+            doc_ids, doc_versions = store.response_rows()
+        self.observe_folder(store)
+        return store, doc_ids, doc_versions
+
+    def observe_folder(self, store):
+        metrics.observe("o_dory_folder_documents", len(store))
+        metrics.observe("o_dory_folder_bytes", store.words.nbytes)
+
+    # engine is one of "seq", "async" or "numpy", async being the numpy kernel
+    # run by the search pool
+    def server_search_matrix(self, y, secrets, store, engine):
+        return self.server_search_matrices(y, [secrets], store, engine)[0]
+
+    # several queries, the dpf outputs of all of them are scanned in one pass
+    def server_search_matrices(self, y, secrets_list, store, engine):
+        outputs_list = [
+            self.eval_dpf(y, secrets, as_array=engine != "seq", width=store.width)
+            for secrets in secrets_list
+        ]
+        return self.scan_outputs_many(outputs_list, store, engine)
+
+    # the columns selected by the dpf outputs, one list per bloom filter column
+    # for each of outputs_list
+    def scan_outputs_many(self, outputs_list, store, engine):
+        if not outputs_list:
+            return []
+        with self.search_slot(self.get_scan_cost(engine)), metrics.phase("scan"):
+            return self._scan_outputs_many(outputs_list, store, engine)
+
+    def _scan_outputs_many(self, outputs_list, store, engine):
+        doc_count = len(store)
+        bloom_filter_width = store.width
+        if engine == "numpy":
+            return self.server_search_numpy(outputs_list, store)
+        if engine == "async":
+            results = search_pool.scan_many_parallel(store, outputs_list)
+            return [unpack_columns(r, doc_count).tolist() for r in results]
+        with metrics.phase("flip"):
+            cols, __ = store.flip()
+        res = []
+        for outputs in outputs_list:
+            outputs = np.asarray(outputs).tolist()
+            results = [
+                [0 for x in range(doc_count)] for y in range(bloom_filter_width)
+            ]
             self.server_search_seq(
                 outputs, cols, results, 0, bloom_filter_width, 0, doc_count
             )
+            res.append(results)
+        return res
+
+    # secrets_list holds one list of per index secrets per query,
+    # the columns are folded in one pass for all of them
+    # (by the search pool when engine is "async")
+    def server_search_folded(self, y, secrets_list, store, engine):
+        outputs = [
+            self.eval_dpf(y, secret, as_array=True, width=store.width)
+            for secrets in secrets_list
+            for secret in secrets
+        ]
+        return self.fold_outputs(secrets_list, outputs, store, engine)
+
+    # outputs holds the outputs of each secret of secrets_list, in order
+    def fold_outputs(self, secrets_list, outputs, store, engine):
+        if not outputs:
+            return [[] for secrets in secrets_list]
+        with self.search_slot(self.get_scan_cost(engine)), metrics.phase("scan"):
+            if engine == "async":
+                shares = search_pool.fold_many_parallel(store, outputs)
+            else:
+                shares = fold_many(outputs, store.words)
+        shares = unpack_columns(shares, len(store)).tolist()
+
+        results, k = [], 0
+        for secrets in secrets_list:
+            results.append(shares[k : k + len(secrets)])
+            k += len(secrets)
+        return results
+
+    # the same queries over the stores of several partitions, the dpf is
+    # evaluated once (all partitions share the bloom filter width) and the
+    # partitions are scanned by threads, the numpy kernels release the gil
+    # (the async engine already splits each scan over the search pool)
+    def server_search_partitioned(self, y, secrets_list, stores, protocol, engine):
+        width = next((s.width for s in stores if len(s) and s.width), 0)
+        if not width:
+            return [[[] for secrets in secrets_list] for store in stores]
+        as_array = engine != "seq"
+        if protocol == "fold":
+            outputs = [
+                self.eval_dpf(y, secret, as_array=True, width=width)
+                for secrets in secrets_list
+                for secret in secrets
+            ]
+        else:
+            outputs = [
+                self.eval_dpf(y, secrets, as_array=as_array, width=width)
+                for secrets in secrets_list
+            ]
+
+        trace = tracing.current()
+
+        def search(store):
+            if not len(store) or store.width != width:
+                return [[] for secrets in secrets_list]
+            with tracing.attach(trace):
+                if protocol == "fold":
+                    return self.fold_outputs(secrets_list, outputs, store, engine)
+                return self.scan_outputs_many(outputs, store, engine)
+
+        if engine == "async" or len(stores) < 2:
+            return [search(store) for store in stores]
+        workers = min(len(stores), multiprocessing.cpu_count())
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(search, stores))
+
+    # concurrent searches on the same folder version are grouped
+    # within this window (see search_coalescer.py), 0 disables it
+    def get_search_coalesce_window(self):
+        params = self.env["ir.config_parameter"].sudo()
+        window = int(params.get_param("o_dory.search_coalesce_ms", 0))
+        max_size = int(params.get_param("o_dory.search_coalesce_max", 32))
+        return window / 1000.0, max_size
+
+    # evaluate one query, possibly along with concurrent ones
+    # the store path identifies the database, folder and bitmap version,
+    # only queries with the same engine are grouped
+    def server_search_coalesced(self, y, secrets, store, protocol, engine):
+        window, max_size = self.get_search_coalesce_window()
+
+        def run(secrets_list):
+            if protocol == "fold":
+                return self.server_search_folded(y, secrets_list, store, engine)
+            return self.server_search_matrices(y, secrets_list, store, engine)
+
+        if not window:
+            return run([secrets])[0]
+        return coalescer.submit(
+            (store.path, y, protocol, engine), secrets, run, window, max_size
+        )
+
+    # json payloads of the searches, timed and measured
+    def search_loads(self, operation, data):
+        metrics.payload(operation, "in", len(data))
+        with metrics.phase("deserialize"):
+            return json.loads(data)
+
+    def search_dumps(self, operation, value):
+        with metrics.phase("serialize"):
+            data = json.dumps(value)
+        metrics.payload(operation, "out", len(data))
+        return data
+
+    # server evals the secret
+    # when engine is not given async_enabled picks between "async" and "seq"
+    @tracing.traced("search")
+    @metrics.operation("search")
+    def server_search(self, y, secrets, async_enabled=False, engine=None, partition=0):
+        _logger.warning("Started server search")
+        engine = engine or ("async" if async_enabled else "seq")
+        secrets = self.search_loads("search", secrets)
+        store, doc_ids, doc_versions = self.get_search_context(partition)
+        if not len(store) or not store.width:
+            return self.search_dumps("search", ([], doc_ids, doc_versions))
+
+        results = self.server_search_coalesced(y, secrets, store, "matrix", engine)
 
         _logger.warning("Done server search")
-        # return results, list(row_to_doc.items()), doc_versions
-        return json.dumps((results, list(row_to_doc.items()), doc_versions))
+        # return results, doc_ids, doc_versions
+        return self.search_dumps("search", (results, doc_ids, doc_versions))
+
+    # dory style search, secrets holds one dpf key set per queried index,
+    # each evaluating to 1 at that index only over the whole bloom filter
+    # instead of width columns, this returns one xor-folded share per index
+    @tracing.traced("search_fold")
+    @metrics.operation("search_fold")
+    def server_search_fold(self, y, secrets, engine=None, partition=0):
+        _logger.warning("Started server fold search")
+        secrets = self.search_loads("search_fold", secrets)
+        store, doc_ids, doc_versions = self.get_search_context(partition)
+        if not len(store) or not store.width:
+            return self.search_dumps("search_fold", ([], doc_ids, doc_versions))
+
+        results = self.server_search_coalesced(y, secrets, store, "fold", engine)
+
+        _logger.warning("Done server fold search")
+        return self.search_dumps("search_fold", (results, doc_ids, doc_versions))
+
+    # many searches over the rows written after since_version only,
+    # for clients holding an answer at that version (see
+    # ClientManager.search_keywords_delta), should return
+    # [results, doc_ids, doc_versions, inserted_versions, removed,
+    #  since_version, bitmap_version]
+    # where inserted_versions gives the version each row was written at,
+    # removed the [doc id, removed version] of the rows removed since then,
+    # since_version is -1 when the answer covers the whole folder, which is
+    # the case when the removals after the given version are not known
+    @tracing.traced("search_delta")
+    @metrics.operation("search_delta")
+    def server_search_delta(
+        self, y, secrets_list, since_version, protocol="fold", engine=None, partition=0
+    ):
+        _logger.warning("Started server delta search")
+        engine = engine or "numpy"
+        secrets_list = self.search_loads("search_delta", secrets_list)
+        folder_id = self.find_folder(partition)
+        version = folder_id.bitmap_version or 0
+        if not folder_id or not folder_id.delta_floor <= since_version <= version:
+            since_version = -1
+
+        with metrics.phase("load"):
+            if not folder_id:
+                store = column_store.empty()
+                inserted_versions, removed = [], []
+            elif since_version < 0:
+                store = folder_id.search_store()
+                inserted_versions, removed = [], []
+            else:
+                bitmaps_obj, versions, inserted_versions = folder_id.delta_load(
+                    since_version
+                )
+                store = column_store.MemoryStore(bitmaps_obj, versions)
+                removed = folder_id.delta_removed(since_version)
+                # the pool reads stores from their file, deltas are small anyway
+                engine = "numpy" if engine == "async" else engine
+            doc_ids, doc_versions = store.response_rows()
+        self.observe_folder(store)
+
+        if not len(store) or not store.width:
+            results = [[] for secrets in secrets_list]
+        elif protocol == "fold":
+            results = self.server_search_folded(y, secrets_list, store, engine)
+        else:
+            results = self.server_search_matrices(y, secrets_list, store, engine)
+
+        _logger.warning("Done server delta search")
+        return self.search_dumps(
+            "search_delta",
+            (
+                results,
+                doc_ids,
+                doc_versions,
+                inserted_versions,
+                removed,
+                since_version,
+                version,
+            ),
+        )
+
+    # many searches over the first partition_count partitions of the folder,
+    # should return [results, doc_ids, doc_versions] per partition,
+    # results holding one result per query (same as server_search_batch)
+    @tracing.traced("search_partitions")
+    @metrics.operation("search_partitions")
+    def server_search_partitions(
+        self, y, secrets_list, protocol="fold", engine=None, partition_count=1
+    ):
+        _logger.warning("Started server partitioned search")
+        engine = engine or "numpy"
+        secrets_list = self.search_loads("search_partitions", secrets_list)
+        contexts = [
+            self.get_search_context(partition) for partition in range(partition_count)
+        ]
+        all_results = self.server_search_partitioned(
+            y, secrets_list, [store for (store, __, __) in contexts], protocol, engine
+        )
+
+        _logger.warning("Done server partitioned search")
+        return self.search_dumps(
+            "search_partitions",
+            [
+                (results, doc_ids, doc_versions)
+                for (results, (__, doc_ids, doc_versions)) in zip(all_results, contexts)
+            ],
+        )
+
+    # many searches in one call, secrets_list holds the secrets of each query
+    # the folder is loaded once, and with the fold protocol
+    # the columns are read once for all the queries
+    # should return one result per query (same as server_search(_fold))
+    @tracing.traced("search_batch")
+    @metrics.operation("search_batch")
+    def server_search_batch(
+        self, y, secrets_list, protocol="fold", engine=None, partition=0
+    ):
+        _logger.warning("Started server batch search")
+        engine = engine or "numpy"
+        secrets_list = self.search_loads("search_batch", secrets_list)
+        store, doc_ids, doc_versions = self.get_search_context(partition)
+        if not len(store) or not store.width:
+            return self.search_dumps(
+                "search_batch", ([[] for s in secrets_list], doc_ids, doc_versions)
+            )
+
+        if protocol == "fold":
+            results = self.server_search_folded(y, secrets_list, store, engine)
+        else:
+            results = self.server_search_matrices(y, secrets_list, store, engine)
+
+        _logger.warning("Done server batch search")
+        return self.search_dumps("search_batch", (results, doc_ids, doc_versions))
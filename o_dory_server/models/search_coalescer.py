@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+# coalescing of concurrent searches on the same folder version
+#
+# the first search of a group waits for a short window, the searches arriving
+# meanwhile with the same key join its group, then the first one evaluates
+# all of them in one pass and every caller picks its own result
+#
+# groups live in the memory of an odoo worker, so this coalesces the
+# requests served by the threads of a worker (threaded or gevent servers),
+# prefork workers still share the pages of the search store
+#
+# writes to a folder are grouped the same way (see ResUsers.write_coalesced)
+import functools, threading
+
+
+class _Group(object):
+    def __init__(self):
+        self.items = []
+        self.results = None
+        self.error = None
+        self.full = threading.Event()
+        self.done = threading.Event()
+
+
+class Coalescer(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._groups = dict()
+
+    def pending(self):
+        with self._lock:
+            return sum(len(g.items) for g in self._groups.values())
+
+    # run is given the items of a group and should return their results in order
+    # window is in seconds, a group is evaluated early once it has max_size items
+    #
+    # prepare is called by a caller that finds no open group, before it opens
+    # one (e.g. to take a lock held by the previous group), nothing joins while
+    # it blocks, so with a window of 0 such calls are not grouped at all
+    # defer is given a release callback and the results are only handed to the
+    # other callers once it is called (e.g. once the transaction is committed),
+    # with the error to raise in them if any; they give up after timeout
+    def submit(
+        self, key, item, run, window, max_size, prepare=None, defer=None, timeout=None
+    ):
+        with self._lock:
+            group = self._groups.get(key)
+            leader = group is None
+            if leader and prepare is None:
+                group = self._groups[key] = _Group()
+            if group is not None:
+                index = self._join(key, group, item, max_size)
+
+        if leader:
+            if prepare is not None:
+                prepare()
+                with self._lock:
+                    # whoever held what prepare waited for has closed its group
+                    group = self._groups[key] = _Group()
+                    index = self._join(key, group, item, max_size)
+            try:
+                group.full.wait(window)
+                self._close(key, group)
+                group.results = run(group.items)
+            except Exception as err:
+                self._close(key, group)
+                self._release(group, err)
+                raise
+            if defer is None:
+                group.done.set()
+            else:
+                defer(functools.partial(self._release, group))
+            return group.results[index]
+
+        if not group.done.wait(timeout):
+            raise TimeoutError("Coalesced group of {} timed out.".format(key))
+        if group.error is not None:
+            raise group.error
+        return group.results[index]
+
+    # add item to the open group of key, should give its index in the group
+    def _join(self, key, group, item, max_size):
+        group.items.append(item)
+        if len(group.items) >= max_size:
+            # later items start a new group
+            del self._groups[key]
+            group.full.set()
+        return len(group.items) - 1
+
+    def _close(self, key, group):
+        with self._lock:
+            if self._groups.get(key) is group:
+                del self._groups[key]
+
+    def _release(self, group, error=None):
+        group.error = error
+        group.done.set()
+
+
+coalescer = Coalescer()
+write_coalescer = Coalescer()
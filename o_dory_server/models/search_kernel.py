@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+# numpy kernels for server searches over packed columns
+#
+# a packed column is a row of uint64 words (see column_store.py),
+# bit r of the words is the bitmap bit of row r
+#
+# this module only depends on numpy so scripts can load it directly
+import numpy as np
+
+
+def pack_columns(cols):
+    # cols is a 2d array of 0s and 1s, should give (len(cols), words) uint64
+    bits = np.asarray(cols, dtype=np.uint8)
+    row_count = bits.shape[1]
+    packed = np.zeros((bits.shape[0], (row_count + 63) // 64 * 8), dtype=np.uint8)
+    packed[:, : (row_count + 7) // 8] = np.packbits(bits, axis=1, bitorder="little")
+    return packed.view("<u8")
+
+
+def unpack_columns(words, row_count):
+    return np.unpackbits(
+        np.ascontiguousarray(words).view(np.uint8),
+        axis=1,
+        count=row_count,
+        bitorder="little",
+    )
+
+
+# the packed version of ResUsers.server_search_seq
+# results[j][i] = outputs[j] & cols[j][i], and cols[j][i] is 0 or 1,
+# so only the low bit of outputs[j] matters: it keeps or clears column j
+def scan(outputs, words):
+    keep = (np.asarray(outputs) & 1).astype(bool)
+    results = np.zeros(words.shape, dtype=words.dtype)
+    results[keep] = words[keep]
+    return results
+
+
+# scan for several queries, (queries, width, words), the columns are read
+# once by blocks for all the queries
+def scan_many(outputs, words, block=1024):
+    keep = (np.asarray(outputs).reshape(-1, words.shape[0]) & 1).astype(bool)
+    results = np.zeros((len(keep),) + words.shape, dtype=words.dtype)
+    for start in range(0, words.shape[0], block):
+        columns = words[start : start + block]
+        for q in range(len(keep)):
+            selected = keep[q, start : start + block]
+            results[q, start : start + block][selected] = columns[selected]
+    return results
+
+
+# xor of outputs[q][j] & cols[j] over all columns j, one share per query q
+# and per row, the columns are read once by blocks for all the queries
+# which also bounds the memory of the selections
+def fold_many(outputs, words, block=1024):
+    keep = (np.asarray(outputs).reshape(-1, words.shape[0]) & 1).astype(bool)
+    shares = np.zeros((len(keep), words.shape[1]), dtype=words.dtype)
+    for start in range(0, words.shape[0], block):
+        columns = words[start : start + block]
+        for q in range(len(keep)):
+            selected = columns[keep[q, start : start + block]]
+            if len(selected):
+                shares[q] ^= np.bitwise_xor.reduce(selected, axis=0)
+    return shares
+
+
+# the rows with a 1 in every column of each index set, as arrays of row
+# numbers, one per set; an empty set matches every row
+# (the naive search, see ResUsers.search_documents_by_keyword_indices)
+def match_all(words, row_count, all_indices):
+    res = []
+    for indices in all_indices:
+        indices = np.asarray(indices)
+        if indices.ndim != 1:
+            raise ValueError("Expected a list of column indices.")
+        if len(indices) and (
+            indices.dtype.kind not in "iu"
+            or indices.min() < 0
+            or indices.max() >= words.shape[0]
+        ):
+            # negative indices would wrap around to other columns
+            raise ValueError("Column indices out of range.")
+        if len(indices):
+            matches = np.bitwise_and.reduce(words[indices], axis=0)
+        else:
+            matches = np.full(words.shape[1], ~np.uint64(0), dtype=words.dtype)
+        # unpacked one set at a time, bounded by the row count
+        res.append(np.flatnonzero(unpack_columns(matches[None], row_count)[0]))
+    return res
+
+
+def fold(outputs, words, block=1024):
+    return fold_many([outputs], words, block)[0]
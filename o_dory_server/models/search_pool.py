@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+# long-lived process pool for the async server search
+#
+# the pool is started by the first async search of an odoo worker and kept
+# for its lifetime; a forked worker never reuses the pool of its parent
+#
+# children read column blocks straight from the memory-mapped search store
+# (see column_store.py), pinned by the parent while they run so that a write
+# evicting its version does not unlink it under them; the dpf outputs and the results are exchanged
+# through one shared memory segment, viewed as numpy arrays on both sides
+import collections, multiprocessing, os, threading
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+from .column_store import ColumnStore, pinned
+from .search_kernel import fold_many, scan_many
+
+_pool = None
+_pool_pid = None
+_pool_size = 0
+_pool_lock = threading.Lock()
+
+# store path -> packed columns, in the children
+_mapped = collections.OrderedDict()
+MAPPED_MAX = 8
+
+
+def get_pool():
+    global _pool, _pool_pid, _pool_size
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            # the start method is scoped to this pool,
+            # fork lets the children inherit the loaded modules
+            context = multiprocessing.get_context("fork")
+            _pool_size = multiprocessing.cpu_count()
+            _pool = context.Pool(processes=_pool_size)
+            _pool_pid = os.getpid()
+        return _pool, _pool_size
+
+
+def _columns(path):
+    words = _mapped.pop(path, None)
+    if words is None:
+        words = ColumnStore(path, None).words
+    _mapped[path] = words
+    # stores of old versions are unlinked, let go of their pages
+    while len(_mapped) > MAPPED_MAX:
+        _mapped.popitem(last=False)
+    return words
+
+
+def _aligned(size):
+    return (size + 7) // 8 * 8
+
+
+def _run(task):
+    kind, path, shm_name, queries, slots, start, end, slot = task
+    words = _columns(path)
+    width, n_words = words.shape
+    shm = shared_memory.SharedMemory(name=shm_name)
+    # the parent owns the segment, the children must not unlink it on exit
+    resource_tracker.unregister(shm._name, "shared_memory")
+    try:
+        outputs = np.ndarray((queries, width), dtype=np.uint8, buffer=shm.buf)
+        results = np.ndarray(
+            (slots, queries, n_words),
+            dtype=np.uint64,
+            buffer=shm.buf,
+            offset=_aligned(queries * width),
+        )
+        if kind == "scan":
+            results[start:end] = scan_many(
+                outputs[:, start:end], words[start:end]
+            ).transpose(1, 0, 2)
+        else:
+            results[slot] = fold_many(outputs[:, start:end], words[start:end])
+        del outputs, results
+    finally:
+        shm.close()
+
+
+# outputs is a (queries, width) array
+def _map(kind, store, outputs):
+    # started before pinning, children forked while the pin is held would
+    # inherit it and keep the file for their whole life
+    pool, nproc = get_pool()
+    with pinned(store) as on_disk:
+        if on_disk:
+            return _map_pinned(pool, nproc, kind, store, outputs)
+    # evicted before the search started, the mapping of this process is
+    # still good but the children cannot open the file anymore
+    if kind == "scan":
+        return scan_many(outputs, store.words)
+    return fold_many(outputs, store.words)
+
+
+def _map_pinned(pool, nproc, kind, store, outputs):
+    width, n_words = store.words.shape
+    outputs = np.asarray(outputs).reshape(-1, width)
+    queries = len(outputs)
+    # balanced chunks of columns, one per process
+    chunks = [c for c in np.array_split(np.arange(width), nproc) if len(c)]
+    slots = width if kind == "scan" else len(chunks)
+    shm = shared_memory.SharedMemory(
+        create=True,
+        size=max(_aligned(queries * width) + slots * queries * n_words * 8, 1),
+    )
+    try:
+        shared_outputs = np.ndarray((queries, width), dtype=np.uint8, buffer=shm.buf)
+        # only the low bit of an output matters (see search_kernel.scan)
+        shared_outputs[:] = outputs & 1
+        pool.map(
+            _run,
+            [
+                (kind, store.path, shm.name, queries, slots, c[0], c[-1] + 1, i)
+                for (i, c) in enumerate(chunks)
+            ],
+        )
+        results = np.ndarray(
+            (slots, queries, n_words),
+            dtype=np.uint64,
+            buffer=shm.buf,
+            offset=_aligned(queries * width),
+        )
+        if kind == "scan":
+            res = results.transpose(1, 0, 2).copy()
+        else:
+            res = np.bitwise_xor.reduce(results, axis=0)
+        del shared_outputs, results
+        return res
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+# same as search_kernel.scan_many, with the columns split over the pool
+def scan_many_parallel(store, outputs):
+    return _map("scan", store, outputs)
+
+
+# same as search_kernel.fold_many, each process folds its columns for all
+# the queries, the partial shares are then xored together
+def fold_many_parallel(store, outputs):
+    return _map("fold", store, outputs)
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+# admission control of the cpu heavy parts of the server searches
+#
+# dpf evaluations (sycret threads) and column scans (numpy, the search pool)
+# take cores from a budget shared by the threads of an odoo worker, the
+# excess waits in one queue per user, served round robin so that a user
+# sending many searches does not starve the others
+#
+# the budget is per worker process: with prefork workers it defaults to
+# the cores of the host divided by the number of workers
+import collections, contextlib, multiprocessing, threading, time
+
+from odoo import tools
+
+
+class _Ticket(object):
+    __slots__ = ("cost",)
+
+    def __init__(self, cost):
+        self.cost = cost
+
+
+class Scheduler(object):
+    def __init__(self, budget):
+        self.budget = max(int(budget), 1)
+        self.in_use = 0
+        self._cond = threading.Condition()
+        # user -> tickets, the first user is served next
+        self._queues = collections.OrderedDict()
+
+    def _head(self):
+        for queue in self._queues.values():
+            return queue[0]
+        return None
+
+    # wait until cost cores are free and it is the turn of user,
+    # TimeoutError after timeout seconds
+    def acquire(self, user, cost, timeout=None):
+        ticket = _Ticket(min(max(int(cost), 1), self.budget))
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            self._queues.setdefault(user, collections.deque()).append(ticket)
+            while not (
+                self._head() is ticket and self.in_use + ticket.cost <= self.budget
+            ):
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    self._dequeue(user, ticket)
+                    self._cond.notify_all()
+                    raise TimeoutError("Search queue timed out.")
+                self._cond.wait(remaining)
+            self._dequeue(user, ticket)
+            # the next ticket of this user goes after the other users
+            if user in self._queues:
+                self._queues.move_to_end(user)
+            self.in_use += ticket.cost
+            self._cond.notify_all()
+        return ticket.cost
+
+    def _dequeue(self, user, ticket):
+        queue = self._queues[user]
+        queue.remove(ticket)
+        if not queue:
+            del self._queues[user]
+
+    def release(self, cost):
+        with self._cond:
+            self.in_use -= cost
+            self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def slot(self, user, cost, timeout=None):
+        cost = self.acquire(user, cost, timeout)
+        try:
+            yield cost
+        finally:
+            self.release(cost)
+
+    def depth(self):
+        with self._cond:
+            return {
+                "queued": sum(len(q) for q in self._queues.values()),
+                "queued_users": len(self._queues),
+                "cores_in_use": self.in_use,
+                "budget": self.budget,
+            }
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+# the budget is read from the odoo configuration, not from the database:
+# searches acquire cores from threads that have no cursor
+#   o_dory_search_core_budget = <cores>
+def get_scheduler():
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            budget = tools.config.get("o_dory_search_core_budget")
+            if not budget:
+                workers = tools.config.get("workers") or 0
+                budget = multiprocessing.cpu_count() // max(int(workers), 1)
+            _scheduler = Scheduler(budget)
+        return _scheduler
+
+
+def get_queue_timeout():
+    return float(tools.config.get("o_dory_search_queue_timeout") or 300)
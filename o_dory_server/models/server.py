@@ -1,9 +1,18 @@
 # -*- coding: utf-8 -*-
-from odoo import models, fields, api, _
+from odoo import models, fields, api, tools, _
 from odoo.exceptions import ValidationError
 
 # import odoo.addons.decimal_precision as dp
 import ujson as json
+import functools, hashlib, logging, os, shutil, uuid
+from psycopg2 import Binary
+from psycopg2.extras import execute_values
+
+from . import column_store, metrics, snapshot
+from .bitmaps import PackedBitmaps, pack_rows
+from .upload_session import store_staged
+
+_logger = logging.getLogger(__name__)
 
 
 # each user has a folder on the server
@@ -16,14 +25,42 @@ class ServerFolder(models.Model):
         "res.users", ondelete="cascade", string="User", required=1
     )
 
+    # a user folder is split in partitions, each with its own bitmaps,
+    # bitmap version and macs, so that writes and searches stay bounded
+    partition_index = fields.Integer("Partition", default=0, required=True)
+
     bitmap_version = fields.Integer("Bitmap Version")
-    # bitmap_width = fields.Integer("Bitmap Width", default=128)
+    bitmap_width = fields.Integer("Bitmap Width")
+    # each document has its own row in server.bitmap.row,
+    # bitmaps is the legacy single blob, only read to migrate old folders
     bitmaps = fields.Binary("Bitmaps", attachment=False)
+    row_ids = fields.One2many("server.bitmap.row", "folder_id", "Bitmap Rows")
+    # rows removed from the bitmaps, for delta searches
+    tombstone_ids = fields.One2many(
+        "server.bitmap.tombstone", "folder_id", "Removed Rows"
+    )
+    # delta searches from a version before this one fall back to a full search
+    # (the removals before it are not known)
+    delta_floor = fields.Integer("Delta Floor")
+
+    # last run of the compaction job (see _cron_compact)
+    compaction_date = fields.Datetime("Last Compaction", readonly=True)
+    compaction_reclaimed = fields.Integer("Reclaimed Bytes", readonly=True)
+    # rows only, postgres frees their space once the table is vacuumed
+    compaction_tombstones = fields.Integer("Dropped Tombstones", readonly=True)
 
     # for authentication purposes
     # this is a list of mac, each mac represents a column from the bitmap
     col_macs = fields.Binary("MACs", attachment=False)
 
+    _sql_constraints = [
+        (
+            "user_partition_uniq",
+            "unique(user_id, partition_index)",
+            "A user has only one folder per partition.",
+        )
+    ]
+
     # a field for display only
     # bitmaps_str = fields.Char(
     #     "Bitmaps String", compute="_compute_bitmaps_str", store=True
@@ -40,17 +77,171 @@ class ServerFolder(models.Model):
         return json.loads(col_macs_serialized)
 
     # we need some bitmaps operations
-    # for now the bitmaps is a dictionary,
-    # key is the str(id) of the encrypted document
-    # value is a list of 0s and 1s, each index indicates a keyword
+    # the bitmaps are kept packed (see bitmaps.py),
+    # each row is keyed by the id of the encrypted document
+    # and holds one bit per keyword index
     def bitmaps_create(self):
-        return dict()
+        return PackedBitmaps()
 
     def bitmaps_serialize(self, bitmaps_obj):
-        return json.dumps(bitmaps_obj)
+        return bitmaps_obj.to_bytes()
 
     def bitmaps_deserialize(self, bitmaps_serialized):
-        return json.loads(bitmaps_serialized)
+        return PackedBitmaps.load(bitmaps_serialized)
+
+    # assemble the bitmaps from the rows table, ordered by doc id
+    # only the rows of doc_ids are read when given
+    def bitmaps_load(self, doc_ids=None):
+        self.ensure_one()
+        self.env["server.bitmap.row"].flush(["folder_id", "document_id", "row"])
+        query = "SELECT document_id, row FROM server_bitmap_row WHERE folder_id = %s"
+        params = [self.id]
+        if doc_ids is not None:
+            query += " AND document_id IN %s"
+            params.append(tuple(int(d) for d in doc_ids) or (0,))
+        self.env.cr.execute(query + " ORDER BY document_id", params)
+        fetched = self.env.cr.fetchall()
+        return PackedBitmaps.from_packed_rows(
+            self.bitmap_width,
+            [doc_id for (doc_id, __) in fetched],
+            [bytes(row) for (__, row) in fetched],
+        )
+
+    # the bitmaps and the document version of each row, for the search store
+    def search_store_load(self):
+        self.ensure_one()
+        self.env["server.bitmap.row"].flush(["folder_id", "document_id", "row"])
+        self.env["encrypted.document"].flush(["version"])
+        self.env.cr.execute(
+            """
+            SELECT r.document_id, r.row, d.version
+              FROM server_bitmap_row r
+              JOIN encrypted_document d ON d.id = r.document_id
+             WHERE r.folder_id = %s
+          ORDER BY r.document_id
+            """,
+            [self.id],
+        )
+        fetched = self.env.cr.fetchall()
+        bitmaps_obj = PackedBitmaps.from_packed_rows(
+            self.bitmap_width,
+            [doc_id for (doc_id, __, __) in fetched],
+            [bytes(row) for (__, row, __) in fetched],
+        )
+        return bitmaps_obj, [version for (__, __, version) in fetched]
+
+    # the rows written after since_version, with the document version and the
+    # insertion version of each row, ordered by doc id
+    def delta_load(self, since_version):
+        self.ensure_one()
+        self.env["server.bitmap.row"].flush(
+            ["folder_id", "document_id", "row", "inserted_version"]
+        )
+        self.env["encrypted.document"].flush(["version"])
+        self.env.cr.execute(
+            """
+            SELECT r.document_id, r.row, d.version, r.inserted_version
+              FROM server_bitmap_row r
+              JOIN encrypted_document d ON d.id = r.document_id
+             WHERE r.folder_id = %s AND r.inserted_version > %s
+          ORDER BY r.document_id
+            """,
+            [self.id, since_version],
+        )
+        fetched = self.env.cr.fetchall()
+        bitmaps_obj = PackedBitmaps.from_packed_rows(
+            self.bitmap_width,
+            [f[0] for f in fetched],
+            [bytes(f[1]) for f in fetched],
+        )
+        return bitmaps_obj, [f[2] for f in fetched], [f[3] for f in fetched]
+
+    # [doc id, removed version] of the rows removed after since_version
+    def delta_removed(self, since_version):
+        self.ensure_one()
+        self.env["server.bitmap.tombstone"].flush()
+        self.env.cr.execute(
+            """
+            SELECT document_id, removed_version
+              FROM server_bitmap_tombstone
+             WHERE folder_id = %s AND removed_version > %s
+          ORDER BY document_id
+            """,
+            [self.id, since_version],
+        )
+        return [list(f) for f in self.env.cr.fetchall()]
+
+    # keep the removal of the rows of doc_ids, removed by the next version
+    def bitmaps_tombstone(self, doc_ids):
+        self.ensure_one()
+        self.env["server.bitmap.tombstone"].sudo().create(
+            [
+                {
+                    "folder_id": self.id,
+                    "document_id": doc_id,
+                    "removed_version": self.bitmap_version + 1,
+                }
+                for doc_id in doc_ids
+            ]
+        )
+
+    def bitmaps_count(self):
+        self.ensure_one()
+        return self.env["server.bitmap.row"].search_count(
+            [("folder_id", "=", self.id)]
+        )
+
+    # write rows for the given docs, only those rows are touched
+    def bitmaps_write(self, doc_ids, rows):
+        self.ensure_one()
+        if not doc_ids:
+            return
+        width = len(rows[0])
+        if width != self.bitmap_width:
+            if self.bitmaps_count():
+                raise ValidationError(
+                    _(
+                        "Bitmap width {} does not match folder width {}.".format(
+                            width, self.bitmap_width
+                        )
+                    )
+                )
+            # an empty folder takes the width of its first rows
+            self.sudo().bitmap_width = width
+        try:
+            packed = pack_rows(rows, width)
+        except ValueError as err:
+            raise ValidationError(_("Invalid bitmap rows: {}".format(err)))
+        self._bitmaps_write_packed(doc_ids, packed)
+
+    # written rows are tagged with the version the write is about to bump to,
+    # unless given an inserted_version
+    def _bitmaps_write_packed(self, doc_ids, packed, inserted_version=None):
+        row_obj = self.env["server.bitmap.row"].sudo()
+        existing = row_obj.search(
+            [("folder_id", "=", self.id), ("document_id", "in", list(doc_ids))]
+        )
+        existing = {r.document_id.id: r for r in existing}
+        if inserted_version is None:
+            inserted_version = self.bitmap_version + 1
+        vals_list = []
+        for k, doc_id in enumerate(doc_ids):
+            row = packed[k].tobytes()
+            if doc_id in existing:
+                existing[doc_id].write(
+                    {"row": row, "inserted_version": inserted_version}
+                )
+            else:
+                vals_list.append(
+                    {
+                        "folder_id": self.id,
+                        "document_id": doc_id,
+                        "row": row,
+                        "inserted_version": inserted_version,
+                    }
+                )
+        if vals_list:
+            row_obj.create(vals_list)
 
     # usually our bitmaps looks like this
     # doc_id: [0, 1, 0, ...]
@@ -60,38 +251,373 @@ class ServerFolder(models.Model):
     # should give a 2d array and a map of row_index to doc_id
     def bitmaps_flip(self, bitmaps_obj):
         self.ensure_one()
-        items = list(bitmaps_obj.items())
-        cols = []
-        row_to_doc = dict()
-        if items:
-            bitmap_width = len(list(items[0][1]))
-            for i in range(bitmap_width):
-                cols.append([0] * len(items))
-            for i in range(len(items)):
-                doc_id, row = items[i]
-                row_to_doc[i] = doc_id
-                for j in range(len(row)):
-                    cols[j][i] = row[j]
-        # print("...", cols, row_to_doc)
-        return cols, row_to_doc
+        return bitmaps_obj.flip()
 
     def bitmaps_update(self, bitmaps_obj, doc_ids, rows):
-        for i in range(len(doc_ids)):
-            doc_id = str(doc_ids[i])
-            bitmaps_obj[doc_id] = rows[i]
-        return bitmaps_obj
+        try:
+            return bitmaps_obj.update(doc_ids, rows)
+        except ValueError as err:
+            raise ValidationError(_("Invalid bitmap rows: {}".format(err)))
 
     def bitmaps_get(self, bitmaps_obj, doc_ids):
-        return [bitmaps_obj.get(str(doc_id)) for doc_id in doc_ids]
+        return bitmaps_obj.get(doc_ids)
 
     def bitmaps_remove(self, bitmaps_obj, doc_ids):
-        count, removed = len(doc_ids), 0
-        for doc_id in doc_ids:
-            doc_id = str(doc_id)
-            if doc_id in bitmaps_obj.keys():
-                del bitmaps_obj[doc_id]
-                removed += 1
-        return count == removed
+        return bitmaps_obj.remove(doc_ids)
+
+    # writers of a folder take this lock first, so that their version bumps
+    # and mac updates apply one after the other instead of conflicting
+    def lock(self):
+        self.ensure_one()
+        self.env.cr.execute(
+            "SELECT id FROM server_folder WHERE id = %s FOR UPDATE", (self.id,)
+        )
+        self.invalidate_cache(["bitmap_version", "bitmap_width", "col_macs"], self.ids)
+
+    # op is "set" for the whole mac list, or "xor" for the macs of the new rows
+    def col_macs_apply(self, col_macs_obj, op, macs):
+        if op == "set":
+            return self.col_macs_deserialize(macs)
+        macs = self.col_macs_deserialize(macs)
+        if len(col_macs_obj) != len(macs):
+            # an empty folder, or the client changed the bloom filter
+            col_macs_obj = [0] * len(macs)
+        return [c ^ m for (c, m) in zip(col_macs_obj, macs)]
+
+    # apply several write batches in one transaction, in order
+    # a batch is (create, rows, macs op, macs) where create makes the documents
+    # in the given env (see ResUsers.write_coalesced)
+    # each batch gets its own version bump, so that the versions of the servers
+    # agree however each of them grouped the batches
+    # should give the doc ids of each batch
+    def bitmaps_append(self, batches):
+        self.ensure_one()
+        col_macs_obj = self.col_macs_deserialize(self.col_macs or "[]")
+        res = []
+        for (create, rows, op, macs) in batches:
+            docs = create(self.env)
+            if not docs or len(docs) != len(rows):
+                raise ValidationError(_("Error creating files."))
+            res.append(docs.ids)
+            self.bitmaps_write(docs.ids, rows)
+            col_macs_obj = self.col_macs_apply(col_macs_obj, op, macs)
+            self.bitmaps_bump_version(self.col_macs_serialize(col_macs_obj))
+        return res
+
+    # every write to the rows goes with a new bitmap version
+    def bitmaps_bump_version(self, new_col_macs):
+        self.ensure_one()
+        version = self.bitmap_version + 1
+        self.sudo().write({"bitmap_version": version, "col_macs": new_col_macs})
+        # the search store of the old version is stale once this is committed
+        self.env.cr.postcommit.add(
+            functools.partial(
+                column_store.evict, self._search_store_directory(), self.id, version
+            )
+        )
+        return version
+
+    def _search_store_directory(self):
+        return os.path.join(tools.config["data_dir"], "o_dory", self.env.cr.dbname)
+
+    # column-major, memory-mapped bitmaps of the current version (see column_store.py)
+    # along with the doc ids and versions of the rows
+    # the store is built by the first search after a write and shared by all workers
+    def search_store(self):
+        self.ensure_one()
+        return column_store.open_store(
+            self._search_store_directory(),
+            self.id,
+            self.bitmap_version,
+            self.search_store_load,
+        )
+
+    # move a legacy bitmaps blob (json or packed) into the rows table
+    def bitmaps_migrate(self):
+        for folder_id in self:
+            if not folder_id.bitmaps:
+                continue
+            bitmaps_obj = folder_id.bitmaps_deserialize(folder_id.bitmaps)
+            # rows of documents that no longer exist are dropped
+            doc_ids = set(
+                self.env["encrypted.document"]
+                .browse(bitmaps_obj.doc_ids.tolist())
+                .exists()
+                .ids
+            )
+            keep = [i for (i, d) in enumerate(bitmaps_obj.doc_ids) if d in doc_ids]
+            folder_id.sudo().write({"bitmap_width": bitmaps_obj.width, "bitmaps": False})
+            # the rows do not change, so no version bump: they are tagged with
+            # the version they already had in the blob
+            folder_id._bitmaps_write_packed(
+                bitmaps_obj.doc_ids[keep].tolist(),
+                bitmaps_obj.rows[keep],
+                inserted_version=folder_id.bitmap_version,
+            )
+
+    # drop what searches no longer need, should give the bytes reclaimed
+    # from the search store files and the legacy blob, the dropped tombstones
+    # are counted apart (compaction_tombstones)
+    # tombstones are kept for the last tombstone_versions versions,
+    # delta searches from before then get full answers
+    # the caller holds the folder lock (see _cron_compact)
+    def compact(self, tombstone_versions):
+        self.ensure_one()
+        # search store files of older versions, left by crashed workers
+        reclaimed = column_store.evict(
+            self._search_store_directory(), self.id, self.bitmap_version
+        )
+        if self.bitmaps:
+            reclaimed += len(self.bitmaps)
+            self.bitmaps_migrate()
+
+        floor = self.bitmap_version - tombstone_versions
+        tombstones = 0
+        if floor > self.delta_floor:
+            self.env["server.bitmap.tombstone"].flush()
+            self.env.cr.execute(
+                """
+                DELETE FROM server_bitmap_tombstone
+                 WHERE folder_id = %s AND removed_version <= %s
+                """,
+                (self.id, floor),
+            )
+            tombstones = self.env.cr.rowcount
+            self.env["server.bitmap.tombstone"].invalidate_cache()
+
+        self.sudo().write(
+            {
+                "delta_floor": max(floor, self.delta_floor),
+                "compaction_date": fields.Datetime.now(),
+                "compaction_reclaimed": reclaimed,
+                "compaction_tombstones": tombstones,
+            }
+        )
+        return reclaimed
+
+    # compact every folder, one transaction per folder; folders a writer
+    # holds are skipped until the next run, searches are never blocked:
+    # they read the search store, which is only replaced atomically
+    @api.model
+    def _cron_compact(self):
+        params = self.env["ir.config_parameter"].sudo()
+        tombstone_versions = int(params.get_param("o_dory.tombstone_versions", 1000))
+        total, tombstones, skipped = 0, 0, 0
+        folder_ids = self.sudo().search([]).ids
+        for folder_id in self.sudo().browse(folder_ids):
+            self.env.cr.execute(
+                "SELECT id FROM server_folder WHERE id = %s FOR UPDATE SKIP LOCKED",
+                (folder_id.id,),
+            )
+            if not self.env.cr.fetchone():
+                skipped += 1
+                continue
+            folder_id.invalidate_cache()
+            total += folder_id.compact(tombstone_versions)
+            tombstones += folder_id.compaction_tombstones
+            self.env.cr.commit()
+            # rebuilt outside the lock, writers go on meanwhile
+            try:
+                folder_id.search_store()
+            except Exception:
+                _logger.exception("Cannot build the search store of %s", folder_id)
+
+        total += column_store.sweep(self._search_store_directory(), set(folder_ids))
+        _logger.info(
+            "Compacted {} folders ({} skipped), reclaimed {} bytes, "
+            "dropped {} tombstones".format(
+                len(folder_ids) - skipped, skipped, total, tombstones
+            )
+        )
+        return total
+
+    # the whole folder as one binary snapshot (see snapshot.py), should give
+    # its bytes by chunks; the rows and the paths of the blobs are read now,
+    # the blobs as the chunks are consumed, after the cursor may be closed
+    def snapshot_export(self):
+        self.ensure_one()
+        bitmaps_obj, versions = self.search_store_load()
+        sources = (
+            self.env["encrypted.document"]
+            .browse(bitmaps_obj.doc_ids.tolist())
+            .blob_sources()
+        )
+        return snapshot.iter_snapshot(
+            self.bitmap_version,
+            self.col_macs_deserialize(self.col_macs or "[]"),
+            versions,
+            bitmaps_obj,
+            [(size, source) for (__, __, size, source) in sources],
+        )
+
+    # load a snapshot read from stream into this folder, which must be empty
+    # the documents keep their ids, so the ones the clients hold stay valid,
+    # none of them may be used on this server (by any folder);
+    # blobs are staged and checked before anything is written, then the
+    # documents, attachments and rows are inserted in bulk
+    @metrics.operation("snapshot_import")
+    def snapshot_import(self, stream):
+        self.ensure_one()
+        self.lock()
+        if self.bitmaps_count() or self.env["encrypted.document"].search_count(
+            [("folder_id", "=", self.id)]
+        ):
+            raise ValidationError(_("The folder must be empty to import a snapshot."))
+
+        directory = os.path.join(
+            self._search_store_directory(),
+            "staging",
+            "snapshot-{}".format(uuid.uuid4().hex),
+        )
+        os.makedirs(directory)
+        cleanup = functools.partial(shutil.rmtree, directory, ignore_errors=True)
+        self.env.cr.postcommit.add(cleanup)
+        self.env.cr.postrollback.add(cleanup)
+
+        # index -> (path, size, sha1) of the blobs, empty ones are not stored
+        staged = dict()
+
+        def write_blob(index, size, chunks):
+            if not size:
+                return
+            path = os.path.join(directory, str(index))
+            digest = hashlib.sha1()
+            with open(path, "wb") as f:
+                for chunk in chunks:
+                    digest.update(chunk)
+                    f.write(chunk)
+            staged[index] = (path, size, digest.hexdigest())
+
+        try:
+            header, bitmaps_obj = snapshot.read_snapshot(stream, write_blob)
+        except ValueError as err:
+            raise ValidationError(_("Invalid snapshot: {}".format(err)))
+        doc_ids = bitmaps_obj.doc_ids.tolist()
+        if len(set(doc_ids)) != len(doc_ids) or min(doc_ids, default=1) < 1:
+            raise ValidationError(_("Invalid snapshot: bad document ids."))
+
+        cr = self.env.cr
+        self.env["encrypted.document"].flush()
+        if doc_ids:
+            cr.execute(
+                "SELECT id FROM encrypted_document WHERE id IN %s LIMIT 10",
+                [tuple(doc_ids)],
+            )
+            taken = [doc_id for (doc_id,) in cr.fetchall()]
+            if taken:
+                raise ValidationError(
+                    _(
+                        "Documents {} already exist on this server, snapshots keep "
+                        "their document ids and can only be imported where none "
+                        "of them is used.".format(taken)
+                    )
+                )
+
+        # a restored folder moves forward, the clients never see an older
+        # version than one they were answered; removals are not exported, delta
+        # searches from before the import get full answers
+        version = max(header["bitmap_version"], self.bitmap_version + 1)
+        uid, now = self.env.uid, fields.Datetime.now()
+        execute_values(
+            cr,
+            """
+            INSERT INTO encrypted_document
+                (id, folder_id, user_id, version,
+                 create_uid, create_date, write_uid, write_date)
+            VALUES %s
+            """,
+            [
+                (doc_id, self.id, self.user_id.id, doc_version, uid, now, uid, now)
+                for (doc_id, doc_version) in zip(doc_ids, header["versions"])
+            ],
+            page_size=1000,
+        )
+        # ids given by the server from now on come after the imported ones
+        cr.execute(
+            """
+            SELECT setval('encrypted_document_id_seq', GREATEST(
+                (SELECT MAX(id) FROM encrypted_document),
+                (SELECT last_value FROM encrypted_document_id_seq)))
+            """
+        )
+
+        # the blobs go to the filestore, same as staged uploads
+        attachment = self.env["ir.attachment"].sudo()
+        execute_values(
+            cr,
+            """
+            INSERT INTO ir_attachment
+                (name, res_model, res_field, res_id, company_id, type,
+                 store_fname, file_size, checksum, mimetype,
+                 create_uid, create_date, write_uid, write_date)
+            VALUES %s
+            """,
+            [
+                (
+                    "blob",
+                    "encrypted.document",
+                    "blob",
+                    doc_ids[index],
+                    self.env.company.id,
+                    "binary",
+                    store_staged(attachment, path, checksum),
+                    size,
+                    checksum,
+                    "application/octet-stream",
+                    uid,
+                    now,
+                    uid,
+                    now,
+                )
+                for (index, (path, size, checksum)) in sorted(staged.items())
+            ],
+            page_size=1000,
+        )
+        execute_values(
+            cr,
+            """
+            INSERT INTO server_bitmap_row
+                (folder_id, document_id, row, inserted_version,
+                 create_uid, create_date, write_uid, write_date)
+            VALUES %s
+            """,
+            [
+                (self.id, doc_id, Binary(row.tobytes()), version, uid, now, uid, now)
+                for (doc_id, row) in zip(doc_ids, bitmaps_obj.rows)
+            ],
+            page_size=1000,
+        )
+        # tombstones of documents removed before the import mean nothing now
+        self.env["server.bitmap.tombstone"].flush()
+        cr.execute("DELETE FROM server_bitmap_tombstone WHERE folder_id = %s", [self.id])
+        for model in (
+            "encrypted.document",
+            "ir.attachment",
+            "server.bitmap.row",
+            "server.bitmap.tombstone",
+        ):
+            self.env[model].invalidate_cache()
+
+        self.sudo().write(
+            {
+                "bitmap_width": bitmaps_obj.width,
+                "bitmap_version": version,
+                "col_macs": self.col_macs_serialize(header["col_macs"]),
+                "delta_floor": version,
+                "bitmaps": False,
+            }
+        )
+        self.env.cr.postcommit.add(
+            functools.partial(
+                column_store.evict, self._search_store_directory(), self.id
+            )
+        )
+        _logger.info(
+            "Imported {} documents into folder {} at version {}".format(
+                len(doc_ids), self.id, version
+            )
+        )
+        return doc_ids
 
     # @api.depends("bitmaps")
     # def _compute_bitmaps_str(self):
@@ -104,12 +630,20 @@ class ServerFolder(models.Model):
     @api.model_create_multi
     def create(self, vals_list):
         res_ids = super(ServerFolder, self).create(vals_list)
-        # when a server folder is created, there should be a bitmap table setup
+        # bitmap rows are added per document, only the macs need a setup
         for res_id in res_ids:
-            res_id.bitmaps = res_id.bitmaps_serialize(res_id.bitmaps_create())
             res_id.col_macs = res_id.col_macs_serialize(res_id.col_macs_create())
         return res_ids
 
+    def unlink(self):
+        for folder_id in self:
+            self.env.cr.postcommit.add(
+                functools.partial(
+                    column_store.evict, folder_id._search_store_directory(), folder_id.id
+                )
+            )
+        return super(ServerFolder, self).unlink()
+
 
 class EncryptedDocument(models.Model):
     _name = "encrypted.document"
@@ -119,5 +653,104 @@ class EncryptedDocument(models.Model):
     # name = fields.Char("Name")
     blob = fields.Binary("Encrypted Blob")  # maybe this should be binary
     folder_id = fields.Many2one("server.folder", ondelete="cascade", string="Folder")
-    user_id = fields.Many2one(related="folder_id.user_id")
+    # stored so listings filter on the owner without joining the folders
+    user_id = fields.Many2one(related="folder_id.user_id", store=True, index=True)
     version = fields.Char("Version")
+
+    # ids and versions of the documents of a user as two flat lists, ordered by id
+    # read straight from the table, without instantiating records
+    @api.model
+    def read_ids_versions(self, user_id, folder_id=None, doc_ids=None):
+        self.flush(["folder_id", "user_id", "version"])
+        query = "SELECT id, version FROM encrypted_document WHERE user_id = %s"
+        params = [user_id]
+        if folder_id is not None:
+            query += " AND folder_id = %s"
+            params.append(folder_id)
+        if doc_ids is not None:
+            query += " AND id IN %s"
+            params.append(tuple(int(d) for d in doc_ids) or (0,))
+        self.env.cr.execute(query + " ORDER BY id", params)
+        fetched = self.env.cr.fetchall()
+        return [doc_id for (doc_id, __) in fetched], [v for (__, v) in fetched]
+
+    # [doc id, version, size, source] of the blob of each document in order,
+    # the source is the path of the file in the filestore or the bytes
+    def blob_sources(self):
+        attachments = (
+            self.env["ir.attachment"]
+            .sudo()
+            .search(
+                [
+                    ("res_model", "=", "encrypted.document"),
+                    ("res_field", "=", "blob"),
+                    ("res_id", "in", self.ids),
+                ]
+            )
+        )
+        attachments = {a.res_id: a for a in attachments}
+
+        sources = []
+        for doc in self:
+            attachment = attachments.get(doc.id)
+            if not attachment:
+                sources.append([doc.id, doc.version, 0, b""])
+            elif attachment.store_fname:
+                path = attachment._full_path(attachment.store_fname)
+                sources.append([doc.id, doc.version, attachment.file_size, path])
+            else:
+                raw = attachment.raw or b""
+                sources.append([doc.id, doc.version, len(raw), raw])
+        return sources
+
+    def unlink(self):
+        # the rows go with the documents, delta searches need to know
+        rows = self.env["server.bitmap.row"].sudo().search(
+            [("document_id", "in", self.ids)]
+        )
+        for folder_id in rows.folder_id:
+            folder_id.bitmaps_tombstone(
+                rows.filtered(lambda r: r.folder_id == folder_id).document_id.ids
+            )
+        return super(EncryptedDocument, self).unlink()
+
+
+# one masked bloom filter row per encrypted document
+class ServerBitmapRow(models.Model):
+    _name = "server.bitmap.row"
+    _description = "Bitmap Row"
+    _order = "document_id"
+
+    folder_id = fields.Many2one(
+        "server.folder", ondelete="cascade", string="Folder", required=1, index=True
+    )
+    document_id = fields.Many2one(
+        "encrypted.document",
+        ondelete="cascade",
+        string="Document",
+        required=1,
+        index=True,
+    )
+    # np.packbits of the row, the width is the folder's bitmap_width
+    row = fields.Binary("Row", attachment=False)
+    # bitmap version of the folder once the row was (re)written
+    inserted_version = fields.Integer("Inserted Version", index=True)
+
+    _sql_constraints = [
+        ("document_uniq", "unique(document_id)", "A document has only one row.")
+    ]
+
+
+# a row removed from the bitmaps, delta searches report it
+# to the clients holding an answer from before its removal
+class ServerBitmapTombstone(models.Model):
+    _name = "server.bitmap.tombstone"
+    _description = "Removed Bitmap Row"
+    _order = "removed_version"
+
+    folder_id = fields.Many2one(
+        "server.folder", ondelete="cascade", string="Folder", required=1, index=True
+    )
+    # the document is gone, only its id is kept
+    document_id = fields.Integer("Document ID", required=True)
+    removed_version = fields.Integer("Removed Version", index=True)
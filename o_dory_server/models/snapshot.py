@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+# binary snapshot of a whole folder, to move it to another server or back it up
+#
+#   snapshot : magic | header size (uint32) | header (json)
+#              | bitmaps size (uint64) | bitmaps | blob * row count | checksum
+#   blob     : size (uint64) | bytes
+#
+# little endian; the bitmaps are in the packed layout of bitmaps.py, their row
+# ids are the ids of the documents and the blobs follow in the order of the
+# rows; the header holds the format version, the bitmap version, the col macs
+# and the version of each document, again in the order of the rows; the
+# checksum is the sha256 of all the bytes before it
+#
+# both sides go through the snapshot as a stream, the blobs by chunks, so only
+# the bitmaps and the header are held in memory
+#
+# documents keep their ids, which the clients hold, so a snapshot is imported
+# into a server whose documents do not use any of them (a new host, or the
+# one it was exported from once the folder was emptied)
+#
+# this module does not depend on odoo so it can be used by scripts as well
+import hashlib, struct
+
+import ujson as json
+
+from .bitmaps import PackedBitmaps, row_size, HEADER as BITMAPS_HEADER
+
+MAGIC = b"ODORYSNP"
+FORMAT_VERSION = 1
+HEADER_SIZE = struct.Struct("<I")
+SIZE = struct.Struct("<Q")
+CHECKSUM_SIZE = hashlib.sha256().digest_size
+CHUNK_SIZE = 64 * 1024
+
+
+# should give the bytes of the snapshot, by chunks
+# sources are (size, path of a file or the bytes of the blob) in the order of
+# the rows of bitmaps_obj, the files are only read while the chunks are
+def iter_snapshot(bitmap_version, col_macs, versions, bitmaps_obj, sources):
+    if not len(bitmaps_obj) == len(versions) == len(sources):
+        raise ValueError("Expected one version and one blob per row.")
+    digest = hashlib.sha256()
+
+    def checked(data):
+        digest.update(data)
+        return data
+
+    header = json.dumps(
+        {
+            "format": FORMAT_VERSION,
+            "bitmap_version": bitmap_version,
+            "col_macs": col_macs,
+            "versions": versions,
+        }
+    ).encode()
+    yield checked(MAGIC + HEADER_SIZE.pack(len(header)) + header)
+    packed = bitmaps_obj.to_bytes()
+    yield checked(SIZE.pack(len(packed)) + packed)
+    for (size, source) in sources:
+        yield checked(SIZE.pack(size))
+        if isinstance(source, bytes):
+            yield checked(source)
+            continue
+        with open(source, "rb") as f:
+            remaining = size
+            while remaining > 0:
+                chunk = f.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise IOError("Truncated blob {}".format(source))
+                remaining -= len(chunk)
+                yield checked(chunk)
+    yield digest.digest()
+
+
+class Reader(object):
+    """Exact reads from a stream, hashed as they go."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.digest = hashlib.sha256()
+
+    def read(self, size, hashed=True):
+        return b"".join(self.iter_chunks(size, hashed))
+
+    def iter_chunks(self, size, hashed=True):
+        while size > 0:
+            chunk = self.stream.read(min(CHUNK_SIZE, size))
+            if not chunk:
+                raise ValueError("Truncated snapshot")
+            size -= len(chunk)
+            if hashed:
+                self.digest.update(chunk)
+            yield chunk
+
+    def unpack(self, fmt):
+        return fmt.unpack(self.read(fmt.size))[0]
+
+
+def _is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+# ValueError unless header is a whole header for count rows
+def _check_header(header, count):
+    version = header.get("bitmap_version")
+    if not _is_int(version) or version < 0:
+        raise ValueError("Invalid snapshot bitmap version")
+    col_macs = header.get("col_macs")
+    if not isinstance(col_macs, list) or not all(_is_int(m) for m in col_macs):
+        raise ValueError("Invalid snapshot macs")
+    versions = header.get("versions")
+    if not isinstance(versions, list) or len(versions) != count:
+        raise ValueError("Expected one version per row")
+    if not all(v is None or isinstance(v, str) for v in versions):
+        raise ValueError("Invalid snapshot document versions")
+
+
+# read a snapshot from stream (a file like object), write_blob(index, size,
+# chunks) is called for the blob of each row in order, with the chunks of the
+# blob as an iterator; should give the header and the bitmaps
+# ValueError when the stream is not a whole snapshot or fails its checksum,
+# blobs written up to then should be dropped by the caller
+def read_snapshot(stream, write_blob, max_header_size=1024 ** 3):
+    reader = Reader(stream)
+    if reader.read(len(MAGIC)) != MAGIC:
+        raise ValueError("Not a folder snapshot")
+    size = reader.unpack(HEADER_SIZE)
+    if size > max_header_size:
+        raise ValueError("Snapshot header too large")
+    header = json.loads(reader.read(size))
+    if not isinstance(header, dict) or header.get("format") != FORMAT_VERSION:
+        raise ValueError("Unsupported snapshot format")
+
+    size = reader.unpack(SIZE)
+    if not BITMAPS_HEADER.size <= size <= max_header_size:
+        raise ValueError("Invalid snapshot bitmaps")
+    packed = reader.read(size)
+    try:
+        bitmaps_obj = PackedBitmaps.from_bytes(packed)
+    except (struct.error, ValueError):
+        raise ValueError("Invalid snapshot bitmaps")
+    count = len(bitmaps_obj)
+    if size != BITMAPS_HEADER.size + count * (8 + row_size(bitmaps_obj.width)):
+        raise ValueError("Invalid snapshot bitmaps")
+    _check_header(header, count)
+
+    for index in range(count):
+        size = reader.unpack(SIZE)
+        chunks = reader.iter_chunks(size)
+        write_blob(index, size, chunks)
+        # whatever the writer left is still part of the checksum
+        for __ in chunks:
+            pass
+
+    checksum = reader.digest.digest()
+    if reader.read(CHECKSUM_SIZE, hashed=False) != checksum:
+        raise ValueError("Snapshot checksum mismatch")
+    if stream.read(1):
+        raise ValueError("Unexpected data after the snapshot")
+    return header, bitmaps_obj
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+# per request timings sent back to the client
+#
+# a client that passes o_dory_trace_id in the context of an rpc gets
+#
+#   {"result": <the usual answer>, "o_dory_trace": {"id", "spans"}}
+#
+# spans are [name, start, duration] in milliseconds from the start of the
+# call on this server, the first one covers the whole call; the phases timed
+# for the metrics (see metrics.phase) are recorded as spans too
+#
+# the trace of a request is kept in a thread local, threads working for it
+# (partitioned searches) attach it explicitly; a search coalesced with the
+# one of another request is evaluated by that request, its own trace then
+# only shows the wait
+import contextlib, functools, logging, threading, time
+
+_logger = logging.getLogger(__name__)
+
+MAX_TRACE_ID_SIZE = 64
+
+_local = threading.local()
+
+
+class Trace(object):
+    def __init__(self, trace_id):
+        self.trace_id = trace_id
+        self.start = time.monotonic()
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def record(self, name, start, end):
+        with self._lock:
+            self.spans.append(
+                [
+                    name,
+                    round((start - self.start) * 1000, 3),
+                    round((end - start) * 1000, 3),
+                ]
+            )
+
+    def export(self):
+        with self._lock:
+            return {
+                "id": self.trace_id,
+                "spans": sorted(self.spans, key=lambda span: (span[1], -span[2])),
+            }
+
+
+def current():
+    return getattr(_local, "trace", None)
+
+
+# record the spans of this thread in trace
+@contextlib.contextmanager
+def attach(trace):
+    previous = current()
+    _local.trace = trace
+    try:
+        yield trace
+    finally:
+        _local.trace = previous
+
+
+def record(name, start, end):
+    trace = current()
+    if trace is not None:
+        trace.record(name, start, end)
+
+
+@contextlib.contextmanager
+def span(name):
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        record(name, start, time.monotonic())
+
+
+# trace an rpc method of a model when the context asks for it, calls made
+# while a trace is already recorded (from another traced method) are spans
+def traced(name):
+    def decorate(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if current() is not None:
+                with span(name):
+                    return method(self, *args, **kwargs)
+            trace_id = self.env.context.get("o_dory_trace_id")
+            if not isinstance(trace_id, str):
+                return method(self, *args, **kwargs)
+            trace = Trace(trace_id[:MAX_TRACE_ID_SIZE])
+            with attach(trace):
+                try:
+                    result = method(self, *args, **kwargs)
+                finally:
+                    trace.record(name, trace.start, time.monotonic())
+            _logger.info("Trace {} {}".format(trace.trace_id, name))
+            return {"result": result, "o_dory_trace": trace.export()}
+
+        return wrapper
+
+    return decorate
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+from odoo import models, fields, api, tools, _
+from odoo.exceptions import ValidationError
+
+import ujson as json
+import datetime, fcntl, functools, hashlib, logging, os, shutil, uuid
+
+_logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+# open sessions not committed after this are dropped with their chunks
+SESSION_MAX_AGE = datetime.timedelta(days=1)
+
+
+# move a staged file into the filestore, checksum is its sha1,
+# should give its store_fname
+def store_staged(attachment, path, checksum):
+    fname = "{}/{}".format(checksum[:2], checksum)
+    full_path = attachment._full_path(fname)
+    if not os.path.exists(full_path):
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        # the staged file is kept until the transaction commits,
+        # a failed commit can then be retried without uploading again
+        try:
+            os.link(path, full_path)
+        except OSError:
+            shutil.copyfile(path, full_path)
+    # same as ir.attachment._file_write, unreferenced files get collected
+    attachment._mark_for_gc(fname)
+    return fname
+
+
+# a staged upload: the blobs are sent by chunks to the staging directory
+# (PUT /o_dory/upload/<token>/<index>, see the controllers), then the
+# documents, their bitmap rows and the macs are created in one transaction
+class ServerUploadSession(models.Model):
+    _name = "server.upload.session"
+    _description = "Upload Session"
+
+    token = fields.Char("Token", required=True, index=True, copy=False)
+    user_id = fields.Many2one(
+        "res.users", ondelete="cascade", string="User", required=1
+    )
+    folder_id = fields.Many2one(
+        "server.folder", ondelete="cascade", string="Folder", required=1
+    )
+    # declared size of each blob, json list
+    sizes = fields.Char("Sizes", required=True)
+    state = fields.Selection(
+        [("open", "Open"), ("committed", "Committed")], default="open", required=True
+    )
+    # json list of the created documents, answered again if the commit is retried
+    doc_ids = fields.Char("Documents")
+
+    _sql_constraints = [
+        ("token_uniq", "unique(token)", "The upload token must be unique."),
+    ]
+
+    @api.model
+    def start(self, user_id, folder_id, sizes):
+        if any(not isinstance(s, int) or s < 0 for s in sizes):
+            raise ValidationError(_("Invalid blob sizes."))
+        session = self.create(
+            {
+                "token": uuid.uuid4().hex,
+                "user_id": user_id,
+                "folder_id": folder_id,
+                "sizes": json.dumps(sizes),
+            }
+        )
+        os.makedirs(session._staging_directory(), exist_ok=True)
+        return session
+
+    def _staging_directory(self):
+        return os.path.join(
+            tools.config["data_dir"], "o_dory", self.env.cr.dbname, "staging", self.token
+        )
+
+    def _part_path(self, index):
+        return os.path.join(self._staging_directory(), "{}.part".format(index))
+
+    # bytes received so far for each blob, the chunks are appended in order
+    # so this is also the offset the client should resume from
+    def received(self):
+        self.ensure_one()
+        res = []
+        for index in range(len(json.loads(self.sizes))):
+            path = self._part_path(index)
+            res.append(os.path.getsize(path) if os.path.exists(path) else 0)
+        return res
+
+    def status(self):
+        self.ensure_one()
+        return {
+            "state": self.state,
+            "sizes": json.loads(self.sizes),
+            "received": self.received() if self.state == "open" else [],
+            "doc_ids": json.loads(self.doc_ids or "[]"),
+        }
+
+    # append data to the blob at index, offset must be the number of bytes
+    # already received, should give the new offset (or the current one when
+    # the chunk does not follow, the client then resumes from there)
+    def write_chunk(self, index, offset, data):
+        self.ensure_one()
+        sizes = json.loads(self.sizes)
+        if self.state != "open" or not 0 <= index < len(sizes):
+            raise ValidationError(_("Invalid upload chunk."))
+        with open(self._part_path(index), "ab") as f:
+            # a retried chunk may race with the original request
+            fcntl.flock(f, fcntl.LOCK_EX)
+            received = os.fstat(f.fileno()).st_size
+            if offset != received:
+                return received
+            if offset + len(data) > sizes[index]:
+                raise ValidationError(_("Upload chunk exceeds the declared size."))
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        return received + len(data)
+
+    # move a staged blob into the filestore, as the blob of doc
+    def _attach_staged(self, doc, path, size):
+        attachment = self.env["ir.attachment"].sudo()
+        digest = hashlib.sha1()
+        with open(path, "rb") as f:
+            for chunk in iter(functools.partial(f.read, CHUNK_SIZE), b""):
+                digest.update(chunk)
+        checksum = digest.hexdigest()
+        fname = store_staged(attachment, path, checksum)
+        attachment.create(
+            {
+                "name": "blob",
+                "res_model": "encrypted.document",
+                "res_field": "blob",
+                "res_id": doc.id,
+                "store_fname": fname,
+                "file_size": size,
+                "checksum": checksum,
+                "mimetype": "application/octet-stream",
+            }
+        )
+
+    # create the documents from the staged blobs with their bitmap rows,
+    # the write is queued with the concurrent ones of the folder
+    # (see ResUsers.write_coalesced), op and macs as in bitmaps_append
+    def commit(self, versions, bloom_filter_rows, op, macs):
+        self.ensure_one()
+        if self.state == "committed":
+            return json.loads(self.doc_ids)
+
+        sizes = json.loads(self.sizes)
+        if not (len(sizes) == len(versions) == len(bloom_filter_rows)):
+            raise ValidationError(_("Upload session does not match the data."))
+        if self.received() != sizes:
+            raise ValidationError(_("Upload session is incomplete."))
+        if not sizes:
+            raise ValidationError(_("Error creating files."))
+
+        def create(env):
+            return self.with_env(env).create_documents(versions)
+
+        return self.user_id.write_coalesced(
+            self.folder_id, create, bloom_filter_rows, op, macs
+        )
+
+    # runs in the transaction that writes the rows, which may be the one of
+    # another upload to the folder, the session is committed along with it
+    def create_documents(self, versions):
+        self.ensure_one()
+        # concurrent commits of the same session wait for the first one
+        self.env.cr.execute(
+            "SELECT id FROM server_upload_session WHERE id = %s FOR UPDATE",
+            (self.id,),
+        )
+        self.invalidate_cache(["state", "doc_ids"], self.ids)
+        if self.state == "committed":
+            raise ValidationError(_("Upload session is already committed."))
+
+        sizes = json.loads(self.sizes)
+        doc_ids = self.env["encrypted.document"].create(
+            [{"folder_id": self.folder_id.id, "version": version} for version in versions]
+        )
+        for (index, doc) in enumerate(doc_ids):
+            # no chunk is sent for an empty blob, which has no attachment
+            # either, as with a write of an empty binary field
+            if sizes[index]:
+                self._attach_staged(doc, self._part_path(index), sizes[index])
+        self.write({"state": "committed", "doc_ids": json.dumps(doc_ids.ids)})
+
+        directory = self._staging_directory()
+        self.env.cr.postcommit.add(
+            functools.partial(shutil.rmtree, directory, ignore_errors=True)
+        )
+        return doc_ids
+
+    @api.autovacuum
+    def _gc_upload_sessions(self):
+        limit = fields.Datetime.now() - SESSION_MAX_AGE
+        # chunks do not write the session, so write_date is the start of an
+        # open session, committed ones are only kept to answer retried commits
+        sessions = self.search([("write_date", "<", limit)])
+        directories = [s._staging_directory() for s in sessions]
+        sessions.unlink()
+        for directory in directories:
+            self.env.cr.postcommit.add(
+                functools.partial(shutil.rmtree, directory, ignore_errors=True)
+            )
+        _logger.info("Removed {} upload sessions".format(len(directories)))
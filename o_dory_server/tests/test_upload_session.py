@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from odoo.tests import TransactionCase
+
+import ujson as json
+import shutil
+
+
+class TestUploadSession(TransactionCase):
+    def setUp(self):
+        super().setUp()
+        self.user = self.env.ref("o_dory_server.user_alice")
+
+    def start(self, sizes):
+        token = self.user.upload_session_start(sizes)
+        session = self.user.get_upload_session(token)
+        self.addCleanup(shutil.rmtree, session._staging_directory(), True)
+        return token, session
+
+    # the client sends no chunk for an empty blob
+    def test_commit_empty_blob(self):
+        token, session = self.start([0, 3])
+        self.assertEqual(session.write_chunk(1, 0, b"abc"), 3)
+        self.assertEqual(session.received(), [0, 3])
+
+        rows = [[1, 0, 0, 0], [0, 1, 0, 0]]
+        self.user.upload_session_commit(
+            token, [["v0", "v1"], rows, json.dumps([0, 0, 0, 0])]
+        )
+        self.assertEqual(session.state, "committed")
+
+        doc_ids = self.env["encrypted.document"].browse(json.loads(session.doc_ids))
+        sources = doc_ids.blob_sources()
+        self.assertEqual([s[1:3] for s in sources], [["v0", 0], ["v1", 3]])
+        with open(sources[1][3], "rb") as f:
+            self.assertEqual(f.read(), b"abc")
@@ -0,0 +1,65 @@
+import sys, logging, subprocess, time
+
+# times what loading the o-dory modules used to pay on every worker start,
+# importing sycret and creating its dpf factory, in fresh interpreters
+#   python3 bench_import.py [<n_threads int> ...]
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+    datefmt="%I:%M:%S %p",
+)
+
+# each measure runs in its own interpreter, so nothing is already imported
+IMPORT_CODE = """
+import time
+start = time.time()
+import numpy, sycret
+print(time.time() - start)
+"""
+
+FACTORY_CODE = """
+import time
+import numpy, sycret
+start = time.time()
+eq = sycret.EqFactory(n_threads={n_threads})
+created = time.time() - start
+eq.keygen(1)
+print(created, time.time() - start)
+"""
+
+
+def measure(code):
+    start = time.time()
+    out = subprocess.run(
+        [sys.executable, "-c", code], check=True, capture_output=True, text=True
+    ).stdout
+    return time.time() - start, [float(v) for v in out.split()]
+
+
+def run(thread_counts):
+    total, (import_time,) = measure(IMPORT_CODE)
+    logging.info(
+        "import numpy and sycret {:.3f}s (interpreter {:.3f}s)".format(
+            import_time, total
+        )
+    )
+    for n_threads in thread_counts:
+        total, (create_time, keygen_time) = measure(
+            FACTORY_CODE.format(n_threads=n_threads)
+        )
+        logging.info(
+            "EqFactory(n_threads={}): create {:.3f}s, create + first keygen "
+            "{:.3f}s (interpreter {:.3f}s)".format(
+                n_threads, create_time, keygen_time, total
+            )
+        )
+
+
+if __name__ == "__main__":
+    try:
+        thread_counts = [int(a) for a in sys.argv[1:]]
+    except ValueError:
+        print("input: [<n_threads int> ...]\nex: 1 4 10 64")
+        sys.exit()
+    run(thread_counts or [1, 10])
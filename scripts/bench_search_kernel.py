@@ -0,0 +1,130 @@
+import sys, logging, os, time, importlib.util
+import numpy as np
+
+# compares the pure python server search loop (ResUsers.server_search_seq)
+# with the numpy kernel over packed columns, and the former python loop of the
+# naive search with its packed AND (match_all), without running odoo
+#   python3 bench_search_kernel.py [<bloom_filter_width int> <doc_num int> ...]
+
+KERNEL_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "..",
+    "o_dory_server",
+    "models",
+    "search_kernel.py",
+)
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+    datefmt="%I:%M:%S %p",
+)
+
+
+def load_kernel():
+    # load the module on its own, importing the addon would need odoo
+    spec = importlib.util.spec_from_file_location("search_kernel", KERNEL_PATH)
+    kernel = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(kernel)
+    return kernel
+
+
+def server_search_seq(outputs, cols, results, col_s, col_e, row_s, row_e):
+    for j in range(col_s, col_e):
+        for i in range(row_s, row_e):
+            results[j][i] ^= outputs[j] & cols[j][i]
+
+
+def run(kernel, bf_width, doc_num):
+    cols = np.random.randint(0, 2, size=(bf_width, doc_num), dtype=np.uint8)
+    # dpf outputs are arbitrary integers, only their low bit ends up in results
+    outputs = np.random.randint(-(2 ** 31), 2 ** 31, size=bf_width, dtype=np.int64)
+    # packing happens once per bitmap version in the search store, not per search
+    words = kernel.pack_columns(cols)
+
+    cols_lst, outputs_lst = cols.tolist(), outputs.tolist()
+    results_seq = [[0 for x in range(doc_num)] for y in range(bf_width)]
+    start = time.time()
+    server_search_seq(
+        outputs_lst, cols_lst, results_seq, 0, bf_width, 0, doc_num
+    )
+    seq_time = time.time() - start
+
+    start = time.time()
+    results_words = kernel.scan(outputs, words)
+    scan_time = time.time() - start
+    results_np = kernel.unpack_columns(results_words, doc_num).tolist()
+    numpy_time = time.time() - start
+
+    assert results_np == results_seq
+    logging.info(
+        "width {} docs {}: seq {:.3f}s, numpy scan {:.4f}s, "
+        "numpy scan + unpack {:.4f}s ({:.0f}x)".format(
+            bf_width,
+            doc_num,
+            seq_time,
+            scan_time,
+            numpy_time,
+            seq_time / numpy_time if numpy_time else float("inf"),
+        )
+    )
+    return seq_time, numpy_time
+
+
+# the naive search before it used packed columns
+def naive_search_seq(cols, all_indices):
+    all_ret = [[] for i in all_indices]
+    for i in range(len(cols[0])):
+        for j, indices in enumerate(all_indices):
+            if all([cols[k][i] for k in indices]):
+                all_ret[j].append(i)
+    return all_ret
+
+
+def run_naive(kernel, bf_width, doc_num, query_num=10, hash_count=7):
+    # dense enough that every query matches some rows
+    cols = (np.random.random((bf_width, doc_num)) < 0.8).astype(np.uint8)
+    words = kernel.pack_columns(cols)
+    all_indices = [
+        np.random.choice(bf_width, hash_count, replace=False).tolist()
+        for q in range(query_num)
+    ]
+
+    cols_lst = cols.tolist()
+    start = time.time()
+    results_seq = naive_search_seq(cols_lst, all_indices)
+    seq_time = time.time() - start
+
+    start = time.time()
+    results_np = [r.tolist() for r in kernel.match_all(words, doc_num, all_indices)]
+    numpy_time = time.time() - start
+
+    assert results_np == results_seq
+    logging.info(
+        "width {} docs {} naive {} queries: seq {:.3f}s, numpy {:.4f}s "
+        "({:.0f}x)".format(
+            bf_width,
+            doc_num,
+            query_num,
+            seq_time,
+            numpy_time,
+            seq_time / numpy_time if numpy_time else float("inf"),
+        )
+    )
+    return seq_time, numpy_time
+
+
+if __name__ == "__main__":
+    args = [int(a) for a in sys.argv[1:]]
+    if len(args) % 2:
+        print(
+            "input: [<bloom_filter_width int> <doc_num int> ...]\n"
+            "ex: 9585 1024 9585 4096"
+        )
+        sys.exit()
+    # the default sizes are the ones from the README
+    sizes = list(zip(args[::2], args[1::2])) or [(9585, 1024), (9585, 4096)]
+    kernel = load_kernel()
+    for bf_width, doc_num in sizes:
+        run(kernel, bf_width, doc_num)
+        run_naive(kernel, bf_width, doc_num)
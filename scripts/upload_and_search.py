@@ -172,6 +172,7 @@ def create_client_manager(url, db, login, pw, client_params):
                 "hash_count": hash_count,
                 "salt": salt,
                 "async_enabled": async_enabled,
+                "search_engine": "async" if async_enabled else "numpy",
             }
         ],
     )